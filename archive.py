@@ -0,0 +1,329 @@
+import io
+import os
+import stat
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import ProtocolError
+from dirindex import relative
+from transfers import preallocate
+
+# Folder trees as a single stream, for the recursive TREE commands.
+#
+# A tree travels as the body of one request: a sequence of entries, each a
+# fixed header with the entry's kind, size, mtime and permission bits,
+# followed by its path and, for files, its contents, and an END entry to
+# close it. Like tar, except that the sender builds it lazily while it walks
+# the folder and the receiver unpacks it as the bytes arrive, so the archive
+# never exists anywhere as a whole and 200k small files cost one round trip
+# instead of 200k.
+#
+# Small files are packed many to a DATA frame, larger ones follow their
+# header as frames of their own (sendfile where possible). On the receiving
+# side small files are handed to a pool of writer threads, so opening,
+# writing and renaming them overlaps with receiving the next ones. Entry
+# paths are relative to the tree with "/" separators, and the receiver
+# checks every one of them before anything is written.
+
+ENTRY = struct.Struct("!BHQqH")  # kind, path length, size, mtime_ns, mode
+KIND_DIR = 1
+KIND_FILE = 2
+KIND_END = 3
+BATCH_SIZE = 256 * 1024  # Headers and small files are sent in frames of about this many bytes
+SMALL_FILE = 64 * 1024  # Files up to this size travel inside a batch and are written by the pool
+WRITE_THREADS = 8  # Files an Extractor writes to disk at once
+MAX_PENDING = 64 * 1024 * 1024  # Bytes of small files waiting for a writer before receiving pauses
+
+
+def entry_header(kind, name, size=0, mtime_ns=0, mode=0):
+    path = name.encode("utf-8")
+    return ENTRY.pack(kind, len(path), size, mtime_ns, stat.S_IMODE(mode)) + path
+
+
+def walk(root):
+    # (name, path, stat) of everything below root, each folder before its
+    # contents and names in sorted order. Symlinks and special files are
+    # left out, so are entries that vanish while we walk.
+    stack = [""]
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, folder)) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subfolders = []
+        for entry in entries:
+            name = f"{folder}/{entry.name}" if folder else entry.name
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                subfolders.append(name)
+            elif not stat.S_ISREG(st.st_mode):
+                continue
+            yield name, entry.path, st
+        stack.extend(reversed(subfolders))
+
+
+def open_file(path):
+    f = open(path, "rb")
+    return f, os.fstat(f.fileno()).st_size
+
+
+def pack(root, open_source=open_file, small_file=SMALL_FILE, batch_size=BATCH_SIZE):
+    # The stream of the tree at root as (piece, last) pairs to send in order.
+    # A piece is either bytes (headers and small files, batched) or a
+    # (source, size) pair whose contents follow as they are, last is only
+    # true for the final piece. open_source(path) returns (source, size);
+    # sources that aren't file objects (the server's chunk lists of
+    # deduplicated files) are never read here. A source is closed when the
+    # next piece is asked for.
+    batch = bytearray()
+    for name, path, st in walk(root):
+        if stat.S_ISDIR(st.st_mode):
+            batch += entry_header(KIND_DIR, name, 0, st.st_mtime_ns, st.st_mode)
+        else:
+            try:
+                source, size = open_source(path)
+            except (OSError, ValueError):
+                continue  # Removed since the walk saw it, or unreadable
+            try:
+                if size <= small_file and isinstance(source, io.IOBase):
+                    data = source.read(size)
+                    batch += entry_header(KIND_FILE, name, len(data), st.st_mtime_ns, st.st_mode)
+                    batch += data
+                else:
+                    batch += entry_header(KIND_FILE, name, size, st.st_mtime_ns, st.st_mode)
+                    yield batch, False
+                    batch = bytearray()
+                    yield (source, size), False
+            finally:
+                if isinstance(source, io.IOBase):
+                    source.close()
+        if len(batch) >= batch_size:
+            yield batch, False
+            batch = bytearray()
+    batch += entry_header(KIND_END, "")
+    yield batch, True
+
+
+def make_folder(path):
+    os.makedirs(path, exist_ok=True)
+
+
+def staging_file(path):
+    return path + ".part"
+
+
+class Extractor:
+    # Receiving side: write(data) takes the stream in pieces of any size,
+    # finish() waits until every file is stored. Entries that can't be stored
+    # are skipped and listed in errors, the rest of the tree still arrives.
+    # make_folder(path), staging_file(path) and publish(staging_path, path)
+    # let the server go through its storage layer, with keep_metadata the
+    # sender's mtimes and permission bits are applied too.
+
+    def __init__(self, root, make_folder=make_folder, staging_file=staging_file, publish=os.replace,
+                 keep_metadata=False, threads=WRITE_THREADS, small_file=SMALL_FILE):
+        self.root = root
+        self.make_folder = make_folder
+        self.staging_file = staging_file
+        self.publish = publish
+        self.keep_metadata = keep_metadata
+        self.threads = threads
+        self.small_file = small_file
+        self.header = bytearray()  # Header of the next entry so far
+        self.entry = None  # (name, path, mtime_ns, mode) of the file being received
+        self.remaining = 0  # Bytes of its contents still to come
+        self.contents = None  # Contents so far of a small file
+        self.staging = None  # (staging path, open file) of a large file
+        self.folders_made = []  # (path, mtime_ns, mode), to apply metadata once they are filled
+        self.pool = None
+        self.pending = 0  # Bytes of small files queued in the pool
+        self.cond = threading.Condition()
+        self.lock = threading.Lock()  # Guards the counters and errors, updated by the pool
+        self.done = False  # END entry seen
+        self.files = 0
+        self.folders = 0
+        self.bytes = 0
+        self.errors = []  # "name: reason" of every entry that was skipped
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self.remaining:
+                piece = view[:self.remaining]
+                view = view[len(piece):]
+                self.remaining -= len(piece)
+                self._contents(piece)
+                if not self.remaining:
+                    self._file_done()
+                continue
+            if self.done:
+                raise ProtocolError("Data after the end of the archive")
+            piece = view[:self._header_size() - len(self.header)]
+            view = view[len(piece):]
+            self.header += piece
+            if len(self.header) == self._header_size():
+                self._start_entry()
+
+    def _header_size(self):
+        # The fixed part of a header first, then as much path as it announces
+        if len(self.header) < ENTRY.size:
+            return ENTRY.size
+        return ENTRY.size + ENTRY.unpack_from(self.header)[1]
+
+    def _start_entry(self):
+        kind, _, size, mtime_ns, mode = ENTRY.unpack_from(self.header)
+        try:
+            name = bytes(self.header[ENTRY.size:]).decode("utf-8")
+        except UnicodeDecodeError:
+            raise ProtocolError("Archive entry name is not UTF-8")
+        self.header = bytearray()
+        if kind == KIND_END:
+            self.done = True
+            return
+        if kind not in (KIND_DIR, KIND_FILE):
+            raise ProtocolError(f"Unknown archive entry kind {kind}")
+        path = self._target(name)
+        if kind == KIND_DIR:
+            if path is not None:
+                try:
+                    self.make_folder(path)
+                    self.folders += 1
+                    self.folders_made.append((path, mtime_ns, mode))
+                except OSError as e:
+                    self._error(name, e)
+            return
+        self.entry = (name, path, mtime_ns, mode)
+        self.remaining = size
+        if path is None:
+            pass  # Refused, the contents are read and dropped
+        elif size <= self.small_file:
+            self.contents = bytearray()
+        else:
+            staging_path = self.staging_file(path)
+            try:
+                f = open(staging_path, "wb")
+                preallocate(f.fileno(), size)
+                self.staging = (staging_path, f)
+            except OSError as e:
+                self._error(name, e)
+        if not size:
+            self._file_done()
+
+    def _target(self, name):
+        # Where an entry goes, None if its name would leave the tree
+        try:
+            name = relative(name)
+        except ValueError as e:
+            self._error(name, e)
+            return None
+        if not name:
+            self._error(name, "empty name")
+            return None
+        return os.path.join(self.root, name)
+
+    def _contents(self, piece):
+        self.bytes += len(piece)
+        if self.contents is not None:
+            self.contents += piece
+        elif self.staging is not None:
+            try:
+                self.staging[1].write(piece)
+            except OSError as e:
+                self._error(self.entry[0], e)
+                self._drop_staging()
+
+    def _file_done(self):
+        name, path, mtime_ns, mode = self.entry
+        if self.contents is not None:
+            data, self.contents = bytes(self.contents), None
+            self._submit(len(data), self._store, name, path, data, mtime_ns, mode)
+        elif self.staging is not None:
+            (staging_path, f), self.staging = self.staging, None
+            self._submit(0, self._finish_large, name, path, staging_path, f, mtime_ns, mode)
+        self.entry = None
+
+    def _submit(self, size, job, *args):
+        # Queue a file for the writer threads, waiting while too many bytes
+        # are queued already
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.threads, thread_name_prefix="extract")
+        with self.cond:
+            while self.pending and self.pending + size > MAX_PENDING:
+                self.cond.wait()
+            self.pending += size
+        self.pool.submit(self._run, size, job, *args)
+
+    def _run(self, size, job, name, *args):
+        try:
+            job(name, *args)
+            with self.lock:
+                self.files += 1
+        except Exception as e:
+            self._error(name, e)
+        finally:
+            with self.cond:
+                self.pending -= size
+                self.cond.notify_all()
+
+    def _store(self, name, path, data, mtime_ns, mode):
+        staging_path = self.staging_file(path)
+        try:
+            with open(staging_path, "wb") as f:
+                f.write(data)
+            self._publish(staging_path, path, mtime_ns, mode)
+        finally:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+
+    def _finish_large(self, name, path, staging_path, f, mtime_ns, mode):
+        try:
+            f.close()
+            self._publish(staging_path, path, mtime_ns, mode)
+        finally:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+
+    def _publish(self, staging_path, path, mtime_ns, mode):
+        if self.keep_metadata:
+            # Set on the staging file, so the final name never shows other values
+            os.chmod(staging_path, stat.S_IMODE(mode) or 0o644)
+            os.utime(staging_path, ns=(mtime_ns, mtime_ns))
+        self.publish(staging_path, path)
+
+    def _drop_staging(self):
+        staging_path, f = self.staging
+        self.staging = None
+        f.close()
+        try:
+            os.remove(staging_path)
+        except OSError:
+            pass
+
+    def _error(self, name, reason):
+        with self.lock:
+            self.errors.append(f"{name}: {reason}")
+
+    def finish(self):
+        # Wait for the writer threads and clean up after a stream that broke
+        # off. Safe to call more than once.
+        if self.staging is not None:
+            self._drop_staging()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        if self.keep_metadata:
+            # Innermost folders first, their mtimes changed as files arrived
+            for path, mtime_ns, mode in reversed(self.folders_made):
+                try:
+                    os.utime(path, ns=(mtime_ns, mtime_ns))
+                except OSError:
+                    pass
+            self.folders_made = []
+        if not self.done:
+            self._error("", "archive ended early")
@@ -0,0 +1,76 @@
+import os
+import sys
+import base64
+import time
+import socket
+import tempfile
+import argparse
+import threading
+
+from protocol import FrameSocket, parse_size
+from aead import FrameCipher, ALGORITHMS
+
+# Throughput of file payloads over a local socket pair, plaintext against each
+# AEAD cipher at several chunk sizes. The socket pair takes the network out of
+# the picture, so the numbers show the CPU cost of encryption alone.
+#
+#   python bench_encryption.py [--size 256M] [--chunk-sizes 16K,64K,256K,1M,4M]
+
+KEY_FILE_KEY = base64.urlsafe_b64encode(b"0" * 32)  # Any key will do for a benchmark
+NONCE = b"\0" * 16
+
+
+def run(path, size, cipher_pair=None, zero_copy=False):
+    # Send the file from one end of a socket pair to the other, return MB/s
+    left, right = socket.socketpair()
+    sender, receiver = FrameSocket(left), FrameSocket(right)
+    if cipher_pair:
+        sender.set_cipher(cipher_pair[0])
+        receiver.set_cipher(cipher_pair[1])
+    received = []
+
+    def receive():
+        received.append(receiver.recv_body(lambda data: None))
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        sender.send_file(f, 0, size, zero_copy=zero_copy)
+    thread.join()
+    elapsed = time.perf_counter() - start
+    left.close()
+    right.close()
+    if received != [size]:
+        raise RuntimeError(f"Received {received} of {size} bytes")
+    return size / elapsed / (1024 * 1024)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Encrypted vs plaintext payload throughput")
+    parser.add_argument("--size", type=parse_size, default=parse_size("256M"), help="Bytes per run")
+    parser.add_argument("--chunk-sizes", default="16K,64K,256K,1M,4M", help="Comma-separated chunk sizes")
+    args = parser.parse_args(argv)
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(args.size))
+        path = f.name
+    try:
+        print(f"{args.size} bytes per run")
+        print(f"{'mode':<20}{'chunk':>8}{'MB/s':>10}{'vs plain':>10}")
+        plain = run(path, args.size)
+        print(f"{'plaintext':<20}{'-':>8}{plain:>10.1f}{'1.00':>10}")
+        print(f"{'plaintext sendfile':<20}{'-':>8}{run(path, args.size, zero_copy=True):>10.1f}")
+        for algorithm in ALGORITHMS:
+            for text in args.chunk_sizes.split(","):
+                chunk_size = parse_size(text)
+                pair = (FrameCipher.for_client(algorithm, KEY_FILE_KEY, NONCE, NONCE, chunk_size),
+                        FrameCipher.for_server(algorithm, KEY_FILE_KEY, NONCE, NONCE, chunk_size))
+                rate = run(path, args.size, pair)
+                print(f"{algorithm:<20}{text:>8}{rate:>10.1f}{rate / plain:>10.2f}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,534 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+from cryptography.fernet import Fernet
+from protocol import (AsyncFrameStream, parse_size, pack_fields, unpack_fields,
+                      OP_AUTH, OP_UPLOAD, OP_DOWNLOAD, OP_DIR, OP_DELETE, OP_LOGOUT, OP_OK)
+from aead import FrameCipher, NONCE_SIZE
+from network_stats import LatencyHistogram
+
+# Load test of the whole server. Starts server.py on localhost in a scratch
+# directory, then for every engine, buffer size, number of server worker
+# processes and concurrency level runs that many simulated clients for a
+# fixed time. Each client logs in and then loops over a weighted mix of
+# UPLOAD, DOWNLOAD, DIR and DELETE with files of the given sizes. Clients are asyncio tasks spread over several processes,
+# so the load generator itself isn't held back by one core. Results (ops/s,
+# MB/s, latency percentiles per operation, server CPU and peak RSS) are
+# printed and written as JSON, and --compare checks them against an earlier
+# run and exits with status 1 if anything got slower than --threshold.
+#
+#   python bench_server.py [--engines threaded,asyncio] [--server-workers 1,4] [--concurrency 1,10,100]
+#                          [--sizes 1K,64K,1M,16M] [--duration 10] [--output bench_results.json]
+#                          [--compare old_results.json]
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+USERNAME = "user1"
+PASSWORD = "password1"
+OPERATIONS = ("upload", "download", "dir", "delete")
+DEFAULT_MIX = "upload=2,download=5,dir=2,delete=1"
+CONNECT_TIMEOUT = 30  # Seconds to wait for the server to greet a new connection
+
+
+class BenchError(Exception):
+    # The server refused an operation, the connection itself is still usable
+    pass
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_file_limit():
+    # A thousand clients and the server's end of their sockets don't fit in
+    # the usual soft limit of 1024 descriptors
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and (hard == resource.RLIM_INFINITY or soft < hard):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+
+def start_server(workdir, port, engine, buffer_size, max_connections, encrypt, workers=1):
+    code = (f"import sys; sys.path.insert(0, {REPO!r}); import server; "
+            f"server.IP = '127.0.0.1'; server.PORT = {port}; server.ADDR = (server.IP, server.PORT); "
+            f"server.main(sys.argv[1:])")
+    args = ["--engine", engine, "--buffer-size", str(buffer_size), "--max-connections", str(max_connections)]
+    if not encrypt:
+        args.append("--no-encryption")
+    if workers > 1:
+        args += ["--workers", str(workers)]
+    with open(os.path.join(workdir, "server.log"), "a") as log:
+        process = subprocess.Popen([sys.executable, "-c", code, *args], cwd=workdir,
+                                   stdout=log, stderr=subprocess.STDOUT)
+    for _ in range(100):
+        if process.poll() is not None:
+            break
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"Server did not start, see {os.path.join(workdir, 'server.log')}")
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class ResourceSampler:
+    # CPU time and peak RSS of the server process and its children (the
+    # workers of a multi-process server), read from /proc (Linux). Elsewhere
+    # the numbers are left out.
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.tick = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.peak_rss = 0
+        self.start_cpu = self._cpu()
+        self.start_time = time.monotonic()
+
+    def _pids(self):
+        pids = [self.pid]
+        try:
+            entries = [entry for entry in os.listdir("/proc") if entry.isdigit()]
+        except OSError:
+            return pids
+        for entry in entries:
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == self.pid:  # ppid
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                pass
+        return pids
+
+    def _cpu(self):
+        try:
+            total = 0.0
+            for pid in self._pids():
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total += (int(fields[11]) + int(fields[12])) / self.tick  # utime + stime
+            return total
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def sample(self):
+        rss = 0
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1]) * 1024
+            except OSError:
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def result(self):
+        self.sample()
+        end_cpu = self._cpu()
+        if self.start_cpu is None or end_cpu is None:
+            return {"cpu_s": None, "cpu_percent": None, "peak_rss_mb": None}
+        cpu = end_cpu - self.start_cpu
+        return {
+            "cpu_s": round(cpu, 3),
+            "cpu_percent": round(100 * cpu / (time.monotonic() - self.start_time), 1),
+            "peak_rss_mb": round(self.peak_rss / (1024 * 1024), 1),
+        }
+
+
+async def connect(job, key, fernet):
+    reader, writer = await asyncio.open_connection("127.0.0.1", job["port"], limit=job["buffer_size"])
+    stream = AsyncFrameStream(reader, writer, job["buffer_size"])
+    try:
+        # A connection the server's accept queue dropped looks established
+        # from this side but never gets its banner
+        await asyncio.wait_for(stream.recv_frame(), CONNECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        writer.close()
+        raise ConnectionError("No welcome banner from the server")
+    nonce = os.urandom(NONCE_SIZE)
+    token = fernet.encrypt(PASSWORD.encode()).decode()
+    await stream.send_frame(OP_AUTH, pack_fields(USERNAME, token, "aes-gcm" if job["encrypt"] else "", nonce.hex()))
+    reply = await stream.recv_frame()
+    if reply is None or reply.opcode != OP_OK:
+        writer.close()
+        raise ConnectionError("Login failed")
+    fields = unpack_fields(reply.payload)
+    if len(fields) > 2 and fields[1]:
+        await stream.set_cipher(FrameCipher.for_client(fields[1], key, nonce, bytes.fromhex(fields[2])))
+    return stream, writer
+
+
+async def expect_ok(stream):
+    reply = await stream.recv_frame()
+    if reply is None:
+        raise ConnectionError("Server closed the connection")
+    if reply.opcode != OP_OK:
+        raise BenchError(reply.payload.decode(errors="replace"))
+    return reply
+
+
+async def upload(stream, name, size, source):
+    await stream.send_frame(OP_UPLOAD, pack_fields(name, size))
+    await expect_ok(stream)
+    with open(source, "rb") as f:
+        await stream.send_file(f, 0, size)
+    await expect_ok(stream)
+    return size
+
+
+async def download(stream, name):
+    await stream.send_frame(OP_DOWNLOAD, pack_fields(name))
+    await expect_ok(stream)
+    return await stream.recv_body(lambda data: None)
+
+
+async def list_dir(stream):
+    await stream.send_frame(OP_DIR, pack_fields("", "", ""))
+    reply = await expect_ok(stream)
+    return len(reply.payload)
+
+
+async def delete(stream, name):
+    await stream.send_frame(OP_DELETE, pack_fields(name))
+    await expect_ok(stream)
+    return 0
+
+
+async def client_loop(job, number, key, fernet, histograms, counters, ready, go):
+    # One simulated client: connect and log in, wait for the others, then
+    # run random operations until the time is up
+    rng = random.Random(f"{job['tag']}-{job['worker']}-{number}")
+    operations, weights = zip(*job["mix"].items())
+    uploaded = []  # Names this client uploaded and may delete
+    serial = 0
+    stream = writer = None
+    try:
+        start = time.perf_counter()
+        stream, writer = await connect(job, key, fernet)
+        histograms["connect"].record(time.perf_counter() - start)
+        counters["connect"]["ok"] += 1
+    except (OSError, ConnectionError):
+        counters["connect"]["errors"] += 1
+    ready()
+    await go.wait()
+    deadline = time.monotonic() + job["duration"]
+    while stream is not None and time.monotonic() < deadline:
+        operation = rng.choices(operations, weights)[0]
+        if operation == "delete" and not uploaded:
+            operation = "upload"
+        start = time.perf_counter()
+        try:
+            if operation == "upload":
+                size = rng.choice(job["sizes"])
+                serial += 1
+                name = f"bench-{job['tag']}-{job['worker']}-{number}-{serial}"
+                moved = await upload(stream, name, size, job["source"])
+                uploaded.append(name)
+            elif operation == "download":
+                moved = await download(stream, f"seed-{rng.choice(job['sizes'])}")
+            elif operation == "dir":
+                moved = await list_dir(stream)
+            else:
+                moved = await delete(stream, uploaded.pop(rng.randrange(len(uploaded))))
+        except BenchError:
+            counters[operation]["errors"] += 1
+            continue
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            # The connection is gone, count it and start over on a new one
+            counters[operation]["errors"] += 1
+            writer.close()
+            try:
+                stream, writer = await connect(job, key, fernet)
+            except (OSError, ConnectionError):
+                counters["connect"]["errors"] += 1
+                stream = None
+            continue
+        histograms[operation].record(time.perf_counter() - start)
+        counters[operation]["ok"] += 1
+        counters[operation]["bytes"] += moved
+    if stream is not None:
+        try:
+            await stream.send_frame(OP_LOGOUT)
+            await stream.recv_frame()
+        except (OSError, ConnectionError):
+            pass
+        writer.close()
+
+
+async def worker_main(job):
+    with open(job["key_file"], "rb") as f:
+        key = f.read()
+    fernet = Fernet(key)
+    names = OPERATIONS + ("connect",)
+    histograms = {name: LatencyHistogram() for name in names}
+    counters = {name: {"ok": 0, "errors": 0, "bytes": 0} for name in names}
+    go = asyncio.Event()
+    waiting = [job["clients"]]
+
+    def ready():
+        waiting[0] -= 1
+        if not waiting[0]:
+            go.set()
+
+    cpu = time.process_time()
+    await asyncio.gather(*(client_loop(job, number, key, fernet, histograms, counters, ready, go)
+                           for number in range(job["clients"])))
+    return histograms, counters, time.process_time() - cpu
+
+
+def run_worker(job):
+    raise_file_limit()
+    return asyncio.run(worker_main(job))
+
+
+def seed(workdir, port, sizes, source, buffer_size, key_file):
+    # The files every DOWNLOAD picks from, uploaded once per run
+    async def upload_seeds():
+        with open(key_file, "rb") as f:
+            key = f.read()
+        job = {"port": port, "buffer_size": buffer_size, "encrypt": False}
+        stream, writer = await connect(job, key, Fernet(key))
+        for size in sizes:
+            if not os.path.exists(os.path.join(workdir, "server_storage", f"seed-{size}")):
+                await upload(stream, f"seed-{size}", size, source)
+        writer.close()
+
+    asyncio.run(upload_seeds())
+
+
+def make_source(path, size):
+    # Random (incompressible) bytes the uploads are cut from
+    block = 16 * 1024 * 1024
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            data = os.urandom(min(block, size - written))
+            f.write(data)
+            written += len(data)
+
+
+def run_scenario(args, tag, port, server, engine, buffer_size, workers, concurrency, key_file, source):
+    processes = max(1, min(args.processes, concurrency))
+    jobs = [{
+        "tag": tag, "worker": worker, "port": port, "buffer_size": buffer_size, "encrypt": args.encrypt,
+        "clients": concurrency // processes + (worker < concurrency % processes),
+        "duration": args.duration, "sizes": args.sizes, "mix": args.mix, "source": source, "key_file": key_file,
+    } for worker in range(processes)]
+    sampler = ResourceSampler(server.pid)
+    started = time.monotonic()
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [pool.submit(run_worker, job) for job in jobs]
+        while not all(future.done() for future in futures):
+            sampler.sample()
+            time.sleep(0.25)
+        results = [future.result() for future in futures]
+    elapsed = time.monotonic() - started
+
+    names = OPERATIONS + ("connect",)
+    histograms = {name: LatencyHistogram() for name in names}
+    counters = {name: {"ok": 0, "errors": 0, "bytes": 0} for name in names}
+    client_cpu = 0.0
+    for worker_histograms, worker_counters, cpu in results:
+        for name in names:
+            histograms[name].merge(worker_histograms[name])
+            for field, value in worker_counters[name].items():
+                counters[name][field] += value
+        client_cpu += cpu
+
+    operations = {}
+    for name in names:
+        histogram = histograms[name]
+        if not histogram.count and not counters[name]["errors"]:
+            continue
+        operations[name] = {
+            "count": counters[name]["ok"],
+            "errors": counters[name]["errors"],
+            "ops_per_s": round(counters[name]["ok"] / args.duration, 2) if name != "connect" else None,
+            "mb_per_s": round(counters[name]["bytes"] / args.duration / (1024 * 1024), 2),
+            "p50_ms": round(histogram.percentile(0.5), 3),
+            "p90_ms": round(histogram.percentile(0.9), 3),
+            "p99_ms": round(histogram.percentile(0.99), 3),
+            "p999_ms": round(histogram.percentile(0.999), 3),
+            "max_ms": round(histogram.max / 1000, 3),
+        }
+    transfers = [operations[name] for name in OPERATIONS if name in operations]
+    return {
+        "engine": engine,
+        "buffer_size": buffer_size,
+        "server_workers": workers,
+        "concurrency": concurrency,
+        "processes": processes,
+        "duration_s": args.duration,
+        "wall_s": round(elapsed, 3),
+        "ops_per_s": round(sum(op["ops_per_s"] for op in transfers), 2),
+        "mb_per_s": round(sum(op["mb_per_s"] for op in transfers), 2),
+        "errors": sum(op["errors"] for op in operations.values()),
+        "operations": operations,
+        "server": sampler.result(),
+        "client_cpu_s": round(client_cpu, 3),
+    }
+
+
+def print_scenario(result):
+    server = result["server"]
+    resources = (f", server CPU {server['cpu_percent']}%, peak RSS {server['peak_rss_mb']} MB"
+                 if server["cpu_percent"] is not None else "")
+    workers = result.get("server_workers", 1)
+    processes = f", {workers} server workers" if workers > 1 else ""
+    print(f"\n{result['engine']} engine, {result['buffer_size']} byte buffers{processes}, "
+          f"{result['concurrency']} clients: "
+          f"{result['ops_per_s']} ops/s, {result['mb_per_s']} MB/s, {result['errors']} errors{resources}")
+    print(f"  {'operation':<10}{'count':>9}{'ops/s':>10}{'MB/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+          f"{'p999 ms':>10}{'errors':>8}")
+    for name, op in result["operations"].items():
+        ops = "-" if op["ops_per_s"] is None else op["ops_per_s"]
+        print(f"  {name:<10}{op['count']:>9}{ops:>10}{op['mb_per_s']:>10}{op['p50_ms']:>10}"
+              f"{op['p99_ms']:>10}{op['p999_ms']:>10}{op['errors']:>8}")
+
+
+def scenario_key(result):
+    return result["engine"], result["buffer_size"], result.get("server_workers", 1), result["concurrency"]
+
+
+def compare(results, baseline, threshold):
+    # Print how each operation moved against the baseline run, returns the
+    # number of regressions: throughput down or p99 up by more than threshold
+    previous = {scenario_key(result): result for result in baseline["scenarios"]}
+    regressions = 0
+    print(f"\nCompared with {baseline.get('started', 'the baseline')} (threshold {threshold:.0%}):")
+    for result in results:
+        old = previous.get(scenario_key(result))
+        if old is None:
+            continue
+        for name, op in result["operations"].items():
+            was = old["operations"].get(name)
+            if not was or not was["count"] or op["ops_per_s"] is None:
+                continue
+            throughput = op["ops_per_s"] / was["ops_per_s"] - 1 if was["ops_per_s"] else 0.0
+            latency = op["p99_ms"] / was["p99_ms"] - 1 if was["p99_ms"] else 0.0
+            slower = throughput < -threshold or latency > threshold
+            regressions += slower
+            print(f"  {result['engine']:<9}{result['buffer_size']:>9} w={result.get('server_workers', 1):<3}"
+                  f"c={result['concurrency']:<5}{name:<10}"
+                  f"ops/s {throughput:+7.1%}  p99 {latency:+7.1%}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {name}, expected one of {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the file server")
+    parser.add_argument("--engines", default="threaded,asyncio", help="Comma-separated server engines")
+    parser.add_argument("--buffer-sizes", default="256K", help="Comma-separated server buffer sizes")
+    parser.add_argument("--server-workers", default="1",
+                        help="Comma-separated numbers of server worker processes, e.g. 1,2,4,8")
+    parser.add_argument("--concurrency", default="1,10,100", help="Comma-separated numbers of clients")
+    parser.add_argument("--sizes", default="1K,64K,1M,16M", help="Comma-separated file sizes, e.g. 1K,1M,2G")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"Operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="Client processes the simulated clients are spread over")
+    parser.add_argument("--encrypt", action="store_true", help="Encrypt file payloads with aes-gcm")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier results to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="Percent change that counts as a regression (default 10)")
+    parser.add_argument("--workdir", help="Scratch directory for the server (default: a temporary one)")
+    args = parser.parse_args(argv)
+    args.sizes = [parse_size(size) for size in args.sizes.split(",")]
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    raise_file_limit()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_server_")
+    os.makedirs(workdir, exist_ok=True)
+    key_file = os.path.join(workdir, "key.key")
+    shutil.copy(os.path.join(REPO, "key.key"), key_file)
+    source = os.path.join(workdir, "source.bin")
+    make_source(source, max(args.sizes))
+
+    results = []
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {"sizes": args.sizes, "mix": args.mix, "duration_s": args.duration, "encrypt": args.encrypt},
+        "scenarios": results,
+    }
+    seeded = False
+    try:
+        for engine in args.engines.split(","):
+            for buffer_size, workers in itertools.product([parse_size(size) for size in args.buffer_sizes.split(",")],
+                                                          [int(count) for count in args.server_workers.split(",")]):
+                port = free_port()
+                server = start_server(workdir, port, engine, buffer_size, max(levels) + 16, args.encrypt, workers)
+                try:
+                    if not seeded:
+                        seed(workdir, port, args.sizes, source, buffer_size, key_file)
+                        seeded = True
+                    for concurrency in levels:
+                        tag = len(results)
+                        result = run_scenario(args, tag, port, server, engine, buffer_size, workers, concurrency,
+                                              key_file, source)
+                        results.append(result)
+                        print_scenario(result)
+                        # Drop what this scenario uploaded so the next one starts the same way
+                        storage = os.path.join(workdir, "server_storage")
+                        for name in os.listdir(storage):
+                            if name.startswith(f"bench-{tag}-"):
+                                os.remove(os.path.join(storage, name))
+                finally:
+                    stop_server(server)
+    finally:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold / 100):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
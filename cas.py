@@ -0,0 +1,273 @@
+import os
+import json
+import struct
+import hashlib
+import secrets
+
+try:
+    import numpy as np
+except ImportError:  # Chunking falls back to a pure Python rolling hash
+    np = None
+
+# Content-addressed chunk storage.
+#
+# Files are cut into variable-size chunks at positions chosen by the content
+# itself (content-defined chunking), so inserting or removing bytes only
+# changes the chunks around the edit and identical data in different files
+# produces identical chunks. Each chunk is stored once under its SHA-256, and
+# the user-visible file becomes a small manifest listing its chunks.
+
+# Boundaries: a rolling sum of per-byte random values over the last WINDOW
+# bytes, a chunk ends where its low MASK_BITS bits are zero (about one
+# position in 1 MB), bounded by MIN_CHUNK and MAX_CHUNK.
+WINDOW = 48
+MASK_BITS = 20
+MASK = (1 << MASK_BITS) - 1
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+READ_BLOCK = 16 * 1024 * 1024
+
+# 256 fixed pseudo-random 64-bit values, the same on every machine
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") for i in range(256)]
+U64 = (1 << 64) - 1
+
+MANIFEST_MAGIC = b"CASMANIFEST1\n"
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+# Chunk list on the wire: raw SHA-256 digest and chunk length
+CHUNK_ENTRY = struct.Struct("!32sI")
+INDEX = struct.Struct("!I")
+
+
+def _candidates_numpy(data, base):
+    # Positions (absolute, exclusive end) where the rolling sum matches the mask
+    gear = np.array(GEAR, dtype=np.uint64)
+    values = gear[np.frombuffer(data, dtype=np.uint8)]
+    sums = np.cumsum(values, dtype=np.uint64)  # Wraps mod 2**64 like the Python version
+    rolling = sums.copy()
+    rolling[WINDOW:] -= sums[:-WINDOW]
+    hits = np.flatnonzero((rolling & np.uint64(MASK)) == 0)
+    return (hits + base + 1).tolist()
+
+
+def _candidates_python(data, base):
+    hits = []
+    total = 0
+    for i, byte in enumerate(data):
+        total = (total + GEAR[byte]) & U64
+        if i >= WINDOW:
+            total = (total - GEAR[data[i - WINDOW]]) & U64
+        if (total & MASK) == 0:
+            hits.append(base + i + 1)
+    return hits
+
+
+def chunk_file(path):
+    # Yield (offset, length, sha256 digest bytes) for every chunk of the file
+    find = _candidates_numpy if np is not None else _candidates_python
+    start = 0
+    position = 0  # Absolute offset of the end of the data read so far
+    tail = b""  # Last WINDOW bytes before the current block
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(READ_BLOCK)
+            if not block:
+                break
+            # The bytes carried over from the previous block only complete
+            # the window, they are not candidates themselves
+            data = tail + block
+            ends = find(data, position - len(tail))
+            ends = [end for end in ends if end > position and end >= WINDOW]
+            consumed = 0  # How much of block has gone into digest
+            for end in ends + [None]:
+                if end is None:
+                    limit = position + len(block)
+                    # No boundary in sight: cut at MAX_CHUNK
+                    while limit - start > MAX_CHUNK:
+                        cut = start + MAX_CHUNK
+                        digest.update(block[consumed:cut - position])
+                        consumed = cut - position
+                        yield start, cut - start, digest.digest()
+                        digest = hashlib.sha256()
+                        start = cut
+                    break
+                while end - start > MAX_CHUNK:
+                    cut = start + MAX_CHUNK
+                    digest.update(block[consumed:cut - position])
+                    consumed = cut - position
+                    yield start, cut - start, digest.digest()
+                    digest = hashlib.sha256()
+                    start = cut
+                if end - start >= MIN_CHUNK:
+                    digest.update(block[consumed:end - position])
+                    consumed = end - position
+                    yield start, end - start, digest.digest()
+                    digest = hashlib.sha256()
+                    start = end
+            digest.update(block[consumed:])
+            position += len(block)
+            tail = data[-WINDOW:]
+    if position > start or position == 0:
+        yield start, position - start, digest.digest()
+
+
+def pack_chunk_list(chunks):
+    return b"".join(CHUNK_ENTRY.pack(digest, length) for digest, length in chunks)
+
+
+def unpack_chunk_list(data):
+    return [(digest.hex(), length) for digest, length in CHUNK_ENTRY.iter_unpack(data)]
+
+
+def pack_indexes(indexes):
+    return b"".join(INDEX.pack(index) for index in indexes)
+
+
+def unpack_indexes(data):
+    return [index for (index,) in INDEX.iter_unpack(data)]
+
+
+def is_digest(digest):
+    # A chunk name: 64 lowercase hex digits, nothing that could form a path
+    return isinstance(digest, str) and len(digest) == 64 and HEX_DIGITS.issuperset(digest)
+
+
+def is_manifest(path):
+    # Whether the file starts like a manifest. User files must not, or they
+    # would be read as one (see server.publish_upload()).
+    with open(path, "rb") as f:
+        return f.read(len(MANIFEST_MAGIC)) == MANIFEST_MAGIC
+
+
+def read_manifest(path):
+    # (size, [(hex digest, length), ...]) if path is a manifest, else None.
+    # Raises ValueError for a manifest whose chunk list doesn't check out.
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+                return None
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        size = manifest["size"]
+        chunks = [(digest, length) for digest, length in manifest["chunks"]]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(f"Corrupt manifest {path}")
+    if (type(size) is not int or any(not is_digest(digest) or type(length) is not int or length < 0
+                                     for digest, length in chunks)
+            or sum(length for digest, length in chunks) != size):
+        raise ValueError(f"Corrupt manifest {path}")
+    return size, chunks
+
+
+def write_manifest(path, size, chunks):
+    # The caller publishes the file, so it replaces the old version atomically
+    with open(path, "wb") as f:
+        f.write(MANIFEST_MAGIC)
+        f.write(json.dumps({"size": size, "chunks": chunks}).encode("utf-8"))
+
+
+def stored_size(path):
+    # Size of a file as the user sees it, manifests count as their contents
+    try:
+        manifest = read_manifest(path)
+    except ValueError:
+        manifest = None  # Corrupt, listed as it is stored
+    return manifest[0] if manifest else os.path.getsize(path)
+
+
+class ChunkStore:
+    # Chunks on disk as objects/<first two hex digits>/<sha256>
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.tmp = os.path.join(root, "tmp")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.tmp, exist_ok=True)
+
+    def object_path(self, digest):
+        if not is_digest(digest):
+            raise ValueError(f"Invalid chunk digest {digest!r}")
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    def missing(self, chunks):
+        # Indexes of the chunks (hex digest, length) the store doesn't hold yet
+        return [index for index, (digest, length) in enumerate(chunks) if not self.has(digest)]
+
+    def writer(self):
+        # (write, finish, discard) for storing one chunk. finish(expected_digest)
+        # keeps the chunk only if its content hashes to the expected digest.
+        tmp_path = os.path.join(self.tmp, secrets.token_hex(8))
+        f = open(tmp_path, "wb")
+        digest = hashlib.sha256()
+
+        def write(data):
+            digest.update(data)
+            f.write(data)
+
+        def finish(expected):
+            f.close()
+            if digest.hexdigest() != expected:
+                os.remove(tmp_path)
+                return False
+            path = self.object_path(expected)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+            return True
+
+        def discard():
+            f.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        return write, finish, discard
+
+    def pieces(self, chunks, offset, count):
+        # (object path, offset in chunk, count) covering [offset, offset + count)
+        # of the file the chunks make up
+        position = 0
+        end = offset + count
+        for digest, length in chunks:
+            chunk_end = position + length
+            if chunk_end > offset and position < end:
+                start = max(offset, position)
+                yield self.object_path(digest), start - position, min(end, chunk_end) - start
+            position = chunk_end
+            if position >= end:
+                break
+
+    def sha256_range(self, chunks, offset, count):
+        digest = hashlib.sha256()
+        for path, start, length in self.pieces(chunks, offset, count):
+            with open(path, "rb") as f:
+                f.seek(start)
+                digest.update(f.read(length))
+        return digest.hexdigest()
+
+    def collect_garbage(self, storage_root):
+        # Remove chunks no manifest under storage_root refers to any more.
+        # Only safe while no upload is in progress, i.e. at startup.
+        live = set()
+        for folder, dirs, files in os.walk(storage_root):
+            for name in files:
+                try:
+                    manifest = read_manifest(os.path.join(folder, name))
+                except ValueError:
+                    continue
+                if manifest:
+                    live.update(digest for digest, length in manifest[1])
+        removed = 0
+        for folder, dirs, files in os.walk(self.objects):
+            for name in files:
+                if name not in live:
+                    os.remove(os.path.join(folder, name))
+                    removed += 1
+        for name in os.listdir(self.tmp):
+            os.remove(os.path.join(self.tmp, name))
+        return removed
@@ -1,71 +1,528 @@
 import os
 import socket
+import threading
 import time
-from cryptography.fernet import Fernet
+from protocol import (FrameSocket, tune_socket, parse_size, pack_fields, unpack_fields, etag, OP_AUTH,
+                      OP_LOGOUT, OP_DOWNLOAD, OP_DIR, OP_CREATE, OP_DELETE, OP_CONFIRM,
+                      OP_UPLOAD_OPEN, OP_UPLOAD_RANGE, OP_CHECKSUM, OP_DEDUP_OPEN, OP_CHUNK_PUT,
+                      OP_DEDUP_COMMIT, OP_SYNC, OP_STAT, OP_BATCH, OP_TREE_UPLOAD, OP_TREE_DOWNLOAD,
+                      OP_TREE_DELETE, OP_OK, OP_ERROR, OP_EXISTS, CAP_DEDUP)
+from transfers import preallocate, range_writer, split_ranges, sha256_range
+from compression import Compressor, Decompressor, available
+
+# cryptography, cas.py (which may load numpy), delta.py and archive.py are
+# imported by the commands that use them, like clientlib does, so the prompt
+# comes up without waiting for them.
 
 # Server connection details
-IP = "10.200.232.146"  # Change to server IPv4
-PORT = 49157
+IP = os.environ.get("FILE_SERVER_HOST", "10.200.232.146")  # Change to server IPv4 or set FILE_SERVER_HOST
+PORT = int(os.environ.get("FILE_SERVER_PORT", 49157))
 ADDR = (IP, PORT)
 SIZE = 1024  # Buffer size
+BUFFER_SIZE = 256 * 1024  # Transfer buffer for file contents
 FORMAT = "utf-8"
 CLIENT_STORAGE = "client_storage"  # Local directory for client files
-
-# Ensure the client storage directory exists
-if not os.path.exists(CLIENT_STORAGE):
-    os.makedirs(CLIENT_STORAGE)
+STREAMS = 4  # Parallel connections used by PUPLOAD/PDOWNLOAD
+CHUNK_SIZE = 8 * 1024 * 1024  # Byte range a stream moves per request, also the resume granularity
+COMPRESSION = available()  # Codecs offered for each transfer, in order of preference ("" for none)
+ENCRYPTION = "aes-gcm,chacha20-poly1305"  # Payload ciphers asked for at login ("" to send plaintext)
+ENCRYPT_CHUNK_SIZE = None  # Bytes per sealed DATA frame we send, None for aead.DEFAULT_CHUNK_SIZE
+PIPELINE_WINDOW = 256  # Requests RUN keeps in flight before waiting for a reply
 
 def load_key():
     # Load the key from the file
     with open("key.key", "rb") as key_file:
         return key_file.read()
 
-def authenticate(client, username, password):
+def encrypt_password(password):
+    from cryptography.fernet import Fernet
     key = load_key()
     fernet = Fernet(key)
-
-    # Encrypt the password
-    encrypted_password = fernet.encrypt(password.encode())
-
+    return fernet.encrypt(password.encode()).decode()
+
+def login(conn, username, password):
+    # Send the credentials and, if the server agrees to encrypt payloads,
+    # switch the connection to the negotiated cipher. Returns the reply.
+    import aead
+    client_nonce = os.urandom(aead.NONCE_SIZE)
+    conn.send_frame(OP_AUTH, pack_fields(username, encrypt_password(password), ENCRYPTION, client_nonce.hex()))
+    response = conn.recv_frame()
+    if response is not None and response.opcode == OP_OK:
+        fields = unpack_fields(response.payload)
+        if len(fields) > 2 and fields[1]:
+            algorithm, server_nonce = fields[1], bytes.fromhex(fields[2])
+            conn.set_cipher(aead.FrameCipher.for_client(algorithm, load_key(), client_nonce, server_nonce,
+                                                        ENCRYPT_CHUNK_SIZE or aead.DEFAULT_CHUNK_SIZE))
+    return response
+
+
+def authenticate(conn, username, password):
     # Send the username and encrypted password to the server
-    client.send(f"AUTH@{username}@{encrypted_password.decode()}".encode(FORMAT))
-    response = client.recv(SIZE).decode(FORMAT)
-    cmd, msg = response.split("@", 1)
-    if cmd == "OK":
+    response = login(conn, username, password)
+    msg = unpack_fields(response.payload)[0]
+    if response.opcode == OP_OK:
         print(f"[SUCCESS] {msg}")
+        if conn.cipher is not None:
+            print(f"[SECURE] File payloads are encrypted with {conn.cipher.algorithm}.")
         return True
     else:
         print(f"[ERROR] {msg}")
         return False
 
 
+def open_stream(username, password):
+    # Extra authenticated connection for one stream of a parallel transfer
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tune_socket(client, BUFFER_SIZE)
+    client.connect(ADDR)
+    conn = FrameSocket(client, BUFFER_SIZE)
+    conn.recv_frame()  # Welcome banner
+    response = login(conn, username, password)
+    if response is None or response.opcode != OP_OK:
+        client.close()
+        raise ConnectionError("Stream authentication failed")
+    return conn
+
+
+def run_streams(username, password, ranges, streams, move_range, primary=None):
+    # Spread byte ranges over `streams` connections. move_range(conn, stream,
+    # offset, count) transfers one range and returns the bytes it moved.
+    # Stream 0 runs on `primary` when given, the others open their own
+    # connections. Prints per-stream throughput and returns the errors that
+    # occurred.
+    pending = list(reversed(ranges))
+    lock = threading.Lock()
+    results = {}
+    errors = []
+
+    def worker(stream):
+        moved = 0
+        start = time.perf_counter()
+        own_connection = primary is None or stream > 0
+        try:
+            conn = open_stream(username, password) if own_connection else primary
+        except Exception as e:
+            errors.append(e)
+            return
+        try:
+            while True:
+                with lock:
+                    if not pending or errors:
+                        break
+                    offset, count = pending.pop()
+                moved += move_range(conn, stream, offset, count)
+            if own_connection:
+                conn.send_frame(OP_LOGOUT)
+                conn.recv_frame()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if own_connection:
+                conn.sock.close()
+            results[stream] = (moved, time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker, args=(stream,))
+               for stream in range(min(streams, len(ranges)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(results) > 1:
+        for stream, (moved, elapsed) in sorted(results.items()):
+            rate = moved / elapsed / (1024 * 1024) if elapsed > 0 else 0.0
+            print(f"  stream {stream}: {moved} bytes in {elapsed:.2f} s ({rate:.2f} MB/s)")
+    return errors
+
+
+def answer_overwrite(conn, response, request_id):
+    # If the server asks whether to overwrite, prompt the user and return the
+    # server's answer to that decision
+    if response.opcode != OP_EXISTS:
+        return response
+    # Server asks if we want to overwrite
+    print(response.payload.decode(FORMAT))
+    overwrite = input("Do you want to overwrite? (yes/no): ").strip().lower()
+
+    # Send overwrite decision to server
+    conn.send_frame(OP_CONFIRM, overwrite, request_id=request_id)
+    return conn.recv_frame()
+
+
+def upload_file(conn, username, password, filepath, streams, chunk_size, request_id):
+    # Chunked, resumable upload. Each chunk is sent with its SHA-256 and only
+    # kept by the server if it matches. If the server already holds some
+    # chunks from an interrupted attempt, only the missing ones are sent.
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath)
+    print(f"Uploading file: {filename}, Size: {filesize} bytes")
+
+    conn.send_frame(OP_UPLOAD_OPEN, pack_fields(filename, filesize, chunk_size, COMPRESSION), request_id=request_id)
+    response = answer_overwrite(conn, conn.recv_frame(), request_id)
+    if response.opcode == OP_ERROR:
+        print(response.payload.decode(FORMAT))
+        return
+    fields = unpack_fields(response.payload)
+    transfer_id, chunk_size, done = fields[:3]
+    codec = fields[3] if len(fields) > 3 else ""  # Codec the server agreed to, if any
+    compressors = []
+    chunk_size = int(chunk_size)
+    done = {int(index) for index in done.split(",") if index}
+    ranges = [(offset, count) for offset, count in split_ranges(filesize, chunk_size)
+              if count and offset // chunk_size not in done]
+    if done:
+        print(f"Resuming upload: {len(done)} chunks already on the server, {len(ranges)} to send")
+
+    def move_range(stream_conn, stream, offset, count):
+        digest = sha256_range(filepath, offset, count)
+        stream_conn.send_frame(OP_UPLOAD_RANGE, pack_fields(transfer_id, offset // chunk_size, digest, stream, codec),
+                               request_id=request_id)
+        compressor = Compressor(codec) if codec else None
+        with open(filepath, "rb") as f:
+            stream_conn.send_file(f, offset, count, request_id=request_id, compressor=compressor)
+        if compressor:
+            compressors.append(compressor)
+        response = stream_conn.recv_frame()
+        if response.opcode != OP_OK:
+            raise ConnectionError(response.payload.decode(FORMAT))
+        return count
+
+    startU = time.perf_counter()
+    errors = []
+    if ranges:
+        errors = run_streams(username, password, ranges, streams, move_range, primary=conn)
+    endU = time.perf_counter()
+
+    if errors:
+        print(f"[ERROR] Upload failed: {errors[0]}. Run the upload again to resume it.")
+    else:
+        print(f"[SUCCESS] File {filename} uploaded successfully.")
+    print_compression(codec, compressors)
+    print(f"The time to upload was {endU - startU:.2f} s")
+
+
+def dedup_upload(conn, filepath, request_id):
+    # Upload to a deduplicating server: send the file's chunk list, then only
+    # the chunks the server doesn't already hold (from this or any other file)
+    from cas import chunk_file, pack_chunk_list, unpack_indexes, INDEX
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath)
+    print(f"Uploading file: {filename}, Size: {filesize} bytes")
+
+    startU = time.perf_counter()
+    chunks = list(chunk_file(filepath))
+    conn.send_frame(OP_DEDUP_OPEN, pack_fields(filename, filesize, len(chunks)), request_id=request_id)
+    conn.send_bytes(pack_chunk_list((digest, length) for offset, length, digest in chunks), request_id=request_id)
+    response = answer_overwrite(conn, conn.recv_frame(), request_id)
+    if response.opcode == OP_ERROR:
+        print(response.payload.decode(FORMAT))
+        return
+    missing = unpack_indexes(conn.recv_bytes(len(chunks) * INDEX.size))
+    print(f"Sending {len(missing)} of {len(chunks)} chunks ({len(chunks) - len(missing)} already on the server)")
+
+    # Chunks are streamed back to back, the server only answers the commit
+    with open(filepath, "rb") as f:
+        for index in missing:
+            offset, length, digest = chunks[index]
+            conn.send_frame(OP_CHUNK_PUT, pack_fields(index), request_id=request_id)
+            conn.send_file(f, offset, length, request_id=request_id)
+    conn.send_frame(OP_DEDUP_COMMIT, request_id=request_id)
+    print_reply(conn.recv_frame())
+    endU = time.perf_counter()
+    print(f"The time to upload was {endU - startU:.2f} s")
+
+
+def sync_file(conn, filepath, request_id):
+    # Re-upload a file the server already has a version of: the server sends
+    # block signatures of its copy and only the differences go back
+    from delta import compute_delta, unpack_signatures, SIGNATURE
+    filename = os.path.basename(filepath)
+    filesize = os.path.getsize(filepath)
+    print(f"Syncing file: {filename}, Size: {filesize} bytes")
+
+    startS = time.perf_counter()
+    conn.send_frame(OP_SYNC, pack_fields(filename, filesize), request_id=request_id)
+    response = conn.recv_frame()
+    if response.opcode == OP_ERROR:
+        print(response.payload.decode(FORMAT))
+        return
+    block_size, block_total = (int(field) for field in unpack_fields(response.payload))
+    signature_list = unpack_signatures(conn.recv_bytes(block_total * SIGNATURE.size))
+
+    stats = {}
+    for piece in compute_delta(filepath, block_size, signature_list, stats):
+        conn.send_bytes(piece, request_id=request_id, end=False)
+    conn.send_bytes(b"", request_id=request_id)
+    print_reply(conn.recv_frame())
+    endS = time.perf_counter()
+    print(f"{stats['literal']} bytes sent as data, {stats['matched']} bytes matched the server's copy")
+    print(f"The time to sync was {endS - startS:.2f} s")
+
+
+def resume_offset(conn, filename, part_path, request_id):
+    # Where to continue a partial download. The tail of the partial copy is
+    # checked against the server so a file that changed since is started over.
+    if not os.path.exists(part_path):
+        return 0
+    offset = os.path.getsize(part_path)
+    tail = min(offset, CHUNK_SIZE)
+    if tail == 0:
+        return 0
+    conn.send_frame(OP_CHECKSUM, pack_fields(filename, offset - tail, tail), request_id=request_id)
+    response = conn.recv_frame()
+    if response.opcode == OP_OK and response.payload.decode(FORMAT) == sha256_range(part_path, offset - tail, tail):
+        return offset
+    return 0
+
+
+def local_etag(filepath):
+    # ETag of our copy of a file, the server's ETag for it if the copy is a
+    # complete download (see keep_version) that hasn't been touched since
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return ""
+    return etag(st.st_size, st.st_mtime_ns)
+
+
+def up_to_date(fields):
+    # Whether a DOWNLOAD reply says our copy is current, there is no body then
+    return len(fields) > 7 and fields[7] == "unchanged"
+
+
+def keep_version(filepath, fields):
+    # Give a finished download the server's mtime, which makes local_etag()
+    # match until either copy changes
+    if len(fields) > 6 and fields[6]:
+        mtime_ns = int(fields[6])
+        os.utime(filepath, ns=(mtime_ns, mtime_ns))
+
+
+def parallel_download(conn, username, password, filename, streams, chunk_size, request_id):
+    # Ranges of one file over several connections, see run_streams()
+    # Ask for an empty range first to learn the file size
+    filepath = os.path.join(CLIENT_STORAGE, filename)
+    conn.send_frame(OP_DOWNLOAD, pack_fields(filename, 0, 0, "", local_etag(filepath)), request_id=request_id)
+    response = conn.recv_frame()
+    if response.opcode == OP_ERROR:
+        print(response.payload.decode(FORMAT))
+        return
+    version = unpack_fields(response.payload)
+    if up_to_date(version):
+        print(f"{filename} is already up to date.")
+        return
+    filesize = int(version[1])
+    conn.recv_body(lambda data: None)
+    print(f"Downloading file: {filename} ({filesize} bytes) over {streams} streams")
+
+    # Ranges land in a preallocated .part file that replaces the local copy
+    # only once all of them have arrived
+    part_path = filepath + ".part"
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    preallocate(fd, filesize)
+
+    decompressors = []
+
+    def move_range(stream_conn, stream, offset, count):
+        stream_conn.send_frame(OP_DOWNLOAD, pack_fields(filename, offset, count, COMPRESSION))
+        response = stream_conn.recv_frame()
+        if response.opcode != OP_OK:
+            raise ConnectionError(response.payload.decode(FORMAT))
+        fields = unpack_fields(response.payload)
+        decompressor = Decompressor(fields[4]) if len(fields) > 4 and fields[4] else None
+        if decompressor:
+            decompressors.append(decompressor)
+        return stream_conn.recv_body(range_writer(fd, offset, offset + count), decompressor)
+
+    startD = time.perf_counter()
+    try:
+        errors = run_streams(username, password, split_ranges(filesize, chunk_size), streams, move_range)
+    finally:
+        os.close(fd)
+    endD = time.perf_counter()
+
+    if errors:
+        os.remove(part_path)
+        print(f"[ERROR] Download failed: {errors[0]}")
+        return
+    os.replace(part_path, filepath)
+    keep_version(filepath, version)
+    print(f"[DOWNLOAD COMPLETE] File {filename} downloaded successfully.")
+    print_compression(decompressors[0].codec if decompressors else "", decompressors)
+    print(f"The time to download was {endD - startD:.2f} s")
+
+
+def pipeline(conn, requests, first_id, window=PIPELINE_WINDOW):
+    # Send (opcode, payload) requests back to back without waiting for each
+    # reply, numbered from first_id, and return the replies in request order.
+    # Replies are matched by request id. At most `window` requests are in
+    # flight so neither side's socket buffer can fill up while the other
+    # isn't reading.
+    replies = [None] * len(requests)
+    pending = {}
+    sent = 0
+    while sent < len(requests) or pending:
+        if sent < len(requests) and len(pending) < window:
+            opcode, payload = requests[sent]
+            conn.send_frame(opcode, payload, request_id=first_id + sent)
+            pending[first_id + sent] = sent
+            sent += 1
+            continue
+        response = conn.recv_frame()
+        if response is None:
+            raise ConnectionError("Server closed the connection")
+        index = pending.pop(response.request_id, None)
+        if index is None:
+            raise ConnectionError(f"Reply to unknown request {response.request_id}")
+        replies[index] = response
+    return replies
+
+
+def read_command_list(source):
+    # Commands from a file, or from stdin up to a line END (or EOF) for "-".
+    # Blank lines and lines starting with # are skipped.
+    lines = []
+    if source == "-":
+        while True:
+            try:
+                line = input()
+            except EOFError:
+                break
+            if line.strip().upper() == "END":
+                break
+            lines.append(line)
+    else:
+        with open(source) as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+
+def command_request(line):
+    # (opcode, payload) of a command that can be pipelined, None otherwise
+    cmd, _, argument = line.partition(" ")
+    opcode = {"CREATE": OP_CREATE, "DELETE": OP_DELETE, "STAT": OP_STAT, "DIR": OP_DIR}.get(cmd.upper())
+    if opcode is None or (opcode != OP_DIR and not argument.strip()):
+        return None
+    return opcode, pack_fields(argument.strip())
+
+
+def print_compression(codec, counters):
+    # Wire vs file bytes of a compressed transfer, counters are the
+    # Compressor/Decompressor objects of its ranges
+    logical = sum(counter.logical for counter in counters)
+    wire = sum(counter.wire for counter in counters)
+    if codec and logical:
+        print(f"{codec}: {wire} bytes on the wire for {logical} bytes of file ({logical / max(wire, 1):.1f}x)")
+
+
+def upload_tree(conn, folder, name, request_id):
+    # Send a local folder and everything in it as one archive stream, see
+    # archive.py. Files are read as the stream goes out, nothing is staged.
+    import archive
+    conn.send_frame(OP_TREE_UPLOAD, pack_fields(name, COMPRESSION), request_id=request_id)
+    response = conn.recv_frame()
+    if response.opcode != OP_OK:
+        print(f"[ERROR] {response.payload.decode(FORMAT)}")
+        return
+    fields = unpack_fields(response.payload)
+    codec = fields[1] if len(fields) > 1 else ""
+    compressor = Compressor(codec) if codec else None
+
+    startT = time.perf_counter()
+    for piece, last in archive.pack(folder):
+        if isinstance(piece, tuple):
+            f, size = piece
+            conn.send_file(f, 0, size, request_id=request_id, end=False, compressor=compressor)
+        else:
+            conn.send_buffer(piece, request_id=request_id, end=last, compressor=compressor)
+    response = conn.recv_frame()
+    endT = time.perf_counter()
+    if response.opcode != OP_OK:
+        print(f"[ERROR] {response.payload.decode(FORMAT)}")
+        return
+    files, folders, size = unpack_fields(response.payload)
+    print(f"[UPLOAD COMPLETE] Folder {folder} stored as {name}: {files} files, {folders} folders, {size} bytes.")
+    if compressor:
+        print_compression(codec, [compressor])
+    print(f"The time to upload was {endT - startT:.2f} s")
+
+
+def download_tree(conn, name, folder, request_id):
+    # Fetch a server folder into a local one, unpacking the archive as it
+    # arrives. Files keep the server's mtimes and permission bits.
+    import archive
+    conn.send_frame(OP_TREE_DOWNLOAD, pack_fields(name, COMPRESSION), request_id=request_id)
+    response = conn.recv_frame()
+    if response.opcode != OP_OK:
+        print(f"[ERROR] {response.payload.decode(FORMAT)}")
+        return
+    fields = unpack_fields(response.payload)
+    codec = fields[1] if len(fields) > 1 else ""
+    decompressor = Decompressor(codec) if codec else None
+
+    startT = time.perf_counter()
+    os.makedirs(folder, exist_ok=True)
+    extractor = archive.Extractor(folder, keep_metadata=True)
+    try:
+        conn.recv_body(extractor.write, decompressor)
+    finally:
+        extractor.finish()
+    endT = time.perf_counter()
+    for error in extractor.errors:
+        print(f"[ERROR] Not stored: {error}")
+    print(f"[DOWNLOAD COMPLETE] Folder {name} saved to {folder}: {extractor.files} files, "
+          f"{extractor.folders} folders, {extractor.bytes} bytes.")
+    if decompressor:
+        print_compression(codec, [decompressor])
+    print(f"The time to download was {endT - startT:.2f} s")
+
+
+def print_reply(response):
+    msg = response.payload.decode(FORMAT)
+    if response.opcode == OP_OK:
+        print(f"[SUCCESS] {msg}")
+    elif response.opcode == OP_ERROR:
+        print(f"[ERROR] {msg}")
+    else:
+        print("[ERROR] Unexpected response from the server.")
+
 
 def main():
+    global COMPRESSION
+    # Ensure the client storage directory exists
+    os.makedirs(CLIENT_STORAGE, exist_ok=True)
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tune_socket(client, BUFFER_SIZE)
     client.connect(ADDR)
+    conn = FrameSocket(client, BUFFER_SIZE)
     print("[CONNECTED] Connected to the server.")
     
-    response = client.recv(SIZE).decode(FORMAT)
-    print(response)
+    response = conn.recv_frame()
+    welcome = unpack_fields(response.payload)
+    print(welcome[0])
+    capabilities = set(welcome[1:])  # Optional features the server has turned on
     # Authentication loop
     while True:
         username = input("Enter username: ").strip()
         password = input("Enter password: ").strip()
 
-        if authenticate(client, username, password):
+        if authenticate(conn, username, password):
             break
         else:
             print("[ERROR] Authentication failed. Try again.")
 
+    request_id = 0
+
     # Command loop
     while True:        
         # Input 
         data = input("> ").strip()
         command = data.split(" ")
         cmd = command[0].upper()
+        request_id += 1
 
         if cmd == "LOGOUT":
-            client.send(cmd.encode(FORMAT))
+            conn.send_frame(OP_LOGOUT, request_id=request_id)
             print("[DISCONNECTED] Logged out from the server.")
             break
         
@@ -79,104 +536,229 @@ def main():
                 print("[ERROR] File does not exist.")
                 continue
 
-            filename = os.path.basename(filepath)
-            filesize = os.path.getsize(filepath)
-
-            print(f"Uploading file: {filename}, Size: {filesize} bytes")
-
-            # Send the command to the server with file details
-            client.send(f"{cmd}@{filename}@{filesize}".encode(FORMAT))
+            if CAP_DEDUP in capabilities:
+                # Only the chunks the server doesn't have, see dedup_upload()
+                dedup_upload(conn, filepath, request_id)
+            else:
+                # Chunked and resumable, see upload_file()
+                upload_file(conn, username, password, filepath, 1, CHUNK_SIZE, request_id)
 
-            # Wait for server response
-            response = client.recv(SIZE).decode(FORMAT)
-            if response.startswith("ERROR@File"):
-                # Server asks if we want to overwrite
-                print(response.split("@", 1)[1])
-                overwrite = input("Do you want to overwrite? (yes/no): ").strip().lower()
+        elif cmd == "SYNC":
+            # Like UPLOAD but only sends what changed since the server's copy
+            if len(command) < 2:
+                print("[ERROR] Specify the file path to sync.")
+                continue
 
-                # Send overwrite decision to server
-                client.send(overwrite.encode(FORMAT))
-                response = client.recv(SIZE).decode(FORMAT)
+            filepath = command[1]
+            if not os.path.exists(filepath):
+                print("[ERROR] File does not exist.")
+                continue
 
-                # Handle response to overwrite decision
-                if response.startswith("ERROR@"):
-                    print(response.split("@", 1)[1])
-                    continue  # Ensure client returns to main loop for new commands
+            if CAP_DEDUP in capabilities:
+                # Deduplicated uploads already skip unchanged chunks
+                dedup_upload(conn, filepath, request_id)
+            else:
+                sync_file(conn, filepath, request_id)
 
-            elif response.startswith("ERROR@"):
-                print(response.split("@", 1)[1])
+        elif cmd == "COMPRESS":
+            # COMPRESS <codec[,codec...]> | off: what later transfers offer
+            if len(command) < 2:
+                print(f"Offering: {COMPRESSION or 'off'} (available: {available()})")
                 continue
+            COMPRESSION = "" if command[1].lower() == "off" else command[1].lower()
+            print(f"Transfers will offer: {COMPRESSION or 'no compression'}")
 
-            startU = time.perf_counter()
-            # Proceed to upload the file
-            with open(filepath, "rb") as f:
-                chunk = f.read(SIZE)
-                while chunk:
-                    client.send(chunk)
-                    chunk = f.read(SIZE)
-
-            endU = time.perf_counter()
+        elif cmd in ("PUPLOAD", "PDOWNLOAD"):
+            # Parallel transfer: PUPLOAD <path> / PDOWNLOAD <name> [streams] [chunk_size]
+            if len(command) < 2:
+                print("[ERROR] Specify the file to transfer.")
+                continue
+            streams = int(command[2]) if len(command) > 2 else STREAMS
+            chunk_size = parse_size(command[3]) if len(command) > 3 else CHUNK_SIZE
+
+            if cmd == "PUPLOAD":
+                if not os.path.exists(command[1]):
+                    print("[ERROR] File does not exist.")
+                    continue
+                upload_file(conn, username, password, command[1], streams, chunk_size, request_id)
+            else:
+                parallel_download(conn, username, password, command[1], streams, chunk_size, request_id)
 
-            # Wait for server confirmation
-            response = client.recv(SIZE).decode(FORMAT)
-            cmd, msg = response.split("@", 1)
-            if cmd == "OK":
-                print(f"[SUCCESS] {msg}")
-            elif cmd == "ERROR":
-                print(f"[ERROR] {msg}")
+        elif cmd in ("RUPLOAD", "RDOWNLOAD", "RDELETE"):
+            # Whole folders: RUPLOAD <local folder> [name] / RDOWNLOAD <name> [local folder] / RDELETE <name>
+            if len(command) < 2:
+                print("[ERROR] Specify the folder.")
+                continue
 
-            print(f"The time to upload was {endU - startU:.2f} s")
+            if cmd == "RUPLOAD":
+                folder = command[1]
+                if not os.path.isdir(folder):
+                    print("[ERROR] Folder does not exist.")
+                    continue
+                name = command[2] if len(command) > 2 else os.path.basename(os.path.normpath(folder))
+                upload_tree(conn, folder, name, request_id)
+            elif cmd == "RDOWNLOAD":
+                name = command[1]
+                folder = command[2] if len(command) > 2 else os.path.join(CLIENT_STORAGE, name)
+                download_tree(conn, name, folder, request_id)
+            else:
+                conn.send_frame(OP_TREE_DELETE, pack_fields(command[1]), request_id=request_id)
+                print_reply(conn.recv_frame())
 
         elif cmd == "DIR":
-            # Send the command to the server
-            client.send(cmd.encode(FORMAT))
-
-            # Receive and process the server's response
-            response = client.recv(SIZE).decode(FORMAT)
-            cmd, msg = response.split("@", 1)
-            if cmd == "OK":
-                print("Files on server:")
-                print(msg)
+            # DIR [folder]: list a folder page by page, each page as it arrives
+            folder = " ".join(command[1:])
+            cursor = ""
+            count = 0
+            while True:
+                conn.send_frame(OP_DIR, pack_fields(folder, cursor), request_id=request_id)
+                response = conn.recv_frame()
+                fields = unpack_fields(response.payload)
+                if response.opcode != OP_OK:
+                    print(f"[ERROR] {fields[0]}")
+                    break
+                if count == 0 and len(fields) > 1:
+                    print("Files on server:")
+                for i in range(1, len(fields), 4):
+                    name, kind, size, mtime = fields[i:i + 4]
+                    modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(int(mtime) / 1e9))
+                    print(f"{int(size):>12}  {modified}  {name}{'/' if kind == 'dir' else ''}")
+                    count += 1
+                cursor = fields[0]
+                if not cursor:
+                    if count == 0:
+                        print("No files found on the server.")
+                    break
+
+        elif cmd == "STAT":
+            # STAT <name>: type, size and modification time of a path
+            if len(command) < 2:
+                print("[ERROR] Specify the file or folder name.")
+                continue
+            conn.send_frame(OP_STAT, pack_fields(" ".join(command[1:])), request_id=request_id)
+            response = conn.recv_frame()
+            fields = unpack_fields(response.payload)
+            if response.opcode == OP_OK:
+                name, kind, size, mtime = fields
+                print(f"{name}: {kind}, {size} bytes, modified {time.ctime(int(mtime) / 1e9)}")
             else:
-                print(f"[ERROR] {msg}")
-                
+                print(f"[ERROR] {fields[0]}")
+
+        elif cmd == "RUN":
+            # RUN <file|->: pipeline a list of CREATE/DELETE/STAT/DIR commands
+            if len(command) < 2:
+                print("[ERROR] Specify a command file, or - to type them (end with END).")
+                continue
+            lines = read_command_list(command[1])
+            requests = [command_request(line) for line in lines]
+            if None in requests:
+                print(f"[ERROR] Only CREATE, DELETE, STAT and DIR can be pipelined: {lines[requests.index(None)]}")
+                continue
+            startR = time.perf_counter()
+            replies = pipeline(conn, requests, request_id + 1)
+            endR = time.perf_counter()
+            request_id += len(requests)
+            for line, response in zip(lines, replies):
+                status = "OK" if response.opcode == OP_OK else "ERROR"
+                fields = unpack_fields(response.payload)
+                if response.opcode == OP_OK and line.split()[0].upper() == "DIR":
+                    more = ", more to come" if fields[0] else ""
+                    print(f"{line}: {status} {len(fields) // 4} entries{more}")
+                    continue
+                print(f"{line}: {status} {' '.join(fields)}")
+            print(f"{len(requests)} commands in {endR - startR:.2f} s")
+
+        elif cmd == "BATCH":
+            # BATCH <file|->: CREATE/DELETE/STAT lines run by the server as one request
+            if len(command) < 2:
+                print("[ERROR] Specify a command file, or - to type them (end with END).")
+                continue
+            lines = read_command_list(command[1])
+            items = []
+            for line in lines:
+                operation, _, name = line.partition(" ")
+                items.append(f"{operation.upper()}\t{name.strip()}")
+            startB = time.perf_counter()
+            conn.send_frame(OP_BATCH, pack_fields(len(items)), request_id=request_id)
+            conn.send_bytes("\n".join(items).encode(FORMAT), request_id=request_id)
+            response = conn.recv_frame()
+            if response.opcode != OP_OK:
+                print(f"[ERROR] {response.payload.decode(FORMAT)}")
+                continue
+            item_total, succeeded, length = unpack_fields(response.payload)
+            results = conn.recv_bytes(int(length)).decode(FORMAT).split("\n")
+            endB = time.perf_counter()
+            for line, result in zip(lines, results):
+                status, _, message = result.partition("\t")
+                print(f"{line}: {status} {message.replace(chr(9), ' ')}")
+            print(f"{succeeded} of {item_total} operations succeeded in {endB - startB:.2f} s")
+
         elif cmd == "DOWNLOAD":
             if len(command) < 2:
                 print("[ERROR] Specify the file name to download.")
                 continue
 
             filename = command[1]
+            filepath = os.path.join(CLIENT_STORAGE, filename)
+            # Optional byte range: DOWNLOAD <name> [offset] [length]. A ranged
+            # download writes its bytes in place in the existing local copy,
+            # a full one goes to a .part file that a later DOWNLOAD resumes.
+            # A full download is skipped if our copy is still current.
+            ranged = len(command) > 2
+            current = ""
+            if ranged:
+                offset = command[2]
+                length = command[3] if len(command) > 3 else ""
+                target = filepath
+            else:
+                target = filepath + ".part"
+                offset = resume_offset(conn, filename, target, request_id)
+                length = ""
+                current = "" if offset else local_etag(filepath)
 
             # Send the DOWNLOAD command to the server
-            client.send(f"{cmd}@{filename}".encode(FORMAT))
+            conn.send_frame(OP_DOWNLOAD, pack_fields(filename, offset, length, COMPRESSION, current),
+                            request_id=request_id)
 
             # Wait for the server response
-            response = client.recv(SIZE).decode(FORMAT)
-            if response.startswith("ERROR"):
-                print(response.split("@", 1)[1])
+            response = conn.recv_frame()
+            if response.opcode == OP_ERROR:
+                print(response.payload.decode(FORMAT))
                 continue
 
-            if response.startswith("OK"):
-                _, server_filename, filesize = response.split("@")
-                filesize = int(filesize)  # Convert to an integer
-                print(f"Downloading file: {server_filename} ({filesize} bytes)")
-
-                # Open a file to write the incoming data
-                filepath = os.path.join(CLIENT_STORAGE, filename)
+            if response.opcode == OP_OK:
+                fields = unpack_fields(response.payload)
+                if up_to_date(fields):
+                    print(f"{filename} is already up to date.")
+                    continue
+                server_filename, filesize, offset, count = fields[:4]
+                filesize, offset, count = int(filesize), int(offset), int(count)  # Convert to integers
+                codec = fields[4] if len(fields) > 4 else ""  # Compression the server picked
+                decompressor = Decompressor(codec) if codec else None
+                if offset and not ranged:
+                    print(f"Resuming download of {server_filename} at byte {offset}")
+                print(f"Downloading file: {server_filename} ({count} of {filesize} bytes from offset {offset})")
+
+                # Open a file to write the incoming data. A ranged download
+                # always writes into the existing copy, even from offset 0.
+                mode = "r+b" if (ranged or offset) and os.path.exists(target) else "wb"
 
                 startD = time.perf_counter()
-                with open(filepath, "wb") as f:
-                    bytes_received = 0
-                    while bytes_received < filesize:
-                        chunk = client.recv(min(SIZE, filesize - bytes_received))
-                        f.write(chunk)
-                        bytes_received += len(chunk)
+                with open(target, mode) as f:
+                    f.seek(offset)
+                    if not ranged:
+                        f.truncate()  # Drop anything past the verified resume point
+                    conn.recv_body(f.write, decompressor)
+                if not ranged:
+                    os.replace(target, filepath)
+                    keep_version(filepath, fields)
                 
                 endD = time.perf_counter()
                 
                 print(f"[DOWNLOAD COMPLETE] File {filename} downloaded successfully.")
+                if decompressor:
+                    print_compression(codec, [decompressor])
                 print(f"The time to download was {endD - startD:.2f} s")
-                end_file = client.recv(SIZE)
 
         elif cmd == "CREATE":
             # Check if the subfolder name is provided
@@ -188,11 +770,10 @@ def main():
             print(f"[DEBUG] Sending CREATE command: {cmd}@{subfolder_name}")  # Debug log
             
             # Send CREATE request to the server
-            client.send(f"{cmd}@{subfolder_name}".encode(FORMAT))
+            conn.send_frame(OP_CREATE, pack_fields(subfolder_name), request_id=request_id)
 
              # Receive and interpret the server's response
-            response = client.recv(SIZE).decode(FORMAT)
-            cmd, msg = response.split("@", 1)
+            print_reply(conn.recv_frame())
             print(f"Sent CREATE command: {cmd}@{subfolder_name}")
 
 
@@ -205,18 +786,10 @@ def main():
             filename = command[1].strip()
 
             # Send DELETE request to the server
-            client.send(f"{cmd}@{filename}".encode(FORMAT))
+            conn.send_frame(OP_DELETE, pack_fields(filename), request_id=request_id)
 
             # Receive and interpret server's response
-            response = client.recv(SIZE).decode(FORMAT)
-            cmd, msg = response.split("@", 1)
-
-            if cmd == "OK":
-                print(f"[SUCCESS] {msg}")
-            elif cmd == "ERROR":
-                print(f"[ERROR] {msg}")
-            else:
-                print("[ERROR] Unexpected response from the server.")
+            print_reply(conn.recv_frame())
 
     client.close()  # Close the connection
 
@@ -224,4 +797,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-
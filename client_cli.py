@@ -0,0 +1,89 @@
+import sys
+import argparse
+
+import clientlib
+
+# Non-interactive client for scripts and cron jobs:
+#
+#   python client_cli.py --host 10.200.232.146 --user user1 --token-file .session upload report.csv
+#   python client_cli.py list reports
+#   python client_cli.py download -r reports backup/reports
+#
+# Every flag left out is read from the environment (FILE_SERVER_HOST,
+# FILE_SERVER_PORT, FILE_SERVER_USER, FILE_SERVER_PASSWORD,
+# FILE_SERVER_TOKEN_FILE, FILE_SERVER_KEY, FILE_SERVER_ENCRYPTION,
+# FILE_SERVER_COMPRESSION), which keeps the password out of the process
+# list. With a token file only the first run logs in with the password, the
+# ones after it RESUME with the saved session token. Results go to stdout,
+# errors to stderr with exit status 1.
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="File server client")
+    parser.add_argument("--host", help=f"Server address (default: {clientlib.HOST})")
+    parser.add_argument("--port", type=int, help=f"Server port (default: {clientlib.PORT})")
+    parser.add_argument("--user", help="Username")
+    parser.add_argument("--password", help="Password, better given as FILE_SERVER_PASSWORD")
+    parser.add_argument("--token-file", help="Keep the session token here and log in with it next time")
+    parser.add_argument("--key", help="Shared key file (default: key.key)")
+    parser.add_argument("--no-encryption", action="store_true", help="Send file payloads in plaintext")
+    parser.add_argument("--no-compression", action="store_true", help="Don't offer to compress transfers")
+    commands = parser.add_subparsers(dest="command", required=True)
+    upload = commands.add_parser("upload", help="Send a file, or a folder with -r")
+    upload.add_argument("path")
+    upload.add_argument("name", nargs="?", help="Name on the server (default: the basename of path)")
+    upload.add_argument("-r", "--recursive", action="store_true", help="path is a folder")
+    download = commands.add_parser("download", help="Fetch a file, or a folder with -r")
+    download.add_argument("name")
+    download.add_argument("path", nargs="?", help="Where to save it (default: name)")
+    download.add_argument("-r", "--recursive", action="store_true", help="name is a folder")
+    listing = commands.add_parser("list", help="List a folder (default: the top level)")
+    listing.add_argument("folder", nargs="?", default="")
+    delete = commands.add_parser("delete", help="Delete a file or empty folder, or a whole folder with -r")
+    delete.add_argument("name")
+    delete.add_argument("-r", "--recursive", action="store_true", help="Delete everything in the folder too")
+    return parser.parse_args(argv)
+
+
+def run(conn, args):
+    if args.command == "upload":
+        if args.recursive:
+            files, folders, size = conn.upload_tree(args.path, args.name)
+            print(f"{files} files, {folders} folders, {size} bytes uploaded")
+        else:
+            print(conn.upload(args.path, args.name))
+    elif args.command == "download":
+        if args.recursive:
+            extractor = conn.download_tree(args.name, args.path)
+            for error in extractor.errors:
+                print(f"[ERROR] Not stored: {error}", file=sys.stderr)
+            print(f"{extractor.files} files, {extractor.folders} folders, {extractor.bytes} bytes downloaded")
+            return 1 if extractor.errors else 0
+        written = conn.download(args.name, args.path)
+        print(f"{args.name} is up to date" if written is None else f"{written} bytes downloaded")
+    elif args.command == "list":
+        for name, kind, size, mtime_ns in conn.list(args.folder):
+            print(f"{name}\t{kind}\t{size}\t{mtime_ns // 1_000_000_000}")
+    elif args.command == "delete":
+        print(conn.delete_tree(args.name) if args.recursive else conn.delete(args.name))
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {}
+    if args.no_encryption:
+        options["encryption"] = ""
+    if args.no_compression:
+        options["compression"] = ""
+    try:
+        with clientlib.connect(args.host, args.port, args.user, args.password, args.token_file, args.key,
+                               **options) as conn:
+            return run(conn, args)
+    except (clientlib.ServerError, OSError) as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
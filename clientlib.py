@@ -0,0 +1,443 @@
+import os
+import socket
+import threading
+from contextlib import contextmanager
+
+from protocol import (FrameSocket, tune_socket, pack_fields, unpack_fields, etag, OP_AUTH, OP_RESUME,
+                      OP_REVOKE, OP_LOGOUT, OP_UPLOAD_OPEN, OP_UPLOAD_RANGE, OP_DEDUP_OPEN, OP_CHUNK_PUT,
+                      OP_DEDUP_COMMIT, OP_DOWNLOAD, OP_DIR, OP_CREATE, OP_DELETE, OP_STAT, OP_CONFIRM,
+                      OP_TREE_UPLOAD, OP_TREE_DOWNLOAD, OP_TREE_DELETE, OP_OK, OP_EXISTS, CAP_DEDUP)
+from compression import Compressor, Decompressor, available
+
+# Client library for scripts, as opposed to the interactive client.py.
+#
+# Connection is one logged-in connection with a method per command that
+# returns results and raises ServerError when the server refuses, instead of
+# printing. ConnectionPool keeps a few of them open for reuse across threads
+# and requests. After the first password login the server hands out a
+# session token, and every further connection of the pool (and, with
+# token_file, of the next process) logs in with RESUME and that token, which
+# skips the password check on the server.
+#
+#   pool = ConnectionPool(("10.200.232.146", 49157), "user1", "password1", token_file=".session")
+#   with pool.connection() as conn:
+#       conn.upload("report.csv")
+#       for name, kind, size, mtime_ns in conn.list():
+#           ...
+#
+# For one-off calls, upload(), download(), list_folder() and delete() open a
+# connection, run the command and log out. Whatever they aren't given is
+# read from the FILE_SERVER_* environment variables (see setting()), and
+# client_cli.py runs them from the command line.
+#
+# Scripts like that are started over and over, so this module only imports
+# what every transfer needs. cryptography is loaded when a password login
+# or an encrypted connection needs it, archive.py by the folder commands
+# and transfers.py or cas.py (which may load numpy) by uploads.
+
+HOST = "10.200.232.146"  # Server address when neither an argument nor FILE_SERVER_HOST gives one
+PORT = 49157
+ENCRYPTION = "aes-gcm,chacha20-poly1305"  # Payload ciphers asked for at login ("" to send plaintext)
+BUFFER_SIZE = 256 * 1024  # Transfer buffer for file contents
+CHUNK_SIZE = 8 * 1024 * 1024  # Byte range an upload sends per request, also the resume granularity
+POOL_SIZE = 4  # Connections a pool keeps at most
+
+
+class ServerError(Exception):
+    # The server answered a request with an error, the connection is still usable
+    pass
+
+
+def setting(value, name, default=None):
+    # value unless it is None, otherwise the environment variable
+    # FILE_SERVER_<name>, otherwise default
+    if value is not None:
+        return value
+    return os.environ.get("FILE_SERVER_" + name, default)
+
+
+def load_key(path="key.key"):
+    with open(path, "rb") as key_file:
+        return key_file.read()
+
+
+def password_cipher(key):
+    # The Fernet that encrypts passwords for AUTH. Imported here, a RESUME
+    # with a session token doesn't need it.
+    from cryptography.fernet import Fernet
+    return Fernet(key)
+
+
+def load_token(path):
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def save_token(path, token):
+    # Readable by the owner only, the token logs in like the password
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token or "")
+
+
+class Connection:
+    # One authenticated connection. Logs in with token if one is given and
+    # still valid, otherwise with username and password.
+
+    def __init__(self, addr, username=None, password=None, token=None, key=None, encryption=ENCRYPTION,
+                 compression=None, buffer_size=BUFFER_SIZE, fernet=None):
+        self.key = key or load_key()
+        self.fernet = fernet
+        self.encryption = encryption
+        self.compression = available() if compression is None else compression
+        self.token = None  # Session token from the server, None if it doesn't issue them
+        self.resumed = False  # Whether the login used the token
+        self.request_id = 0
+        sock = socket.create_connection(addr)
+        try:
+            tune_socket(sock, buffer_size)
+            self.conn = FrameSocket(sock, buffer_size)
+            banner = self.conn.recv_frame()
+            if banner is None or banner.opcode != OP_OK:
+                raise ServerError(banner.payload.decode() if banner else "Connection closed by server")
+            self.capabilities = unpack_fields(banner.payload)[1:]
+            error = None
+            if token:
+                error = self._login(OP_RESUME, token)
+                self.resumed = error is None
+            if not self.resumed:
+                if password is None:
+                    raise ServerError(error or "No password or session token to log in with")
+                self.fernet = self.fernet or password_cipher(self.key)
+                error = self._login(OP_AUTH, username, self.fernet.encrypt(password.encode()).decode())
+                if error is not None:
+                    raise ServerError(error)
+        except BaseException:
+            sock.close()
+            raise
+
+    def _login(self, opcode, *credentials):
+        # None on success, otherwise the server's reason
+        client_nonce = b""
+        if self.encryption:
+            import aead
+            client_nonce = os.urandom(aead.NONCE_SIZE)
+        self.conn.send_frame(opcode, pack_fields(*credentials, self.encryption, client_nonce.hex()))
+        reply = self.conn.recv_frame()
+        if reply is None:
+            raise ConnectionError("Connection closed by server")
+        fields = unpack_fields(reply.payload)
+        if reply.opcode != OP_OK:
+            return fields[0] if fields else "Login failed"
+        if len(fields) > 2 and fields[1]:
+            self.conn.set_cipher(aead.FrameCipher.for_client(fields[1], self.key, client_nonce,
+                                                             bytes.fromhex(fields[2]), aead.DEFAULT_CHUNK_SIZE))
+        self.token = fields[3] if len(fields) > 3 and fields[3] else None
+        return None
+
+    def _next_id(self):
+        self.request_id += 1
+        return self.request_id
+
+    def _reply(self, rid):
+        reply = self.conn.recv_frame()
+        if reply is None:
+            raise ConnectionError("Connection closed by server")
+        if reply.opcode != OP_OK and reply.opcode != OP_EXISTS:
+            raise ServerError(reply.payload.decode(errors="replace"))
+        return reply
+
+    def request(self, opcode, *fields):
+        # Send one request, return the fields of the OK reply
+        rid = self._next_id()
+        self.conn.send_frame(opcode, pack_fields(*fields), request_id=rid)
+        return unpack_fields(self._reply(rid).payload)
+
+    def stat(self, name):
+        # (kind, size, mtime_ns)
+        _, kind, size, mtime_ns = self.request(OP_STAT, name)
+        return kind, int(size), int(mtime_ns)
+
+    def list(self, folder=""):
+        # Yields (name, kind, size, mtime_ns) for every entry, page by page
+        cursor = ""
+        while True:
+            fields = self.request(OP_DIR, folder, cursor)
+            for i in range(1, len(fields), 4):
+                name, kind, size, mtime_ns = fields[i:i + 4]
+                yield name, kind, int(size), int(mtime_ns)
+            cursor = fields[0]
+            if not cursor:
+                return
+
+    def create(self, name):
+        return self.request(OP_CREATE, name)[0]
+
+    def delete(self, name):
+        return self.request(OP_DELETE, name)[0]
+
+    def _confirm(self, rid, overwrite):
+        # The reply to an upload request, answering the server's overwrite
+        # question on the way if it asks one
+        reply = self._reply(rid)
+        if reply.opcode == OP_EXISTS:
+            self.conn.send_frame(OP_CONFIRM, "yes" if overwrite else "no", request_id=rid)
+            reply = self._reply(rid)
+        return reply
+
+    def upload(self, path, name=None, overwrite=True, chunk_size=CHUNK_SIZE):
+        # Send the local file at path, stored as name (its basename by
+        # default), the way client.py's UPLOAD does: a deduplicating server
+        # only gets the chunks it doesn't have, any other a chunked upload
+        # that a failed call resumes when it is made again. Returns the
+        # server's message.
+        name = name or os.path.basename(path)
+        if CAP_DEDUP in self.capabilities:
+            return self._dedup_upload(path, name, overwrite)
+        from transfers import split_ranges, sha256_range
+        rid = self._next_id()
+        size = os.path.getsize(path)
+        self.conn.send_frame(OP_UPLOAD_OPEN, pack_fields(name, size, chunk_size, self.compression), request_id=rid)
+        fields = unpack_fields(self._confirm(rid, overwrite).payload)
+        transfer_id, chunk_size = fields[0], int(fields[1])
+        done = {int(index) for index in fields[2].split(",") if index}
+        codec = fields[3] if len(fields) > 3 else ""
+        message = f"File {name} uploaded successfully."  # Empty files are stored on open
+        with open(path, "rb") as f:
+            for offset, count in split_ranges(size, chunk_size):
+                index = offset // chunk_size
+                if not count or index in done:
+                    continue
+                digest = sha256_range(path, offset, count)
+                self.conn.send_frame(OP_UPLOAD_RANGE, pack_fields(transfer_id, index, digest, "", codec),
+                                     request_id=rid)
+                self.conn.send_file(f, offset, count, request_id=rid, compressor=Compressor(codec) if codec else None)
+                message = unpack_fields(self._reply(rid).payload)[0]
+        return message
+
+    def _dedup_upload(self, path, name, overwrite):
+        # The file's chunk list first, then only the chunks the server asks for
+        from cas import chunk_file, pack_chunk_list, unpack_indexes, INDEX
+        size = os.path.getsize(path)
+        chunks = list(chunk_file(path))
+        rid = self._next_id()
+        self.conn.send_frame(OP_DEDUP_OPEN, pack_fields(name, size, len(chunks)), request_id=rid)
+        self.conn.send_bytes(pack_chunk_list((digest, length) for offset, length, digest in chunks), request_id=rid)
+        self._confirm(rid, overwrite)
+        missing = unpack_indexes(self.conn.recv_bytes(len(chunks) * INDEX.size))
+        with open(path, "rb") as f:
+            for index in missing:
+                offset, length, digest = chunks[index]
+                self.conn.send_frame(OP_CHUNK_PUT, pack_fields(index), request_id=rid)
+                self.conn.send_file(f, offset, length, request_id=rid)
+        self.conn.send_frame(OP_DEDUP_COMMIT, request_id=rid)
+        return unpack_fields(self._reply(rid).payload)[0]
+
+    def download(self, name, path=None, offset=0, length=None):
+        # Fetch name into path, by way of a .part file so an interrupted
+        # download never leaves a torn copy. A range (length bytes from
+        # offset) is written into the existing copy at offset instead, like
+        # client.py does. Returns the number of bytes written, or None if
+        # path already holds the server's current version of the whole file.
+        path = path or name
+        whole = not offset and length is None
+        current = ""
+        if whole and os.path.exists(path):
+            st = os.stat(path)
+            current = etag(st.st_size, st.st_mtime_ns)
+        rid = self._next_id()
+        self.conn.send_frame(OP_DOWNLOAD, pack_fields(name, offset, "" if length is None else length,
+                                                     self.compression, current), request_id=rid)
+        fields = unpack_fields(self._reply(rid).payload)
+        if len(fields) > 7 and fields[7] == "unchanged":
+            return None
+        codec = fields[4] if len(fields) > 4 else ""
+        if not whole:
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.seek(int(fields[2]))
+                return self.conn.recv_body(f.write, Decompressor(codec) if codec else None)
+        part = path + ".part"
+        with open(part, "wb") as f:
+            written = self.conn.recv_body(f.write, Decompressor(codec) if codec else None)
+        os.replace(part, path)
+        if len(fields) > 6:
+            # With the server's mtime the next download of it can be skipped
+            os.utime(path, ns=(int(fields[6]), int(fields[6])))
+        return written
+
+    def upload_tree(self, path, name=None):
+        # Send the local folder at path and everything in it, stored as name
+        # (its basename by default). Returns (files, folders, bytes) stored.
+        import archive
+        name = name or os.path.basename(os.path.normpath(path))
+        rid = self._next_id()
+        self.conn.send_frame(OP_TREE_UPLOAD, pack_fields(name, self.compression), request_id=rid)
+        fields = unpack_fields(self._reply(rid).payload)
+        compressor = Compressor(fields[1]) if len(fields) > 1 and fields[1] else None
+        for piece, last in archive.pack(path):
+            if isinstance(piece, tuple):
+                f, size = piece
+                self.conn.send_file(f, 0, size, request_id=rid, end=False, compressor=compressor)
+            else:
+                self.conn.send_buffer(piece, request_id=rid, end=last, compressor=compressor)
+        return tuple(int(field) for field in unpack_fields(self._reply(rid).payload))
+
+    def download_tree(self, name, path=None):
+        # Fetch the folder name and everything in it into the local folder
+        # path, keeping the server's mtimes. Returns the archive.Extractor,
+        # whose errors lists the entries that could not be stored.
+        import archive
+        path = path or name
+        rid = self._next_id()
+        self.conn.send_frame(OP_TREE_DOWNLOAD, pack_fields(name, self.compression), request_id=rid)
+        fields = unpack_fields(self._reply(rid).payload)
+        codec = fields[1] if len(fields) > 1 else ""
+        os.makedirs(path, exist_ok=True)
+        extractor = archive.Extractor(path, keep_metadata=True)
+        try:
+            self.conn.recv_body(extractor.write, Decompressor(codec) if codec else None)
+        finally:
+            extractor.finish()
+        return extractor
+
+    def delete_tree(self, name):
+        return self.request(OP_TREE_DELETE, name)[0]
+
+    def revoke(self, all_sessions=False):
+        # Invalidate this connection's token, or every token of the user
+        return self.request(OP_REVOKE, "all" if all_sessions else "")[0]
+
+    def close(self, logout=True):
+        try:
+            if logout:
+                self.conn.send_frame(OP_LOGOUT, request_id=self._next_id())
+                self.conn.recv_frame()
+        except OSError:
+            pass
+        finally:
+            self.conn.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    # Up to size logged-in connections shared by any number of threads.
+    # Connections are created on demand and kept open between uses. A
+    # connection whose socket failed is closed rather than reused.
+
+    def __init__(self, addr, username, password=None, size=POOL_SIZE, token_file=None, **options):
+        self.addr = addr
+        self.username = username
+        self.password = password
+        self.token_file = token_file
+        self.options = options
+        self.options.setdefault("key", load_key())
+        self.token = load_token(token_file) if token_file else None
+        self.idle = []  # Most recently used last
+        self.lock = threading.Lock()
+        self.login_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def _open(self):
+        if self.token is None:
+            # Let one thread log in with the password while the others wait
+            # for its token
+            with self.login_lock:
+                if self.token is None:
+                    return self._connect()
+        return self._connect()
+
+    def _connect(self):
+        conn = Connection(self.addr, self.username, self.password, token=self.token, **self.options)
+        with self.lock:
+            if conn.token != self.token:
+                # First login, or the old token had expired
+                self.token = conn.token
+                if self.token_file:
+                    save_token(self.token_file, self.token)
+        return conn
+
+    def _put(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    @contextmanager
+    def connection(self):
+        self.slots.acquire()
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self._open()
+            try:
+                yield conn
+            except ServerError:
+                self._put(conn)
+                raise
+            except BaseException:
+                # Possibly in the middle of a body, the connection can't be trusted
+                conn.close(logout=False)
+                raise
+            self._put(conn)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def connect(host=None, port=None, username=None, password=None, token_file=None, key_file=None, **options):
+    # A Connection for one-off use. With a token file (FILE_SERVER_TOKEN_FILE)
+    # the session token is kept between runs, so only the first run logs in
+    # with the password.
+    host = setting(host, "HOST", HOST)
+    port = int(setting(port, "PORT", PORT))
+    username = setting(username, "USER")
+    password = setting(password, "PASSWORD")
+    token_file = setting(token_file, "TOKEN_FILE")
+    options.setdefault("encryption", setting(None, "ENCRYPTION", ENCRYPTION))
+    options.setdefault("compression", setting(None, "COMPRESSION"))
+    token = load_token(token_file) if token_file else None
+    conn = Connection((host, port), username, password, token=token,
+                      key=load_key(setting(key_file, "KEY", "key.key")), **options)
+    if token_file and conn.token != token:
+        save_token(token_file, conn.token)
+    return conn
+
+
+def upload(path, name=None, **settings):
+    # Settings are connect()'s arguments
+    with connect(**settings) as conn:
+        return conn.upload(path, name)
+
+
+def download(name, path=None, **settings):
+    with connect(**settings) as conn:
+        return conn.download(name, path)
+
+
+def list_folder(folder="", **settings):
+    # [(name, kind, size, mtime_ns)]
+    with connect(**settings) as conn:
+        return list(conn.list(folder))
+
+
+def delete(name, **settings):
+    with connect(**settings) as conn:
+        return conn.delete(name)
@@ -0,0 +1,109 @@
+import zlib
+
+try:
+    import lzma
+except ImportError:  # Python built without liblzma
+    lzma = None
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+# On-the-wire compression of file bodies.
+#
+# The codec is negotiated per transfer: the client lists the codecs it can
+# use, the server picks the first one it has too and names it in its reply.
+# A compressed body is still a sequence of DATA frames, every frame holds one
+# block of at most BLOCK_SIZE bytes compressed on its own and is flagged with
+# FLAG_COMPRESSED. Blocks that don't shrink enough go out raw, and after a few
+# of those in a row compression is switched off for a while so no CPU is
+# spent on data that is already compressed (archives, media, encrypted files).
+
+BLOCK_SIZE = 256 * 1024  # Logical bytes per compressed frame
+MAX_BLOCK = 1024 * 1024  # Largest block a receiver accepts
+MIN_SAVING = 0.9  # Compressed blocks must be smaller than this fraction of the raw block
+GIVE_UP = 2  # Incompressible blocks in a row before compression switches off...
+RETRY = 64  # ...and for how many blocks it stays off before trying again
+
+# name -> (compress, decompressor factory). zlib is always there, the others
+# only when Python was built with them.
+CODECS = {"zlib": (lambda data: zlib.compress(data, 6), zlib.decompressobj)}
+if lzma is not None:
+    CODECS["lzma"] = (lambda data: lzma.compress(data, preset=1), lzma.LZMADecompressor)
+if bz2 is not None:
+    CODECS["bz2"] = (lambda data: bz2.compress(data, 5), bz2.BZ2Decompressor)
+
+# What the decompressors raise on corrupt input
+DECODE_ERRORS = (zlib.error, OSError, EOFError) + ((lzma.LZMAError,) if lzma is not None else ())
+
+
+def available():
+    # The codecs this side can use, comma-separated, in order of preference
+    return ",".join(CODECS)
+
+
+def negotiate(offer):
+    # First codec of a comma-separated offer we support, "" for none
+    for codec in offer.split(","):
+        if codec in CODECS:
+            return codec
+    return ""
+
+
+class Compressor:
+    # Sending side of one transfer, also counts logical and wire bytes
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.compress = CODECS[codec][0]
+        self.misses = 0  # Incompressible blocks in a row
+        self.skip = 0  # Blocks left to send raw without trying
+        self.logical = 0
+        self.wire = 0
+
+    def encode(self, data):
+        # (payload, compressed) for one block
+        self.logical += len(data)
+        if self.skip:
+            self.skip -= 1
+        elif data:
+            packed = self.compress(data)
+            if len(packed) < len(data) * MIN_SAVING:
+                self.misses = 0
+                self.wire += len(packed)
+                return packed, True
+            self.misses += 1
+            if self.misses >= GIVE_UP:
+                self.misses = 0
+                self.skip = RETRY
+        self.wire += len(data)
+        return data, False
+
+
+class Decompressor:
+    # Receiving side of one transfer, also counts logical and wire bytes
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.factory = CODECS[codec][1]
+        self.logical = 0
+        self.wire = 0
+
+    def decode(self, packed):
+        # Each block is a complete stream of its own and may not inflate past
+        # MAX_BLOCK, so a hostile peer can't make us allocate without bound
+        decompressor = self.factory()
+        try:
+            data = decompressor.decompress(packed, MAX_BLOCK)
+        except DECODE_ERRORS as e:
+            raise ValueError(f"Bad {self.codec} block: {e}")
+        if not decompressor.eof:
+            raise ValueError(f"Bad {self.codec} block")
+        self.wire += len(packed)
+        self.logical += len(data)
+        return data
+
+    def passthrough(self, length):
+        # A raw block of the same body
+        self.wire += length
+        self.logical += length
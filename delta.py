@@ -0,0 +1,286 @@
+import os
+import math
+import struct
+import hashlib
+from bisect import bisect_left
+from itertools import accumulate
+
+try:
+    import numpy as np
+except ImportError:  # Checksums fall back to pure Python
+    np = None
+
+# rsync-style delta transfer.
+#
+# The receiver describes the copy it already has as a list of block
+# signatures: a cheap rolling checksum and a strong hash per fixed-size
+# block. The sender slides a window over its new version of the file, and
+# wherever the rolling checksum and then the strong hash match a block of the
+# old copy it sends a reference to that block instead of the data. Everything
+# else goes as literal bytes. The receiver rebuilds the new version from the
+# references and the literals and checks it against the SHA-256 the sender
+# computed along the way.
+
+MIN_BLOCK = 2 * 1024
+MAX_BLOCK = 128 * 1024
+READ_BLOCK = 4 * 1024 * 1024  # How much of the new file is scanned at once
+BATCH = 256 * 1024  # Instructions are sent in DATA frames of about this size
+MAX_LITERAL = 1024 * 1024  # Longest literal in one instruction
+
+# Signature of one block: rolling checksum and the first 16 bytes of its SHA-256
+SIGNATURE = struct.Struct("!I16s")
+
+# Instructions of the delta stream, each starts with its opcode byte
+DELTA_COPY = 0x01  # first block, block count: copy blocks of the old file
+DELTA_LITERAL = 0x02  # length, then that many bytes of new data
+DELTA_END = 0x03  # SHA-256 of the whole new file
+COPY = struct.Struct("!BII")
+LITERAL = struct.Struct("!BI")
+END = struct.Struct("!B32s")
+
+
+def block_size_for(filesize):
+    # About sqrt(filesize) like rsync: fewer, larger blocks for larger files
+    size = int(math.sqrt(filesize)) & ~1023
+    return max(MIN_BLOCK, min(MAX_BLOCK, size))
+
+
+def weak_checksum(block):
+    # rsync's checksum: a = sum of the bytes, b = sum of the running sums of a
+    if np is not None:
+        values = np.frombuffer(block, dtype=np.uint8).astype(np.int64)
+        a = int(values.sum())
+        b = int(np.cumsum(values).sum())
+    else:
+        a = sum(block)
+        b = sum(accumulate(block))
+    return (a & 0xFFFF) | ((b & 0xFFFF) << 16)
+
+
+def strong_hash(block):
+    return hashlib.sha256(block).digest()[:16]
+
+
+def _rolling_numpy(data, block_size):
+    # weak_checksum of data[k:k + block_size] for every k, vectorised through
+    # prefix sums of x and of j * x
+    values = np.frombuffer(data, dtype=np.uint8).astype(np.int64)
+    sums = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(values, out=sums[1:])
+    weighted = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(values * np.arange(len(values), dtype=np.int64), out=weighted[1:])
+    starts = np.arange(len(values) - block_size + 1, dtype=np.int64)
+    a = sums[block_size:] - sums[:-block_size]
+    b = (starts + block_size) * a - (weighted[block_size:] - weighted[:-block_size])
+    return ((a & 0xFFFF) | ((b & 0xFFFF) << 16)).astype(np.uint32)
+
+
+def _rolling_python(data, block_size):
+    checksums = []
+    a = sum(data[:block_size]) & 0xFFFF
+    b = sum(accumulate(data[:block_size])) & 0xFFFF
+    checksums.append(a | (b << 16))
+    for k in range(len(data) - block_size):
+        out, new = data[k], data[k + block_size]
+        a = (a - out + new) & 0xFFFF
+        b = (b - block_size * out + a) & 0xFFFF
+        checksums.append(a | (b << 16))
+    return checksums
+
+
+def signatures(f, block_size):
+    # Signature of every whole block of the open file. A trailing partial
+    # block is left out, the sender just sends those few bytes as literals.
+    out = bytearray()
+    f.seek(0)
+    while True:
+        block = f.read(block_size)
+        if len(block) < block_size:
+            break
+        out += SIGNATURE.pack(weak_checksum(block), strong_hash(block))
+    return bytes(out)
+
+
+def unpack_signatures(data):
+    return list(SIGNATURE.iter_unpack(data))
+
+
+def compute_delta(path, block_size, signature_list, stats=None):
+    # Yield the delta stream that turns the receiver's file (described by
+    # signature_list) into the file at path, in pieces of about BATCH bytes.
+    # stats, if given, is filled with the literal and matched byte counts.
+    table = {}  # weak checksum -> {strong hash: block index}
+    for index, (weak, strong) in enumerate(signature_list):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    if stats is None:
+        stats = {}
+    stats["literal"] = stats["matched"] = 0
+    rolling = _rolling_numpy if np is not None else _rolling_python
+    if np is not None and table:
+        known = np.zeros(1 << 24, dtype=bool)
+        known[np.array(list(table), dtype=np.uint32) >> 8] = True
+
+    out = bytearray()
+    digest = hashlib.sha256()
+    run = None  # [first block, count] of the copy being extended
+
+    def flush_run():
+        nonlocal run
+        if run:
+            out.extend(COPY.pack(DELTA_COPY, run[0], run[1]))
+            stats["matched"] += run[1] * block_size
+            run = None
+
+    def literal(data):
+        flush_run()
+        for start in range(0, len(data), MAX_LITERAL):
+            piece = data[start:start + MAX_LITERAL]
+            out.extend(LITERAL.pack(DELTA_LITERAL, len(piece)))
+            out.extend(piece)
+        stats["literal"] += len(data)
+
+    def copy(index):
+        nonlocal run
+        if run and run[0] + run[1] == index:
+            run[1] += 1
+        else:
+            flush_run()
+            run = [index, 1]
+
+    pending = b""  # Bytes read but not yet matched or sent
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(READ_BLOCK)
+            digest.update(block)
+            data = pending + block
+            if not block:
+                break
+            pos = 0
+            if table and len(data) >= block_size:
+                weak = rolling(data, block_size)
+                if np is not None:
+                    # Positions whose top 24 bits match a known checksum, the
+                    # dict lookup below weeds out the rest
+                    candidates = np.flatnonzero(known[weak >> 8]).tolist()
+                else:
+                    candidates = [k for k, value in enumerate(weak) if value in table]
+                i = 0
+                while i < len(candidates):
+                    k = candidates[i]
+                    blocks = table.get(int(weak[k]))
+                    index = blocks.get(strong_hash(data[k:k + block_size])) if blocks else None
+                    if index is None:
+                        i += 1
+                        continue
+                    if k > pos:
+                        literal(data[pos:k])
+                    copy(index)
+                    pos = k + block_size
+                    i = bisect_left(candidates, pos, i)
+                    if len(out) >= BATCH:
+                        yield bytes(out)
+                        out.clear()
+            # A match can still start in the last block_size - 1 bytes once
+            # more data arrives, keep them back
+            keep = max(pos, len(data) - block_size + 1)
+            if keep > pos:
+                literal(data[pos:keep])
+            pending = data[keep:]
+            if len(out) >= BATCH:
+                yield bytes(out)
+                out.clear()
+    if pending:
+        literal(pending)
+    flush_run()
+    out.extend(END.pack(DELTA_END, digest.digest()))
+    yield bytes(out)
+
+
+class Patcher:
+    # Applies a delta stream fed in arbitrary pieces through write(), copying
+    # matched blocks from basis (an open file, or None) and writing the new
+    # file through out_write. Bad instructions don't raise, so the rest of the
+    # body can still be read off the connection; error says what went wrong.
+
+    def __init__(self, basis, block_size, out_write, buffer_size=1024 * 1024):
+        self.basis = basis
+        self.block_size = block_size
+        self.block_total = os.fstat(basis.fileno()).st_size // block_size if basis else 0
+        self.out_write = out_write
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.literal_left = 0  # Bytes of the current literal still to come
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.literal = 0
+        self.matched = 0
+        self.expected = None  # Sender's SHA-256, from the END instruction
+        self.error = None
+
+    def write(self, data):
+        if self.error:
+            return
+        self.buffer.extend(data)
+        try:
+            self._parse()
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+
+    def _emit(self, data):
+        self.digest.update(data)
+        self.out_write(data)
+        self.size += len(data)
+
+    def _parse(self):
+        buffer = self.buffer
+        start = 0
+        while start < len(buffer):
+            if self.literal_left:
+                piece = bytes(buffer[start:start + self.literal_left])
+                self._emit(piece)
+                self.literal += len(piece)
+                self.literal_left -= len(piece)
+                start += len(piece)
+                continue
+            if self.expected is not None:
+                raise ValueError("Data after the end of the delta")
+            op = buffer[start]
+            size = {DELTA_COPY: COPY.size, DELTA_LITERAL: LITERAL.size, DELTA_END: END.size}.get(op)
+            if size is None:
+                raise ValueError(f"Unknown delta instruction {op:#x}")
+            if len(buffer) - start < size:
+                break
+            if op == DELTA_COPY:
+                op, first, count = COPY.unpack_from(buffer, start)
+                self._copy(first, count)
+            elif op == DELTA_LITERAL:
+                op, self.literal_left = LITERAL.unpack_from(buffer, start)
+            else:
+                op, self.expected = END.unpack_from(buffer, start)
+            start += size
+        del buffer[:start]
+
+    def _copy(self, first, count):
+        if first + count > self.block_total:
+            raise ValueError(f"Blocks {first}-{first + count} outside the old file")
+        offset = first * self.block_size
+        remaining = count * self.block_size
+        while remaining > 0:
+            data = os.pread(self.basis.fileno(), min(self.buffer_size, remaining), offset)
+            if not data:
+                raise ValueError("Old file shrank during the sync")
+            self._emit(data)
+            offset += len(data)
+            remaining -= len(data)
+        self.matched += count * self.block_size
+
+    def finish(self):
+        # None if the new file is complete and matches the sender's hash,
+        # otherwise the reason it doesn't
+        if self.error:
+            return self.error
+        if self.literal_left or self.buffer or self.expected is None:
+            return "Delta stream ended early"
+        if self.digest.digest() != self.expected:
+            return "Rebuilt file doesn't match the sender's SHA-256"
+        return None
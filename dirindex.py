@@ -0,0 +1,143 @@
+import os
+import stat
+import threading
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right, insort
+
+# In-memory index of the storage directory for DIR.
+#
+# Each folder is scanned with os.scandir the first time it is listed and kept
+# as a sorted list of names plus (kind, size, mtime) per name, so a listing is
+# a slice of that list rather than a fresh scan. Pages are addressed by a
+# cursor, the last name of the previous page, which stays valid while entries
+# come and go. Every change the server makes itself runs inside changing(),
+# which patches the cached folder afterwards; a folder whose mtime moved for
+# any other reason, before or during that change, is simply scanned again.
+
+
+def relative(path):
+    # Normalise a client-supplied path inside the storage root, "" is the root
+    path = path.strip().strip("/")
+    if not path:
+        return ""
+    path = os.path.normpath(path)
+    if path == ".":
+        return ""
+    if os.path.isabs(path) or path == ".." or path.startswith(".." + os.sep):
+        raise ValueError(f"Path {path} is outside the storage directory")
+    return path
+
+
+class Folder:
+    def __init__(self, mtime):
+        self.mtime = mtime  # st_mtime_ns of the folder when the entries were read
+        self.names = []  # Sorted
+        self.entries = {}  # name -> (kind, size, mtime_ns)
+
+
+class DirectoryIndex:
+    # size_of(path, stat_result) gives the size shown for a file, so stored
+    # formats (deduplicated manifests) can report their logical size
+
+    def __init__(self, root, size_of=None):
+        self.root = root
+        self.size_of = size_of or (lambda path, st: st.st_size)
+        self.folders = {}  # relative folder path -> Folder
+        self.lock = threading.Lock()
+
+    def _entry(self, path, st):
+        if stat.S_ISDIR(st.st_mode):
+            return "dir", 0, st.st_mtime_ns
+        return "file", self.size_of(path, st), st.st_mtime_ns
+
+    def _folder(self, folder):
+        # Cached Folder, scanned again if something outside the server changed
+        # it. The scan runs without the lock so other listings and updates
+        # aren't held up by a large folder; only the swap into the cache is
+        # locked. A change during the scan moves the folder's mtime past the
+        # one stored here, so the next listing scans again.
+        path = os.path.join(self.root, folder)
+        st = os.stat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            raise NotADirectoryError(f"{folder} is not a folder")
+        mtime = st.st_mtime_ns
+        with self.lock:
+            cached = self.folders.get(folder)
+        if cached is not None and cached.mtime == mtime:
+            return cached
+        cached = Folder(mtime)
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    cached.entries[entry.name] = self._entry(entry.path, entry.stat())
+                except OSError:  # Removed while we were scanning
+                    continue
+        cached.names = sorted(cached.entries)
+        with self.lock:
+            self.folders[folder] = cached
+        return cached
+
+    def page(self, folder, cursor="", limit=1000):
+        # ([(name, kind, size, mtime), ...], next cursor or "" on the last page)
+        folder = relative(folder)
+        cached = self._folder(folder)
+        with self.lock:
+            start = bisect_right(cached.names, cursor) if cursor else 0
+            names = cached.names[start:start + limit]
+            entries = [(name,) + cached.entries[name] for name in names]
+            more = start + limit < len(cached.names)
+        return entries, names[-1] if more and names else ""
+
+    def _mtime(self, folder):
+        try:
+            return os.stat(os.path.join(self.root, folder)).st_mtime_ns
+        except OSError:
+            return None
+
+    @contextmanager
+    def changing(self, path):
+        # Wraps every change the server makes to path, so update() knows the
+        # folder's mtime from before it
+        path = relative(path)
+        before = self._mtime(os.path.dirname(path))
+        try:
+            yield
+        finally:
+            self.update(path, before)
+
+    def update(self, path, before):
+        # Refresh one path after the server created, replaced or removed it.
+        # before is the folder's mtime from just before that change: if the
+        # cached listing is older than that, the folder was also changed by
+        # someone else (another worker, a user on the host) and is dropped to
+        # be scanned again instead of patched.
+        path = relative(path)
+        if not path:
+            return
+        folder, name = os.path.split(path)
+        full_path = os.path.join(self.root, path)
+        after = self._mtime(folder)
+        with self.lock:
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                st = None
+            if st is None:
+                # Gone, and with it anything cached below it
+                prefix = path + os.sep
+                for cached in [key for key in self.folders if key == path or key.startswith(prefix)]:
+                    del self.folders[cached]
+            cached = self.folders.get(folder)
+            if cached is None:
+                return  # Never listed, the first DIR will scan it
+            if before is None or after is None or cached.mtime != before:
+                del self.folders[folder]
+                return
+            if st is None:
+                if cached.entries.pop(name, None) is not None:
+                    del cached.names[bisect_left(cached.names, name)]
+            else:
+                if name not in cached.entries:
+                    insort(cached.names, name)
+                cached.entries[name] = self._entry(full_path, st)
+            cached.mtime = after
@@ -0,0 +1,92 @@
+import mmap
+import threading
+from collections import OrderedDict
+
+# Shared read-only mappings of the most downloaded files.
+#
+# A file that is asked for min_hits times is mapped once with mmap and every
+# later download of it, from any connection, sends slices of that one
+# mapping instead of reading the file into its own buffer. Mappings are
+# kept in LRU order and the least recently used ones are dropped once the
+# mapped files add up to more than capacity bytes.
+#
+# Stored files are only ever replaced by renaming a new file over them (see
+# storage.py), so a mapped version never changes underneath us: a download
+# still sending from it finishes with the old contents, the next one sees
+# the new inode and maps that instead. Views handed out keep a dropped
+# mapping alive until the last one is released.
+
+MIN_HITS = 2  # Requests before a file is worth mapping
+MAX_TRACKED = 4096  # Files whose requests are counted before they are mapped
+
+
+class HotFile:
+    def __init__(self, data, version):
+        self.data = data  # mmap, or b"" for an empty file
+        self.version = version  # (inode, size, mtime_ns) of what was mapped
+        self.size = version[1]
+
+
+class HotFileCache:
+    def __init__(self, capacity, min_hits=MIN_HITS, max_file=None):
+        self.capacity = capacity
+        self.min_hits = min_hits
+        self.max_file = max_file or capacity // 4  # Larger files are never mapped
+        self.files = OrderedDict()  # path -> HotFile, least recently used first
+        self.requests = OrderedDict()  # path -> requests so far of files not mapped yet
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, f, st):
+        # Mapping of the version of path open as f (st is its fstat), None if
+        # the file isn't requested often enough to be cached
+        if not self.capacity or st.st_size > self.max_file:
+            return None
+        version = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            hot = self.files.get(path)
+            if hot is not None and hot.version == version:
+                self.files.move_to_end(path)
+                self.hits += 1
+                return hot.data
+            self.misses += 1
+            if hot is not None:
+                self._drop(path)  # Replaced since it was mapped
+            count = self.requests.pop(path, 0) + 1
+            if count < self.min_hits:
+                self.requests[path] = count
+                while len(self.requests) > MAX_TRACKED:
+                    self.requests.popitem(last=False)
+                return None
+        data = mmap.mmap(f.fileno(), st.st_size, access=mmap.ACCESS_READ) if st.st_size else b""
+        with self.lock:
+            if path in self.files:
+                self._drop(path)  # Mapped by another connection meanwhile
+            self.files[path] = HotFile(data, version)
+            self.used += st.st_size
+            while self.used > self.capacity:
+                self._drop(next(iter(self.files)))
+        return data
+
+    def invalidate(self, path):
+        # Drop the mapping of a file that was replaced or deleted, so the old
+        # version's disk space is freed once its last download is done
+        with self.lock:
+            if path in self.files:
+                self._drop(path)
+            self.requests.pop(path, None)
+
+    def _drop(self, path):
+        self.used -= self.files.pop(path).size
+
+    def summary(self):
+        with self.lock:
+            return {
+                "capacity": self.capacity,
+                "used": self.used,
+                "files": len(self.files),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,59 @@
+import os
+import json
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Live metrics endpoint.
+#
+# A small HTTP server on its own thread that answers GET /metrics with a JSON
+# snapshot of the running server, so a load test can be watched while it
+# runs. It listens on a local TCP port or on a Unix socket
+# (curl --unix-socket <path> http://localhost/metrics). The snapshot itself
+# comes from a callable the file server passes in, this module only serves it.
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.snapshot(), indent=2).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # A scrape every second would drown out the server's own log
+
+
+class UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix sockets have no peer address, the handler expects a (host, port)
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+def start(snapshot, port=None, path=None, host="127.0.0.1"):
+    # Serve snapshot() on a Unix socket at path, or else on host:port
+    if path:
+        if os.path.exists(path):
+            os.remove(path)  # Left behind by a server that didn't shut down cleanly
+        server = UnixMetricsServer(path, MetricsHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+    server.snapshot = snapshot
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+    if isinstance(server, UnixMetricsServer) and os.path.exists(server.server_address):
+        os.remove(server.server_address)
@@ -1,58 +1,426 @@
-import time
-import pandas as pd
-
-class NetworkStats:
-    def __init__(self):
-        self.stats = []  # Initialize an empty list to store stats
-
-    def record_upload(self, filename, filesize, start_time, end_time):
-        
-        ##Record statistics for an upload operation.
-        
-        rate_mb_s = filesize / (end_time - start_time) / (1024 * 1024)  # MB/s
-        self.stats.append({
-            "operation": "upload",
-            "filename": filename,
-            "filesize_bytes": filesize,
-            "rate_mb_s": rate_mb_s,
-            "time_s": end_time - start_time
-        })
-
-    def record_download(self, filename, filesize, start_time, end_time):
-        
-        ##Record statistics for a download operation.
-        
-        rate_mb_s = filesize / (end_time - start_time) / (1024 * 1024)  # MB/s
-        self.stats.append({
-            "operation": "download",
-            "filename": filename,
-            "filesize_bytes": filesize,
-            "rate_mb_s": rate_mb_s,
-            "time_s": end_time - start_time
-        })
-
-    def record_response_time(self, command, start_time, end_time, filename=None, filesize=None):
-        
-        ##Record response time for a specific command.
-        ##Optional parameters `filename` and `filesize` can provide additional context.
-        
-        response_time_ms = (end_time - start_time) * 1000  # ms
-        stat = {
-            "operation": "response",
-            "command": command,
-            "response_time_ms": response_time_ms,
-        }
-        if filename:
-            stat["filename"] = filename
-        if filesize:
-            stat["filesize_bytes"] = filesize
-        self.stats.append(stat)
-
-    def save_stats_to_csv(self, filepath):
-        
-        ##Save all recorded statistics to a CSV file.
-        
-        # Convert the stats list to a DataFrame and save it as a CSV
-        stats_df = pd.DataFrame(self.stats)
-        stats_df.to_csv(filepath, index=False)
-        print(f"[INFO] Stats saved to {filepath}")
+import os
+import csv
+import math
+import time
+import threading
+from array import array
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Stats can still go to CSV
+    pa = None
+
+CAPACITY = 65536  # Rows held in memory between flushes
+FLUSH_INTERVAL = 5.0  # Seconds between background flushes
+
+# Columns of the stats file, in order. Numeric columns live in preallocated
+# float arrays (NaN when a row has no value), the others in preallocated lists.
+NUMERIC = ("timestamp", "filesize_bytes", "wire_bytes", "rate_mb_s", "time_s", "response_time_ms")
+TEXT = ("operation", "command", "filename", "stream", "transfer_path", "compression")
+COLUMNS = ("timestamp", "operation", "command", "filename", "stream", "filesize_bytes", "wire_bytes",
+           "rate_mb_s", "time_s", "response_time_ms", "transfer_path", "compression")
+
+
+class LatencyHistogram:
+
+    ##Streaming latency histogram in the style of HdrHistogram. Values are
+    ##counted in microseconds in log-linear buckets: one per microsecond up to
+    ##64, then 32 per power of two, so any percentile is within about 3% of the
+    ##exact value and the histogram never grows past BUCKETS counters.
+
+    LINEAR = 64
+    PER_OCTAVE = 32
+    OCTAVES = 36  # Up to 2^42 us, about 50 days
+    BUCKETS = LINEAR + OCTAVES * PER_OCTAVE
+
+    def __init__(self):
+        self.counts = array("q", bytes(8 * self.BUCKETS))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+
+    def _index(self, value):
+        if value < self.LINEAR:
+            return value
+        shift = value.bit_length() - 6
+        index = self.LINEAR + (shift - 1) * self.PER_OCTAVE + (value >> shift) - self.PER_OCTAVE
+        return min(index, self.BUCKETS - 1)
+
+    def _value(self, index):
+        ##Middle of a bucket, in microseconds
+        if index < self.LINEAR:
+            return index
+        shift = (index - self.LINEAR) // self.PER_OCTAVE + 1
+        top = (index - self.LINEAR) % self.PER_OCTAVE + self.PER_OCTAVE
+        return (top << shift) + (1 << shift) // 2
+
+    def record(self, seconds):
+        value = max(int(seconds * 1_000_000), 0)
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        ##Add the samples of another histogram, e.g. one from another process
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        ##Latency in milliseconds that `fraction` of the samples don't exceed
+        if not self.count:
+            return 0.0
+        rank = max(math.ceil(fraction * self.count), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._value(index), self.max) / 1000
+        return self.max / 1000
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p99_ms": self.percentile(0.99),
+            "p999_ms": self.percentile(0.999),
+            "max_ms": self.max / 1000,
+        }
+
+
+class RateWindow:
+
+    ##Events (or bytes) per second over the last `window` seconds, counted in
+    ##one slot per second so it costs the same however busy the server is.
+
+    def __init__(self, window=60):
+        self.window = window
+        self.amounts = array("d", bytes(8 * window))
+        self.seconds = array("q", bytes(8 * window))  # Which second each slot holds
+
+    def add(self, now, amount=1):
+        second = int(now)
+        slot = second % self.window
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.amounts[slot] = 0
+        self.amounts[slot] += amount
+
+    def rate(self, now):
+        second = int(now)
+        total = sum(amount for amount, when in zip(self.amounts, self.seconds) if second - when < self.window)
+        return total / self.window
+
+
+class NetworkStats:
+    def __init__(self, capacity=CAPACITY, flush_interval=FLUSH_INTERVAL):
+
+        ##Rows go into a ring buffer of `capacity` rows that a background thread
+        ##appends to the stats file every `flush_interval` seconds (or sooner
+        ##when the buffer is half full). If the writer falls a whole buffer
+        ##behind, the oldest rows are overwritten and counted in `dropped`.
+
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.columns = {name: array("d", [math.nan]) * capacity for name in NUMERIC}
+        self.columns.update({name: [None] * capacity for name in TEXT})
+        self.written = 0  # Rows recorded so far
+        self.flushed = 0  # Rows handed to the writer so far
+        self.dropped = 0
+        self.latency = {}  # command -> LatencyHistogram
+        self.rates = {}  # command -> RateWindow of requests
+        self.transferred = {"upload": RateWindow(), "download": RateWindow()}  # File bytes
+        self.lock = threading.Lock()  # Guards the buffer and the histograms
+        self.write_lock = threading.Lock()  # One flush at a time
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.path = None
+
+    def start(self, filepath):
+
+        ##Start appending to `filepath`, Parquet if it ends in .parquet
+        ##(needs pyarrow) and CSV otherwise.
+
+        if filepath.endswith(".parquet") and pa is None:
+            filepath = filepath[:-len(".parquet")] + ".csv"
+            print(f"[WARNING] pyarrow is not installed, writing stats to {filepath} instead.")
+        self.path = filepath
+        if filepath.endswith(".parquet"):
+            self._parquet_folder(filepath)
+        elif os.path.exists(filepath):
+            with open(filepath, newline="") as f:
+                header = f.readline().strip()
+            if header and header != ",".join(COLUMNS):
+                self._migrate(filepath)
+        self.thread = threading.Thread(target=self._run, name="stats-writer", daemon=True)
+        self.thread.start()
+
+    def _parquet_folder(self, filepath):
+
+        ##Parquet stats are a folder of part files, one per flush, read back
+        ##together as one dataset. A single file from an older version becomes
+        ##the first part.
+
+        if os.path.isfile(filepath):
+            os.replace(filepath, filepath + ".tmp")
+            os.makedirs(filepath)
+            os.replace(filepath + ".tmp", os.path.join(filepath, "part-0.parquet"))
+        os.makedirs(filepath, exist_ok=True)
+
+    def _migrate(self, filepath):
+
+        ##Rewrite a stats file from an older version, which had its own set of
+        ##columns, with the current columns so new rows can be appended to it.
+
+        with open(filepath, newline="") as f:
+            rows = list(csv.DictReader(f))
+        with open(filepath + ".tmp", "w", newline="") as f:
+            writer = csv.DictWriter(f, COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(filepath + ".tmp", filepath)
+
+    def _run(self):
+        while not self.stopping:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"[ERROR] Could not write stats: {e}")
+
+    def _record(self, row, command=None, seconds=None, direction=None):
+
+        ##Store one row, time it under `command` in the latency histograms and
+        ##count its bytes towards the `direction` ("upload" or "download")
+        ##throughput. Only touches preallocated memory, so handlers never wait
+        ##on disk.
+
+        now = time.monotonic()
+        with self.lock:
+            slot = self.written % self.capacity
+            for name, column in self.columns.items():
+                column[slot] = row.get(name, math.nan if name in NUMERIC else None)
+            self.written += 1
+            if command is not None:
+                histogram = self.latency.get(command)
+                if histogram is None:
+                    histogram = self.latency[command] = LatencyHistogram()
+                histogram.record(seconds)
+                rate = self.rates.get(command)
+                if rate is None:
+                    rate = self.rates[command] = RateWindow()
+                rate.add(now)
+            if direction in self.transferred:
+                self.transferred[direction].add(now, row["filesize_bytes"])
+            backlog = self.written - self.flushed
+        if backlog >= self.capacity // 2:
+            self.wake.set()
+
+    def record_upload(self, filename, filesize, start_time, end_time, wire_bytes=None, compression=None):
+
+        ##Record statistics for an upload operation.
+        ##`wire_bytes` is what actually crossed the network when it differs from
+        ##`filesize` (compressed transfers), `compression` names the codec.
+
+        rate_mb_s = filesize / (end_time - start_time) / (1024 * 1024)  # MB/s
+        stat = {
+            "operation": "upload",
+            "filename": filename,
+            "filesize_bytes": filesize,
+            "rate_mb_s": rate_mb_s,
+            "time_s": end_time - start_time
+        }
+        self._add_wire(stat, filesize, wire_bytes, compression)
+        self._record(stat, "UPLOAD", end_time - start_time, "upload")
+
+    def record_download(self, filename, filesize, start_time, end_time, transfer_path=None,
+                        wire_bytes=None, compression=None):
+
+        ##Record statistics for a download operation.
+        ##`transfer_path` records how the bytes were sent ("sendfile" or "buffered").
+
+        rate_mb_s = filesize / (end_time - start_time) / (1024 * 1024)  # MB/s
+        stat = {
+            "operation": "download",
+            "filename": filename,
+            "filesize_bytes": filesize,
+            "rate_mb_s": rate_mb_s,
+            "time_s": end_time - start_time
+        }
+        if transfer_path:
+            stat["transfer_path"] = transfer_path
+        self._add_wire(stat, filesize, wire_bytes, compression)
+        self._record(stat, "DOWNLOAD", end_time - start_time, "download")
+
+    def record_stream(self, operation, filename, stream, nbytes, start_time, end_time,
+                      wire_bytes=None, compression=None):
+
+        ##Record throughput for one stream of a parallel (multi-connection) transfer.
+
+        elapsed = end_time - start_time
+        stat = {
+            "operation": f"{operation}_stream",
+            "filename": filename,
+            "stream": stream,
+            "filesize_bytes": nbytes,
+            "rate_mb_s": nbytes / elapsed / (1024 * 1024) if elapsed > 0 else 0.0,
+            "time_s": elapsed
+        }
+        self._add_wire(stat, nbytes, wire_bytes, compression)
+        self._record(stat, direction=operation)
+
+    def _add_wire(self, stat, logical_bytes, wire_bytes, compression):
+
+        ##Bytes on the wire next to the logical (file) bytes, so the CSV shows
+        ##the effective speedup of compression as filesize_bytes / wire_bytes.
+
+        stat["timestamp"] = time.time()
+        stat["wire_bytes"] = logical_bytes if wire_bytes is None else wire_bytes
+        if compression:
+            stat["compression"] = compression
+
+    def record_response_time(self, command, start_time, end_time, filename=None, filesize=None):
+
+        ##Record response time for a specific command.
+        ##Optional parameters `filename` and `filesize` can provide additional context.
+
+        response_time_ms = (end_time - start_time) * 1000  # ms
+        stat = {
+            "timestamp": time.time(),
+            "operation": "response",
+            "command": command,
+            "response_time_ms": response_time_ms,
+        }
+        if filename:
+            stat["filename"] = filename
+        if filesize:
+            stat["filesize_bytes"] = filesize
+        self._record(stat, command, end_time - start_time)
+
+    def latency_summary(self):
+
+        ##{command: {"count", "mean_ms", "p50_ms", "p99_ms", "p999_ms", "max_ms", "rate_per_s"}},
+        ##the rate being requests per second over the last minute
+
+        now = time.monotonic()
+        with self.lock:
+            return {command: dict(histogram.summary(), rate_per_s=self.rates[command].rate(now))
+                    for command, histogram in sorted(self.latency.items())}
+
+    def histograms(self):
+
+        ##Copies of the per-command latency histograms, for merging with those
+        ##of other worker processes
+
+        with self.lock:
+            copies = {}
+            for command, histogram in self.latency.items():
+                copies[command] = LatencyHistogram()
+                copies[command].merge(histogram)
+            return copies
+
+    def throughput(self):
+
+        ##File bytes per second uploaded and downloaded over the last minute, in MB/s
+
+        now = time.monotonic()
+        with self.lock:
+            return {f"{direction}_mb_s": rate.rate(now) / (1024 * 1024)
+                    for direction, rate in self.transferred.items()}
+
+    def _drain(self):
+
+        ##Columns of the rows recorded since the last flush, oldest first
+
+        with self.lock:
+            end = self.written
+            start = max(self.flushed, end - self.capacity)
+            self.dropped += start - self.flushed
+            self.flushed = end
+            first, count = start % self.capacity, end - start
+            columns = {}
+            for name, column in self.columns.items():
+                if first + count <= self.capacity:
+                    columns[name] = column[first:first + count]
+                else:
+                    columns[name] = column[first:] + column[:first + count - self.capacity]
+        return columns, count
+
+    def flush(self):
+
+        ##Append everything recorded since the last flush to the stats file and
+        ##rewrite the latency percentiles next to it.
+
+        if self.path is None:
+            return
+        with self.write_lock:
+            columns, count = self._drain()
+            if count:
+                if self.path.endswith(".parquet"):
+                    self._write_parquet(columns)
+                else:
+                    self._write_csv(columns, count)
+            self._write_latency()
+
+    def _write_csv(self, columns, count):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(COLUMNS)
+            cells = [[("" if value is None or value != value else value) for value in columns[name]]
+                     for name in COLUMNS]
+            writer.writerows(zip(*cells))
+
+    def _write_parquet(self, columns):
+        # Each flush is a complete file of its own, written aside and renamed
+        # in, so a crash never leaves a part without its footer
+        table = pa.table({name: pa.array(list(columns[name]), type=pa.float64(), from_pandas=True)
+                          if name in NUMERIC else pa.array(columns[name], type=pa.string())
+                          for name in COLUMNS})
+        name = f"part-{time.time_ns()}-{os.getpid()}.parquet"
+        temporary = os.path.join(self.path, "." + name)  # Skipped by dataset readers
+        pq.write_table(table, temporary)
+        os.replace(temporary, os.path.join(self.path, name))
+
+    def _write_latency(self):
+        summary = self.latency_summary()
+        if not summary:
+            return
+        path = os.path.splitext(self.path)[0] + "_latency.csv"
+        with open(path + ".tmp", "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["command"] + list(next(iter(summary.values()))))
+            for command, values in summary.items():
+                writer.writerow([command] + [round(value, 3) for value in values.values()])
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+
+        ##Stop the writer thread and flush what is left.
+
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        if self.dropped:
+            print(f"[WARNING] {self.dropped} stats rows were dropped because the writer fell behind.")
+
+    def save_stats_to_csv(self, filepath):
+
+        ##Flush all recorded statistics to `filepath` and stop background writing.
+
+        if self.path is None:
+            self.path = filepath
+        self.close()
+        print(f"[INFO] Stats saved to {self.path}")
@@ -0,0 +1,707 @@
+import os
+import time
+import socket
+import struct
+from collections import namedtuple
+
+from compression import BLOCK_SIZE
+
+# Binary framing shared by client.py and server.py.
+#
+# Every message on the wire is a frame: a fixed 16 byte header followed by
+# `length` bytes of payload. The header carries everything needed to route
+# the frame (version, opcode, flags, request id) so control frames can be
+# dispatched without decoding their payload as text, and the explicit length
+# means TCP is free to split or coalesce segments without losing or merging
+# messages.
+
+PROTOCOL_VERSION = 1
+FORMAT = "utf-8"
+SIZE = 1024  # Socket read size for control frames
+DEFAULT_BUFFER_SIZE = 256 * 1024  # Transfer buffer for file bodies
+
+# version (B), opcode (B), flags (H), request id (I), payload length (Q)
+HEADER = struct.Struct("!BBHIQ")
+HEADER_SIZE = HEADER.size
+
+# Largest payload we are willing to buffer for a single control frame.
+# File contents never go through this limit, they are streamed as DATA frames.
+MAX_CONTROL_PAYLOAD = 1024 * 1024
+
+# Client requests
+OP_AUTH = 0x01
+OP_LOGOUT = 0x02
+OP_UPLOAD = 0x03
+OP_DOWNLOAD = 0x04
+OP_DIR = 0x05
+OP_CREATE = 0x06
+OP_DELETE = 0x07
+OP_CONFIRM = 0x08  # Answer to an OP_EXISTS prompt ("yes"/"no")
+OP_UPLOAD_OPEN = 0x09  # Start or resume a chunked upload, replies with a transfer id
+OP_UPLOAD_RANGE = 0x0A  # One checksummed chunk of a chunked upload, on any connection
+OP_CHECKSUM = 0x0B  # SHA-256 of a byte range of a stored file
+OP_DEDUP_OPEN = 0x0C  # Chunk list of a file, server answers with the chunks it lacks
+OP_CHUNK_PUT = 0x0D  # One missing chunk, no reply
+OP_DEDUP_COMMIT = 0x0E  # Publish the file once all its chunks are stored
+OP_SYNC = 0x0F  # Replace a stored file from a delta against its block signatures
+OP_STAT = 0x10  # Type, size and mtime of a path
+OP_BATCH = 0x11  # Many CREATE/DELETE/STAT operations in one request
+OP_RESUME = 0x12  # Log in with a session token from an earlier AUTH instead of the password
+OP_REVOKE = 0x13  # Invalidate this connection's session token, or all of the user's
+OP_TREE_UPLOAD = 0x14  # A whole folder as one archive stream, see archive.py
+OP_TREE_DOWNLOAD = 0x15
+OP_TREE_DELETE = 0x16  # A folder and everything in it
+
+# Server replies
+OP_OK = 0x80
+OP_ERROR = 0x81
+OP_EXISTS = 0x82  # Upload target exists, server waits for OP_CONFIRM
+
+# File contents. A body is one or more DATA frames, the last one has FLAG_END set.
+OP_DATA = 0x90
+
+FLAG_END = 0x0001
+FLAG_COMPRESSED = 0x0002  # DATA frame holding one compressed block, see compression.py
+FLAG_ENCRYPTED = 0x0004  # DATA frame sealed with the connection's cipher, see aead.py
+
+# Optional server features, advertised in the welcome frame after the banner
+CAP_DEDUP = "dedup"
+
+COMMAND_NAMES = {
+    OP_AUTH: "AUTH",
+    OP_LOGOUT: "LOGOUT",
+    OP_UPLOAD: "UPLOAD",
+    OP_DOWNLOAD: "DOWNLOAD",
+    OP_DIR: "DIR",
+    OP_CREATE: "CREATE",
+    OP_DELETE: "DELETE",
+    OP_CONFIRM: "CONFIRM",
+    OP_UPLOAD_OPEN: "UPLOAD_OPEN",
+    OP_UPLOAD_RANGE: "UPLOAD_RANGE",
+    OP_CHECKSUM: "CHECKSUM",
+    OP_DEDUP_OPEN: "DEDUP_OPEN",
+    OP_CHUNK_PUT: "CHUNK_PUT",
+    OP_DEDUP_COMMIT: "DEDUP_COMMIT",
+    OP_SYNC: "SYNC",
+    OP_STAT: "STAT",
+    OP_BATCH: "BATCH",
+    OP_RESUME: "RESUME",
+    OP_REVOKE: "REVOKE",
+    OP_TREE_UPLOAD: "TREE_UPLOAD",
+    OP_TREE_DOWNLOAD: "TREE_DOWNLOAD",
+    OP_TREE_DELETE: "TREE_DELETE",
+}
+COMMANDS = {name: opcode for opcode, name in COMMAND_NAMES.items()}
+
+Frame = namedtuple("Frame", ["opcode", "flags", "request_id", "payload"])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_header(opcode, length, flags=0, request_id=0):
+    return HEADER.pack(PROTOCOL_VERSION, opcode, flags, request_id, length)
+
+
+def encode_frame(opcode, payload=b"", flags=0, request_id=0):
+    if isinstance(payload, str):
+        payload = payload.encode(FORMAT)
+    return encode_header(opcode, len(payload), flags, request_id) + payload
+
+
+def pack_fields(*fields):
+    # Control payloads are a list of text fields separated by NUL bytes
+    return b"\x00".join(str(field).encode(FORMAT) for field in fields)
+
+
+def unpack_fields(payload):
+    if not payload:
+        return []
+    return bytes(payload).decode(FORMAT).split("\x00")
+
+
+def parse_header(header):
+    version, opcode, flags, request_id, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    return opcode, flags, request_id, length
+
+
+def parse_size(text):
+    # "262144", "256K", "4M" -> bytes, for command line options
+    text = str(text).strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def etag(size, mtime_ns):
+    # Version tag of a stored file, sent with DOWNLOAD. A client that gives
+    # its copy the server's mtime can work out the same tag from its own stat.
+    return f"{size:x}-{mtime_ns:x}"
+
+
+def tune_socket(sock, buffer_size=DEFAULT_BUFFER_SIZE):
+    # Kernel socket buffers sized like our transfer buffer, and no Nagle delay
+    # for the small control frames
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def bounded_writer(buffer, limit):
+    # write() callback collecting a body into buffer, at most limit bytes
+    def write(data):
+        if len(buffer) + len(data) > limit:
+            raise ProtocolError(f"Body larger than {limit} bytes")
+        buffer.extend(data)
+    return write
+
+
+def file_range(f, offset, count):
+    # Clamp a requested (offset, count) to the size of the open file
+    filesize = os.fstat(f.fileno()).st_size
+    if offset < 0 or offset > filesize:
+        raise ValueError(f"Offset {offset} outside file of {filesize} bytes")
+    if count is None or count > filesize - offset:
+        count = filesize - offset
+    return count
+
+
+def read_file_range(f, offset, count, buffer_size=DEFAULT_BUFFER_SIZE):
+    # Yield views of one preallocated buffer covering f[offset:offset + count]
+    buffer = bytearray(max(1, min(buffer_size, count)))
+    view = memoryview(buffer)
+    f.seek(offset)
+    remaining = count
+    while remaining > 0:
+        n = f.readinto(view[:min(len(buffer), remaining)])
+        if not n:
+            raise ProtocolError("File shrank during transfer")
+        yield view[:n]
+        remaining -= n
+
+
+def decode_payload(cipher, decompressor, flags, request_id, payload):
+    # Undo encryption, then compression, of one DATA frame payload
+    if flags & FLAG_ENCRYPTED:
+        if cipher is None:
+            raise ProtocolError("Encrypted frame on a connection without a cipher")
+        try:
+            payload = cipher.open(OP_DATA, flags, request_id, payload)
+        except ValueError as e:
+            raise ProtocolError(str(e))
+    elif cipher is not None:
+        # Otherwise an attacker could simply strip the encryption
+        raise ProtocolError("Unencrypted frame on an encrypted connection")
+    if flags & FLAG_COMPRESSED:
+        if decompressor is None:
+            raise ProtocolError("Compressed frame in a body that wasn't negotiated as compressed")
+        try:
+            return decompressor.decode(bytes(payload))
+        except ValueError as e:
+            raise ProtocolError(f"Corrupt compressed frame: {e}")
+    if decompressor is not None:
+        decompressor.passthrough(len(payload))
+    return payload
+
+
+def encoded_frames(blocks, count, request_id=0, end=True, compressor=None, cipher=None):
+    # Encoded DATA frames, one per block of a body of `count` bytes, each
+    # compressed and/or sealed on its own
+    sent = 0
+    for view in blocks if count else [b""]:
+        sent += len(view)
+        flags = FLAG_END if end and sent == count else 0
+        payload = view
+        if compressor is not None:
+            payload, compressed = compressor.encode(view)
+            flags |= FLAG_COMPRESSED if compressed else 0
+        if cipher is not None:
+            flags |= FLAG_ENCRYPTED
+            payload = cipher.seal(OP_DATA, flags, request_id, payload)
+        yield encode_frame(OP_DATA, payload, flags, request_id)
+
+
+def split_blocks(data, size):
+    view = memoryview(data)
+    return (view[start:start + size] for start in range(0, len(view), size))
+
+
+class FrameDecoder:
+    # Incremental decoder: feed it whatever recv() returned and pull complete
+    # frames out. Bytes that belong to the next frame stay in the buffer.
+
+    def __init__(self, max_payload=MAX_CONTROL_PAYLOAD):
+        self.max_payload = max_payload
+        self.buffer = bytearray()
+        self.pos = 0  # Start of unread data in self.buffer
+
+    def feed(self, data):
+        # Drop consumed bytes once they make up most of the buffer so pipelined
+        # frames don't cost a memmove each
+        if self.pos and self.pos >= len(self.buffer) // 2:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        self.buffer += data
+
+    def buffered(self):
+        return len(self.buffer) - self.pos
+
+    def next_header(self):
+        # Consume and return (opcode, flags, request_id, length), payload is left
+        # in the buffer for the caller to stream with take()
+        if self.buffered() < HEADER_SIZE:
+            return None
+        header = parse_header(self.buffer[self.pos:self.pos + HEADER_SIZE])
+        self.pos += HEADER_SIZE
+        return header
+
+    def next_frame(self):
+        # Return the next complete frame, or None if more bytes are needed
+        if self.buffered() < HEADER_SIZE:
+            return None
+        opcode, flags, request_id, length = parse_header(
+            self.buffer[self.pos:self.pos + HEADER_SIZE])
+        if length > self.max_payload:
+            raise ProtocolError(f"Control frame too large ({length} bytes)")
+        end = self.pos + HEADER_SIZE + length
+        if len(self.buffer) < end:
+            return None
+        payload = bytes(self.buffer[self.pos + HEADER_SIZE:end])
+        self.pos = end
+        return Frame(opcode, flags, request_id, payload)
+
+    def take(self, n):
+        # Return up to n already-buffered bytes
+        n = min(n, self.buffered())
+        data = bytes(self.buffer[self.pos:self.pos + n])
+        self.pos += n
+        return data
+
+
+class FrameSocket:
+    # Blocking frame reader/writer around a connected socket
+
+    def __init__(self, sock, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.buffer_size = buffer_size
+        self._view = None
+        self.cipher = None  # Seals DATA payloads once set, see aead.py
+        self.throttle = None  # Paces DATA bodies once set, see ratelimit.py
+        self.bytes_in = 0  # Bytes received and sent on the socket, for metrics
+        self.bytes_out = 0
+        self.throttled = 0.0  # Seconds spent waiting on the throttle
+        self.credit = 0  # Body bytes already paid for
+
+    @property
+    def view(self):
+        # Transfer buffer, only allocated once the connection moves file data
+        # so idle connections stay small
+        if self._view is None:
+            self._view = memoryview(bytearray(self.buffer_size))
+        return self._view
+
+    def _fill(self):
+        data = self.sock.recv(SIZE)
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+        self.bytes_in += len(data)
+        self.decoder.feed(data)
+
+    def _send(self, data):
+        self.sock.sendall(data)
+        self.bytes_out += len(data)
+
+    def _pace(self, amount):
+        # Wait until the throttle lets amount more body bytes through.
+        # Control frames never come here. Bytes are paid for a whole buffer
+        # at a time so concurrent transfers take equal turns whatever the
+        # size of their frames.
+        if self.throttle is None:
+            return
+        self.credit -= amount
+        while self.credit < 0:
+            delay = self.throttle(self.buffer_size)
+            self.credit += self.buffer_size
+            if delay > 0:
+                self.throttled += delay
+                time.sleep(delay)
+
+    def _slices(self, count):
+        # (start, length) pieces of a body to pace one at a time, a single
+        # piece when nothing is throttled
+        step = self.buffer_size if self.throttle is not None else max(count, 1)
+        return ((start, min(step, count - start)) for start in range(0, count, step))
+
+    def send_frame(self, opcode, payload=b"", flags=0, request_id=0):
+        self._send(encode_frame(opcode, payload, flags, request_id))
+
+    def recv_frame(self):
+        # Returns None if the peer closed the connection between frames
+        while (frame := self.decoder.next_frame()) is None:
+            data = self.sock.recv(SIZE)
+            if not data:
+                if self.decoder.buffered():
+                    raise ConnectionError("Connection closed mid-frame")
+                return None
+            self.bytes_in += len(data)
+            self.decoder.feed(data)
+        return frame
+
+    def recv_header(self):
+        while (header := self.decoder.next_header()) is None:
+            self._fill()
+        return header
+
+    def recv_payload(self, length, write):
+        # Stream `length` payload bytes to write(), leftovers from the decoder
+        # first. The rest is received with recv_into straight into the
+        # preallocated transfer buffer and handed to write() once the buffer is
+        # full, so the loop doesn't allocate and disk writes are batched.
+        # write() gets a memoryview that is only valid until it returns.
+        remaining = length
+        if self.decoder.buffered():
+            chunk = self.decoder.take(remaining)
+            write(chunk)
+            remaining -= len(chunk)
+        view = self.view
+        size = len(view)
+        filled = 0
+        while remaining > 0:
+            n = self.sock.recv_into(view[filled:filled + min(size - filled, remaining)])
+            if not n:
+                raise ConnectionError("Connection closed mid-transfer")
+            self.bytes_in += n
+            self._pace(n)
+            filled += n
+            remaining -= n
+            if filled == size or remaining == 0:
+                write(view[:filled])
+                filled = 0
+
+    def send_file(self, f, offset=0, count=None, request_id=0, zero_copy=True, end=True, compressor=None):
+        # Send `count` bytes of f starting at `offset` as a single DATA frame,
+        # the last of the body unless end is False. With zero_copy the kernel
+        # moves the bytes straight from the page cache to the socket
+        # (os.sendfile), otherwise they go through one reused userspace
+        # buffer. With a compressor or a cipher the bytes go out as one frame
+        # per block instead. Returns the path that was used so callers can
+        # record it.
+        count = file_range(f, offset, count)
+        if compressor is not None or self.cipher is not None:
+            for frame in encoded_frames(self._blocks(f, offset, count, compressor), count, request_id, end,
+                                        compressor, self.cipher):
+                self._pace(len(frame))
+                self._send(frame)
+            return "buffered"
+        self._send(encode_header(OP_DATA, count, FLAG_END if end else 0, request_id))
+        if zero_copy and hasattr(os, "sendfile"):
+            sent = 0
+            for start, length in self._slices(count):
+                self._pace(length)
+                sent += self.sock.sendfile(f, offset + start, length)
+            self.bytes_out += sent
+            if sent != count:
+                raise ProtocolError("File shrank during transfer")
+            return "sendfile"
+        for view in read_file_range(f, offset, count, self.buffer_size):
+            self._pace(len(view))
+            self._send(view)
+        return "buffered"
+
+    def send_buffer(self, data, offset=0, count=None, request_id=0, end=True, compressor=None):
+        # send_file() for a file already in memory, such as a cached mmap.
+        # Frames are sliced straight out of data, nothing is copied into the
+        # transfer buffer.
+        view = memoryview(data)[offset:offset + count if count is not None else None]
+        count = len(view)
+        if compressor is not None or self.cipher is not None:
+            for frame in encoded_frames(split_blocks(view, self._block_size(compressor)), count, request_id, end,
+                                        compressor, self.cipher):
+                self._pace(len(frame))
+                self._send(frame)
+            return "mmap"
+        self._send(encode_header(OP_DATA, count, FLAG_END if end else 0, request_id))
+        for start in range(0, count, self.buffer_size):
+            piece = view[start:start + self.buffer_size]
+            self._pace(len(piece))
+            self._send(piece)
+        return "mmap"
+
+    def send_bytes(self, data, request_id=0, end=True):
+        # Send in-memory data as one DATA frame, the last of the body unless
+        # end is False. Encrypted connections split it into cipher chunks.
+        self._pace(len(data))
+        if self.cipher is None:
+            self._send(encode_frame(OP_DATA, data, FLAG_END if end else 0, request_id))
+            return
+        for frame in encoded_frames(split_blocks(data, self.cipher.chunk_size), len(data), request_id, end,
+                                    cipher=self.cipher):
+            self._send(frame)
+
+    def set_cipher(self, cipher):
+        # Seal every DATA frame from now on, in both directions
+        self.cipher = cipher
+
+    def call(self, func, *args):
+        # Run disk or CPU heavy work of a handler. A blocking connection
+        # simply runs it, the asyncio stream moves it off the event loop.
+        return func(*args)
+
+    def set_throttle(self, throttle):
+        # throttle(amount) returns the seconds to wait before moving amount
+        # more body bytes, None turns pacing off
+        self.throttle = throttle
+
+    def _block_size(self, compressor):
+        # Compressed blocks stay small enough for any receiver to inflate,
+        # encrypted ones are as large as the cipher's chunk size
+        return BLOCK_SIZE if compressor is not None or self.cipher is None else self.cipher.chunk_size
+
+    def _blocks(self, f, offset, count, compressor):
+        return read_file_range(f, offset, count, self._block_size(compressor))
+
+    def _transformed(self, flags):
+        # Whether a DATA frame has to be read whole and decoded
+        return flags & (FLAG_COMPRESSED | FLAG_ENCRYPTED) or self.cipher is not None
+
+    def _payload_limit(self, flags):
+        return self.cipher.max_frame if flags & FLAG_ENCRYPTED and self.cipher else MAX_CONTROL_PAYLOAD
+
+    def recv_bytes(self, limit):
+        # Read a whole body into memory, refusing bodies larger than limit
+        data = bytearray()
+        self.recv_body(bounded_writer(data, limit))
+        return bytes(data)
+
+    def recv_body(self, write, decompressor=None):
+        # Read DATA frames until FLAG_END, returns the number of bytes written.
+        # Encrypted frames are opened and compressed frames inflated first,
+        # each on its own, so a bad frame is rejected as soon as it arrives.
+        total = 0
+        while True:
+            opcode, flags, request_id, length = self.recv_header()
+            if opcode != OP_DATA:
+                raise ProtocolError(f"Expected DATA frame, got opcode {opcode:#x}")
+            if self._transformed(flags):
+                packed = bytearray()
+                self.recv_payload(length, bounded_writer(packed, self._payload_limit(flags)))
+                data = decode_payload(self.cipher, decompressor, flags, request_id, packed)
+                write(data)
+                total += len(data)
+            else:
+                self.recv_payload(length, write)
+                total += length
+                if decompressor is not None:
+                    decompressor.passthrough(length)
+            if flags & FLAG_END:
+                return total
+
+
+class AsyncFrameStream:
+    # asyncio counterpart of FrameSocket with the same method names. Writes
+    # wait on drain() so a slow peer pushes back on the sender instead of
+    # growing the transport buffer, and reads are paced by the caller so the
+    # StreamReader pauses the socket when its buffer limit is reached.
+    # asyncio is imported where it is used: only the server's asyncio engine
+    # needs it, and it would double the startup time of every client.
+
+    def __init__(self, reader, writer, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.decoder = FrameDecoder()
+        self.buffer_size = buffer_size
+        self._view = None
+        self.cipher = None
+        self.throttle = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.throttled = 0.0
+        self.credit = 0
+
+    view = FrameSocket.view
+    _slices = FrameSocket._slices
+    _block_size = FrameSocket._block_size
+    _blocks = FrameSocket._blocks
+    _transformed = FrameSocket._transformed
+    _payload_limit = FrameSocket._payload_limit
+
+    async def _fill(self):
+        data = await self.reader.read(SIZE)
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+        self.bytes_in += len(data)
+        self.decoder.feed(data)
+
+    async def _send(self, data):
+        self.writer.write(data)
+        self.bytes_out += len(data)
+        await self.writer.drain()
+
+    async def _pace(self, amount):
+        if self.throttle is None:
+            return
+        self.credit -= amount
+        while self.credit < 0:
+            delay = self.throttle(self.buffer_size)
+            self.credit += self.buffer_size
+            if delay > 0:
+                import asyncio
+                self.throttled += delay
+                await asyncio.sleep(delay)
+
+    async def send_frame(self, opcode, payload=b"", flags=0, request_id=0):
+        await self._send(encode_frame(opcode, payload, flags, request_id))
+
+    async def recv_frame(self):
+        while (frame := self.decoder.next_frame()) is None:
+            data = await self.reader.read(SIZE)
+            if not data:
+                if self.decoder.buffered():
+                    raise ConnectionError("Connection closed mid-frame")
+                return None
+            self.bytes_in += len(data)
+            self.decoder.feed(data)
+        return frame
+
+    async def recv_header(self):
+        while (header := self.decoder.next_header()) is None:
+            await self._fill()
+        return header
+
+    async def _run(self, offload, func, *args):
+        return await self.call(func, *args) if offload else func(*args)
+
+    async def _produced(self, iterator):
+        # Items of a blocking iterator (file reads, compression, encryption),
+        # each one made on the executor
+        iterator = iter(iterator)
+        while (item := await self.call(next, iterator, None)) is not None:
+            yield item
+
+    async def recv_payload(self, length, write, offload=True):
+        # StreamReader has no readinto, so reads are copied into the transfer
+        # buffer and written out in the same batches as FrameSocket. write()
+        # runs on the executor unless offload is False, so a slow disk only
+        # holds up this connection.
+        remaining = length
+        if self.decoder.buffered():
+            chunk = self.decoder.take(remaining)
+            await self._run(offload, write, chunk)
+            remaining -= len(chunk)
+        view = self.view
+        size = len(view)
+        filled = 0
+        while remaining > 0:
+            chunk = await self.reader.read(min(size - filled, remaining))
+            if not chunk:
+                raise ConnectionError("Connection closed mid-transfer")
+            n = len(chunk)
+            self.bytes_in += n
+            await self._pace(n)
+            view[filled:filled + n] = chunk
+            filled += n
+            remaining -= n
+            if filled == size or remaining == 0:
+                await self._run(offload, write, view[:filled])
+                filled = 0
+
+    async def send_file(self, f, offset=0, count=None, request_id=0, zero_copy=True, end=True, compressor=None):
+        count = file_range(f, offset, count)
+        if compressor is not None or self.cipher is not None:
+            async for frame in self._produced(encoded_frames(self._blocks(f, offset, count, compressor), count,
+                                                             request_id, end, compressor, self.cipher)):
+                await self._pace(len(frame))
+                await self._send(frame)
+            return "buffered"
+        await self._send(encode_header(OP_DATA, count, FLAG_END if end else 0, request_id))
+        if zero_copy and hasattr(os, "sendfile"):
+            import asyncio
+            loop = asyncio.get_running_loop()
+            sent = 0
+            for start, length in self._slices(count):
+                await self._pace(length)
+                sent += await loop.sendfile(self.writer.transport, f, offset + start, length)
+            self.bytes_out += sent
+            if sent != count:
+                raise ProtocolError("File shrank during transfer")
+            return "sendfile"
+        async for view in self._produced(read_file_range(f, offset, count, self.buffer_size)):
+            # The transport may keep a reference to what we pass it, so hand
+            # over a copy rather than the reused buffer
+            await self._pace(len(view))
+            await self._send(bytes(view))
+        return "buffered"
+
+    async def send_buffer(self, data, offset=0, count=None, request_id=0, end=True, compressor=None):
+        # The transport may hold on to the slices until they are sent, which
+        # is fine for a mapping that never changes
+        view = memoryview(data)[offset:offset + count if count is not None else None]
+        count = len(view)
+        if compressor is not None or self.cipher is not None:
+            async for frame in self._produced(encoded_frames(split_blocks(view, self._block_size(compressor)), count,
+                                                             request_id, end, compressor, self.cipher)):
+                await self._pace(len(frame))
+                await self._send(frame)
+            return "mmap"
+        await self._send(encode_header(OP_DATA, count, FLAG_END if end else 0, request_id))
+        for start in range(0, count, self.buffer_size):
+            piece = view[start:start + self.buffer_size]
+            await self._pace(len(piece))
+            await self._send(piece)
+        return "mmap"
+
+    async def send_bytes(self, data, request_id=0, end=True):
+        await self._pace(len(data))
+        if self.cipher is None:
+            await self._send(encode_frame(OP_DATA, data, FLAG_END if end else 0, request_id))
+            return
+        for frame in encoded_frames(split_blocks(data, self.cipher.chunk_size), len(data), request_id, end,
+                                    cipher=self.cipher):
+            await self._send(frame)
+
+    async def set_cipher(self, cipher):
+        self.cipher = cipher
+
+    async def call(self, func, *args):
+        # On the loop's default executor, so other connections keep being
+        # served meanwhile
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def set_throttle(self, throttle):
+        self.throttle = throttle
+
+    async def recv_bytes(self, limit):
+        # Copied into memory on the loop, there is nothing to wait for
+        data = bytearray()
+        await self.recv_body(bounded_writer(data, limit), offload=False)
+        return bytes(data)
+
+    def _decode(self, decompressor, flags, request_id, packed, write):
+        data = decode_payload(self.cipher, decompressor, flags, request_id, packed)
+        write(data)
+        return len(data)
+
+    async def recv_body(self, write, decompressor=None, offload=True):
+        total = 0
+        while True:
+            opcode, flags, request_id, length = await self.recv_header()
+            if opcode != OP_DATA:
+                raise ProtocolError(f"Expected DATA frame, got opcode {opcode:#x}")
+            if self._transformed(flags):
+                packed = bytearray()
+                await self.recv_payload(length, bounded_writer(packed, self._payload_limit(flags)), offload=False)
+                total += await self._run(offload, self._decode, decompressor, flags, request_id, packed, write)
+            else:
+                await self.recv_payload(length, write, offload)
+                total += length
+                if decompressor is not None:
+                    decompressor.passthrough(length)
+            if flags & FLAG_END:
+                return total
@@ -0,0 +1,154 @@
+import time
+import threading
+
+# Bandwidth shaping for file transfers.
+#
+# File bodies (DATA frames) are paced by token buckets, one for all users
+# together and one per user, so a single large upload or download can't take
+# the whole link or disk. Control frames (DIR, STAT, CREATE replies and the
+# like) never wait on a bucket, which keeps interactive commands fast while
+# bulk transfers run.
+#
+# A transfer asks for its bytes one buffer at a time and is told how long to
+# wait before moving them. Buckets may go into debt, so requests are granted
+# in the order they arrive and concurrent transfers take turns buffer by
+# buffer. When a global rate is set, every user that moved data in the last
+# ACTIVE_WINDOW seconds gets an equal share of it, however many connections
+# they use.
+#
+# With --workers the limiter lives in the manager process and every call to
+# it is a blocking round trip, which the asyncio engine would make on its
+# event loop. Connections of a worker therefore lease LEASE_TIME worth of
+# their rate at once and spend it buffer by buffer without asking again.
+
+ACTIVE_WINDOW = 1.0  # Seconds after its last transfer a user still counts for the fair share
+LEASE_TIME = 0.1  # Seconds of a user's rate a connection takes at once from a shared limiter
+
+
+def throttle(limiter, username):
+    # Pacing callback for a connection of username, None if no limit applies.
+    # limiter may be a proxy to a BandwidthLimiter in another process (see
+    # workers.py), so the callback is built here rather than by the limiter.
+    if not limiter.limited(username):
+        return None
+    if not isinstance(limiter, BandwidthLimiter):
+        return Lease(limiter, username)
+    return lambda amount: limiter.delay(username, amount)
+
+
+class Lease:
+    # Pacing callback over a limiter in another process: bytes are taken from
+    # it in leases and handed out locally, the wait for a lease is served by
+    # the buffer that asked for it
+
+    def __init__(self, limiter, username):
+        self.limiter = limiter
+        self.username = username
+        self.tokens = 0  # Leased bytes not spent yet
+        self.leases = 0  # Calls made to the limiter, for tests
+
+    def __call__(self, amount):
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        granted, wait = self.limiter.lease(self.username, -self.tokens, LEASE_TIME)
+        self.tokens += granted
+        self.leases += 1
+        return wait
+
+
+class TokenBucket:
+    # Refills at rate bytes per second up to burst bytes
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate  # One second worth by default
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def take(self, amount, now):
+        # Seconds until the bucket will have covered amount, 0 if it already has
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthLimiter:
+    def __init__(self, rate=0, user_rate=0, user_rates=None):
+        self.lock = threading.Lock()
+        self.configure(rate, user_rate, user_rates)
+
+    def configure(self, rate=0, user_rate=0, user_rates=None):
+        # Bytes per second for everyone together, for each user unless
+        # user_rates has their own, 0 for no limit
+        with self.lock:
+            self.rate = rate
+            self.user_rate = user_rate
+            self.user_rates = dict(user_rates or {})
+            self.total = TokenBucket(rate) if rate else None
+            self.users = {}  # username -> TokenBucket
+            self.active = {}  # username -> when it last moved data
+
+    def limit_for(self, username):
+        return self.user_rates.get(username, self.user_rate)
+
+    def limited(self, username):
+        # Whether any limit applies to username's transfers
+        return bool(self.rate or self.limit_for(username))
+
+    def delay(self, username, amount):
+        # Seconds username has to wait before moving amount more bytes
+        now = time.monotonic()
+        with self.lock:
+            self.active[username] = now
+            wait = self.total.take(amount, now) if self.total else 0.0
+            rate = self._share(username, now)
+            if rate:
+                bucket = self.users.get(username)
+                if bucket is None:
+                    bucket = self.users[username] = TokenBucket(rate)
+                bucket.rate = bucket.burst = rate
+                wait = max(wait, bucket.take(amount, now))
+        return wait
+
+    def lease(self, username, amount, duration):
+        # At least amount bytes, or duration seconds worth of username's
+        # current rate if that is more, and the seconds to wait before moving
+        # them
+        now = time.monotonic()
+        with self.lock:
+            self.active[username] = now
+            rate = self._share(username, now) or self.rate
+        granted = max(amount, int(rate * duration))
+        return granted, self.delay(username, granted)
+
+    def _share(self, username, now):
+        # The user's own limit, capped at an equal part of the global rate.
+        # Bandwidth that users with a lower limit of their own leave unused
+        # is split among the others.
+        limit = self.limit_for(username)
+        if not self.rate:
+            return limit
+        for user, seen in list(self.active.items()):
+            if now - seen > ACTIVE_WINDOW:
+                del self.active[user]
+        remaining = self.rate
+        limits = sorted(self.limit_for(user) or self.rate for user in self.active)
+        for count, other in enumerate(limits):
+            fair = remaining / (len(limits) - count)
+            if other >= fair:
+                break
+            remaining -= other
+        return min(limit, fair) if limit else fair
+
+    def summary(self):
+        # Configured limits and the users currently sharing them, for metrics
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "user_rate": self.user_rate,
+                "user_rates": dict(self.user_rates),
+                "active_users": sorted(user for user, seen in self.active.items() if now - seen <= ACTIVE_WINDOW),
+            }
@@ -4,9 +4,34 @@ import threading
 import time  # To measure response time
 import hashlib
 import signal
+import secrets
+import argparse
+import asyncio
 
 from cryptography.fernet import Fernet
-from network_stats import NetworkStats
+import metrics
+import workers
+from network_stats import NetworkStats, LatencyHistogram
+from protocol import (FrameSocket, AsyncFrameStream, parse_size, tune_socket, pack_fields, unpack_fields, etag,
+                      COMMAND_NAMES,
+                      OP_AUTH, OP_LOGOUT, OP_UPLOAD, OP_DOWNLOAD, OP_DIR, OP_CREATE,
+                      OP_DELETE, OP_CONFIRM, OP_UPLOAD_OPEN, OP_UPLOAD_RANGE, OP_CHECKSUM,
+                      OP_DEDUP_OPEN, OP_CHUNK_PUT, OP_DEDUP_COMMIT, OP_SYNC, OP_STAT, OP_BATCH,
+                      OP_RESUME, OP_REVOKE, OP_TREE_UPLOAD, OP_TREE_DOWNLOAD, OP_TREE_DELETE,
+                      OP_OK, OP_ERROR, OP_EXISTS, CAP_DEDUP)
+from transfers import TransferRegistry, sha256_file
+from cas import ChunkStore, CHUNK_ENTRY, MANIFEST_MAGIC, MIN_CHUNK, is_manifest, read_manifest, write_manifest, \
+    stored_size, unpack_chunk_list, pack_indexes
+from aead import FrameCipher, NONCE_SIZE, DEFAULT_CHUNK_SIZE
+from aead import negotiate as negotiate_cipher
+from compression import Compressor, Decompressor, CODECS, negotiate
+from dirindex import DirectoryIndex
+from storage import Storage
+from hotcache import HotFileCache
+from tokens import TokenStore, DEFAULT_TTL
+from ratelimit import BandwidthLimiter, throttle
+from delta import Patcher, SIGNATURE, block_size_for, signatures
+import archive
 
 IP = "10.200.232.146" # Change to server IPv4
 PORT = 49157
@@ -14,10 +39,55 @@ ADDR = (IP,PORT)
 SIZE = 1024
 FORMAT = "utf-8"
 SERVER_PATH = "server_storage"  # Directory to store files
+STAGING_PATH = "server_staging"  # Uploads are assembled here, same filesystem as SERVER_PATH
+CHUNK_SIZE = 8 * 1024 * 1024  # Chunk size of resumable uploads if the client doesn't pick one
+MIN_CHUNK_SIZE = 64 * 1024  # Chunk sizes a client asks for are kept within these bounds,
+MAX_CHUNK_SIZE = 64 * 1024 * 1024  # the reply to UPLOAD_OPEN tells it the one in use
+MAX_UPLOAD_SIZE = 0  # Largest file a client may upload, 0 for no limit besides the free disk space
+CAS_PATH = "server_cas"  # Content-addressed chunks of deduplicated files
+DEDUP = False  # Accept deduplicated uploads (--storage dedup)
+MAX_CONNECTIONS = 1000  # Connections beyond this are refused with an error frame
+ZERO_COPY = True  # Serve downloads with sendfile when possible
+BUFFER_SIZE = 256 * 1024  # Transfer buffer per connection, also used for SO_RCVBUF/SO_SNDBUF
+LISTEN_BACKLOG = 1024  # Pending connections the kernel queues for accept() during a burst
+STATS_FILE = "server_network_stats.csv"  # Appended to every few seconds by a background thread
+MAX_BATCH_BODY = 16 * 1024 * 1024  # Largest list of operations one BATCH may carry
+MAX_CHUNK_LIST = 64 * 1024 * 1024  # Largest chunk list of a DEDUP_OPEN, about 1.8M chunks or a 1 TB file
+DIR_PAGE_SIZE = 1000  # Entries per DIR reply unless the client asks for fewer
+MAX_DIR_PAGE = 2000  # Keeps a page of long names well under MAX_CONTROL_PAYLOAD
+COMPRESSION = True  # Agree to compress transfers when the client offers a codec
+ENCRYPTION = True  # Agree to encrypt file payloads when the client asks at login
+ENCRYPT_CHUNK_SIZE = DEFAULT_CHUNK_SIZE  # Bytes per sealed DATA frame we send
+METRICS_PORT = 0  # Serve live metrics on 127.0.0.1:METRICS_PORT, 0 for off
+HOT_CACHE_SIZE = 256 * 1024 * 1024  # Bytes of popular files kept mapped for downloads, 0 for none
+FSYNC = False  # Flush uploads to disk before they replace the old version (--fsync)
+SESSION_TTL = DEFAULT_TTL  # Seconds a session token can be used to RESUME, 0 to not issue tokens
+RATE_LIMIT = 0  # Bytes per second of file data for all users together, 0 for no limit
+USER_RATE_LIMIT = 0  # Bytes per second of file data per user, 0 for no limit
+USER_RATE_LIMITS = {}  # username -> bytes per second, overrides USER_RATE_LIMIT
+WORKERS = 1  # Worker processes sharing the port with SO_REUSEPORT, 1 to serve from this process
+REPORT_INTERVAL = 1.0  # Seconds between a worker's metrics reports to the supervisor
+STOP_SIGNAL = signal.SIGINT  # Signal the server shuts down on, SIGTERM in worker processes
 stats_logger = NetworkStats()
+storage = Storage(SERVER_PATH, STAGING_PATH, FSYNC)
+transfers = TransferRegistry(STAGING_PATH, publish=storage.publish)
+hot_files = HotFileCache(HOT_CACHE_SIZE)
+storage.watchers.append(hot_files.invalidate)
+chunk_store = ChunkStore(CAS_PATH)
+session_tokens = TokenStore(SESSION_TTL)
+bandwidth = BandwidthLimiter(RATE_LIMIT, USER_RATE_LIMIT, USER_RATE_LIMITS)
+# Deduplicated files are listed with the size of their contents, not of the manifest
+dir_index = DirectoryIndex(SERVER_PATH, lambda path, st: stored_size(path) if DEDUP else st.st_size)
 is_running = True
+active_sessions = set()  # Sessions of the connected clients, for the metrics endpoint
+sessions_lock = threading.Lock()
+closed_totals = {"connections": 0, "bytes_in": 0, "bytes_out": 0}  # Of connections that have ended
+started_at = time.time()
+connection_tasks = None  # Connection tasks of the asyncio engine, kept by the tasks themselves for metrics
+worker_reports = None  # pid -> (index, metrics_snapshot(), histograms) of every worker, in the supervisor's manager
 
-# Set up a signal handler to capture keyboard interrupt in order to close the server
+# Set up a signal handler to capture keyboard interrupt in order to close the server.
+# Also handles SIGTERM, which the supervisor sends its workers to stop them.
 def signal_handler(sig, frame):
     global is_running
     print("\n[INFO] Interrupt received. Shutting down server...")
@@ -25,10 +95,6 @@ def signal_handler(sig, frame):
 
 signal.signal(signal.SIGINT, signal_handler)
 
-# Ensure the server storage directory exists
-if not os.path.exists(SERVER_PATH):
-    os.makedirs(SERVER_PATH)
-
 def hash_password(password):
     return hashlib.sha256(password.encode("utf-8")).hexdigest()
 
@@ -61,201 +127,1185 @@ def authenticate(username, encrypted_password):
         return False
 
 
-def handle_client(conn, addr):
-    authenticated = False
-    username = None  # Store the authenticated username
+def is_hex(text):
+    try:
+        bytes.fromhex(text)
+        return True
+    except ValueError:
+        return False
+
+
+class Deferred:
+    # Stands in for the connection inside handlers. Calling a method records
+    # the call instead of doing it, the handler yields it and the engine that
+    # drives the handler performs it (blocking for threads, awaited for asyncio).
+    # This way both engines run the exact same handler code.
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: (name, args, kwargs)
+
+
+class Session:
+    # Per-connection state shared by the handlers
+
+    def __init__(self, addr, stream=None):
+        self.addr = addr
+        self.conn = Deferred()
+        self.stream = stream  # The real connection, only read for its byte counters
+        self.authenticated = False
+        self.username = None  # Store the authenticated username
+        self.encrypt_payloads = False  # Encrypted payloads can't use sendfile
+        self.dedup = None  # Deduplicated upload in progress
+        self.token = ""  # Session token the client can RESUME with
+        self.connected_at = time.monotonic()
+        self.commands = 0  # Requests handled so far
+        self.command = None  # Name of the request being handled
+        self.command_started = None
+
+    def metrics(self, now):
+        # Counters of this connection for the metrics endpoint
+        return {
+            "addr": f"{self.addr[0]}:{self.addr[1]}" if isinstance(self.addr, tuple) else str(self.addr),
+            "user": self.username,
+            "connected_s": round(now - self.connected_at, 3),
+            "commands": self.commands,
+            "command": self.command,
+            "command_s": round(now - self.command_started, 3) if self.command else None,
+            "bytes_in": self.stream.bytes_in if self.stream else 0,
+            "bytes_out": self.stream.bytes_out if self.stream else 0,
+            "throttled_s": round(self.stream.throttled, 3) if self.stream else 0,
+        }
+
+
+def handle_auth(session, frame):
+    # AUTH checks the password, RESUME a session token from an earlier AUTH
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    if frame.opcode == OP_AUTH:
+        if len(command) > 1 and authenticate(command[0], command[1]):
+            token = session_tokens.issue(command[0]) if SESSION_TTL else ""
+            yield from start_session(session, rid, command[0], token, command[2:4])
+        else:
+            yield conn.send_frame(OP_ERROR, "Invalid credentials.", request_id=rid)
+    elif frame.opcode == OP_RESUME:
+        username = session_tokens.check(command[0]) if command else None
+        if username is not None:
+            yield from start_session(session, rid, username, command[0], command[1:3])
+        else:
+            yield conn.send_frame(OP_ERROR, "Session expired or revoked, log in again.", request_id=rid)
+    else:
+        yield conn.send_frame(OP_ERROR, "Please authenticate first.", request_id=rid)
+
+
+def start_session(session, rid, username, token, cipher_offer):
+    # Reply to a successful login with the session token and, if the client
+    # asked for encrypted payloads, switch to the negotiated cipher. The
+    # client's offer and nonce are optional, keys are derived from both
+    # sides' nonces. File data of the connection is paced by the user's
+    # bandwidth limits from here on.
+    conn = session.conn
+    session.authenticated = True
+    session.username = username
+    session.token = token
+    yield conn.set_throttle(throttle(bandwidth, username))
+    algorithm = negotiate_cipher(cipher_offer[0]) if ENCRYPTION and len(cipher_offer) > 1 else ""
+    client_nonce = bytes.fromhex(cipher_offer[1]) if algorithm and is_hex(cipher_offer[1]) else b""
+    if len(client_nonce) != NONCE_SIZE:
+        yield conn.send_frame(OP_OK, pack_fields("Authentication successful.", "", "", token), request_id=rid)
+        return
+    server_nonce = secrets.token_bytes(NONCE_SIZE)
+    yield conn.send_frame(OP_OK, pack_fields("Authentication successful.", algorithm, server_nonce.hex(), token),
+                          request_id=rid)
+    cipher = FrameCipher.for_server(algorithm, key, client_nonce, server_nonce, ENCRYPT_CHUNK_SIZE)
+    yield conn.set_cipher(cipher)
+    session.encrypt_payloads = True
+
+
+def handle_revoke(session, frame):
+    # REVOKE [all]: stop this connection's session token, or every token of
+    # the user, from being used to RESUME. The connection stays logged in.
+    command = unpack_fields(frame.payload)
+    if command and command[0] == "all":
+        count = session_tokens.revoke_user(session.username)
+    else:
+        count = int(bool(session.token) and session_tokens.revoke(session.token))
+    yield session.conn.send_frame(OP_OK, f"{count} session(s) revoked.", request_id=frame.request_id)
+
+
+def handle_logout(session, frame):
+    # Log the user out
+    start_time = time.perf_counter()
+    yield session.conn.send_frame(OP_OK, "Logged out", request_id=frame.request_id)
+    end_time = time.perf_counter()
+    stats_logger.record_response_time("LOGOUT", start_time, end_time)
+    print(f"[DISCONNECTED] {session.addr} logged out.")
+
+
+def confirm_overwrite(session, rid, filename, filepath):
+    # Ask the client before replacing an existing file, returns True to go ahead
+    conn = session.conn
+    if not os.path.exists(filepath):
+        return True
+
+    # Notify the client about the existing file
+    yield conn.send_frame(OP_EXISTS, f"File {filename} already exists.", request_id=rid)
+
+    # Wait for client response
+    reply = yield conn.recv_frame()
+    overwrite = ""
+    if reply is not None and reply.opcode == OP_CONFIRM:
+        overwrite = reply.payload.decode(FORMAT).strip().lower()
+    if overwrite != "yes":
+        yield conn.send_frame(OP_ERROR, "Upload cancelled by user.", request_id=rid)
+        print(f"[UPLOAD CANCELLED] Client declined to overwrite {filename}.")
+        return False
+    return True
+
+
+def publish_file(staging_path, path):
+    # storage.publish() that keeps the DIR index up to date
+    with dir_index.changing(os.path.relpath(path, storage.root)):
+        storage.publish(staging_path, path)
+
+
+def publish_upload(staging_path, path):
+    # Every file a user sends is published through here. One that starts like
+    # a chunk manifest is refused, with --storage dedup it would be read as
+    # one and could point at any chunk.
+    if is_manifest(staging_path):
+        raise ValueError("Files starting with the chunk manifest header can't be stored.")
+    publish_file(staging_path, path)
+
+
+def publish_manifest(path, size, chunks):
+    # A deduplicated upload is published like any other, only its file is
+    # written by the server
+    staging_path = storage.staging_file("manifest")
+    try:
+        write_manifest(staging_path, size, chunks)
+        publish_file(staging_path, path)
+    finally:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+
+
+def upload_size_error(filename, filesize):
+    # Why an upload of filesize bytes is refused before any of it arrives,
+    # None to accept it. The size is the client's word and staging files are
+    # preallocated to it, so it is checked against the limit and the disk.
+    if filesize < 0:
+        return f"Invalid size for {filename}."
+    if MAX_UPLOAD_SIZE and filesize > MAX_UPLOAD_SIZE:
+        return f"{filename} is larger than the upload limit of {MAX_UPLOAD_SIZE} bytes."
+    if filesize > storage.free_space():
+        return f"Not enough disk space on the server for {filename}."
+    return None
+
+
+def handle_upload(session, frame):
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    filename = command[0]
+    filesize = int(command[1])
+    try:
+        filepath = storage.target(filename)
+    except ValueError as e:
+        yield conn.send_frame(OP_ERROR, str(e), request_id=rid)
+        return
+    error = upload_size_error(filename, filesize)
+    if error:
+        yield conn.send_frame(OP_ERROR, error, request_id=rid)
+        return
+
+    # Check if the file exists
+    if not (yield from confirm_overwrite(session, rid, filename, filepath)):
+        return
+
+    # Notify the client that the server is ready to receive the file
+    yield conn.send_frame(OP_OK, "Ready to receive file", request_id=rid)
+
+    start_time = time.perf_counter()
+
+    # Write to a staging file first so a dropped upload never leaves a
+    # truncated file behind in SERVER_PATH, and downloads running meanwhile
+    # keep reading the old version
+    staging_path = storage.staging_file("upload")
+    try:
+        with open(staging_path, "wb") as f:
+            storage.preallocate(f, filesize)
+            bytes_received = yield conn.recv_body(f.write)
+        error = None if bytes_received == filesize else f"Size mismatch for {filename}."
+        if error is None:
+            try:
+                yield conn.call(publish_upload, staging_path, filepath)
+            except ValueError as e:
+                error = str(e)
+    finally:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+
+    end_time = time.perf_counter()
+    if error:
+        print(f"[UPLOAD FAILED] {filename}: {error} ({bytes_received} of {filesize} bytes received)")
+        yield conn.send_frame(OP_ERROR, error, request_id=rid)
+        return
+    stats_logger.record_upload(filename, filesize, start_time, end_time)
+
+    print(f"[UPLOAD COMPLETE] File {filename} uploaded successfully.")
+    yield conn.send_frame(OP_OK, f"File {filename} uploaded successfully.", request_id=rid)
+
+
+def handle_upload_open(session, frame):
+    # Start or resume a chunked upload. Chunks can then arrive on any of the
+    # user's connections, in any order, and the file appears once all of them
+    # are in. The reply lists the chunks already stored so a client resuming
+    # an interrupted upload only sends the missing ones.
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    filename = command[0]
+    filesize = int(command[1])
+    chunk_size = int(command[2]) if len(command) > 2 and command[2] else CHUNK_SIZE
+    codec = negotiate(command[3]) if COMPRESSION and len(command) > 3 else ""
+    try:
+        filepath = storage.target(filename)
+    except ValueError as e:
+        yield conn.send_frame(OP_ERROR, str(e), request_id=rid)
+        return
+    # Tiny chunks would bloat the chunk log and the reply, huge ones make a
+    # single chunk checksum read the whole file
+    chunk_size = min(max(chunk_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+    # Resuming an upload the user already confirmed doesn't ask again
+    transfer = transfers.resumable(session.username, filepath, filesize, chunk_size)
+    if transfer is None:
+        # The staging file is preallocated and kept for resuming, so the
+        # space is claimed for as long as the upload stays unfinished
+        error = upload_size_error(filename, filesize)
+        if error:
+            yield conn.send_frame(OP_ERROR, error, request_id=rid)
+            return
+        if not (yield from confirm_overwrite(session, rid, filename, filepath)):
+            return
+        transfer = transfers.create(session.username, filename, filepath, filesize, chunk_size)
+        print(f"[UPLOAD OPEN] {filename} ({filesize} bytes) as transfer {transfer.transfer_id}.")
+    else:
+        print(f"[UPLOAD RESUME] {filename}: {len(transfer.chunks)} of {transfer.total_chunks()} chunks stored.")
+
+    done = ",".join(str(index) for index in sorted(transfer.chunks))
+    yield conn.send_frame(OP_OK, pack_fields(transfer.transfer_id, chunk_size, done, codec), request_id=rid)
+
+
+def handle_upload_range(session, frame):
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    transfer_id = command[0]
+    index = int(command[1])
+    expected_digest = command[2]
+    stream = command[3] if len(command) > 3 else ""
+    codec = command[4] if len(command) > 4 else ""
+    decompressor = Decompressor(codec) if codec in CODECS else None
+
+    transfer = transfers.get(transfer_id, session.username)
+    if transfer is None or not 0 <= index < transfer.total_chunks() or (codec and decompressor is None):
+        # The body is on its way regardless, read it so the stream stays in sync
+        yield conn.recv_body(lambda data: None, decompressor)
+        yield conn.send_frame(OP_ERROR, f"Unknown transfer, chunk or codec {transfer_id}/{index}/{codec}.",
+                              request_id=rid)
+        return
+
+    write, digest = transfer.chunk_writer(index)
+    start_time = time.perf_counter()
+    bytes_received = yield conn.recv_body(write, decompressor)
+    end_time = time.perf_counter()
+    stats_logger.record_stream("upload", transfer.filename, stream, bytes_received, start_time, end_time,
+                               wire_bytes=decompressor.wire if decompressor else None, compression=codec)
+
+    # Only chunks that arrived whole and match the client's hash are kept
+    if bytes_received != transfer.chunk_range(index)[1] or digest.hexdigest() != expected_digest:
+        print(f"[UPLOAD CHUNK REJECTED] Chunk {index} of {transfer.filename} failed verification.")
+        yield conn.send_frame(OP_ERROR, f"Checksum mismatch for chunk {index}.", request_id=rid)
+        return
+    if index == 0 and os.pread(transfer.fd, len(MANIFEST_MAGIC), 0) == MANIFEST_MAGIC:
+        # Refused before the file can be assembled, as publish_upload() would
+        print(f"[UPLOAD REJECTED] {transfer.filename} starts with the chunk manifest header.")
+        transfers.discard(transfer)
+        yield conn.send_frame(OP_ERROR, "Files starting with the chunk manifest header can't be stored.",
+                              request_id=rid)
+        return
+
+    with dir_index.changing(transfer.filename):
+        complete = yield conn.call(transfer.add_chunk, index, expected_digest)
+    if complete:
+        transfers.finish(transfer)
+        print(f"[UPLOAD COMPLETE] File {transfer.filename} assembled from chunks.")
+        yield conn.send_frame(OP_OK, f"File {transfer.filename} uploaded successfully.", request_id=rid)
+    else:
+        yield conn.send_frame(OP_OK, pack_fields(transfer.received(), transfer.filesize), request_id=rid)
+
+
+def checksum_range(filename, filepath, offset, count):
+    # Only the lookup is done under the lock. Files are swapped by renaming,
+    # so the descriptor opened here keeps the version whose size was checked
+    # while it is hashed, and chunks of a manifest never change.
+    with storage.reading(filepath):
+        if not os.path.isfile(filepath):
+            raise FileNotFoundError(filepath)
+        manifest = read_manifest(filepath) if DEDUP else None
+        f = None if manifest else open(filepath, "rb")
+    try:
+        filesize = manifest[0] if manifest else os.fstat(f.fileno()).st_size
+        if offset < 0 or count < 0 or offset + count > filesize:
+            raise ValueError(f"Invalid range for {filename}.")
+        if manifest:
+            return chunk_store.sha256_range(manifest[1], offset, count)
+        return sha256_file(f, offset, count)
+    finally:
+        if f is not None:
+            f.close()
+
+
+def handle_checksum(session, frame):
+    # SHA-256 of a byte range, lets a client check a partial download still
+    # matches the server's copy before resuming it
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    filename = command[0]
+    offset = int(command[1])
+    count = int(command[2])
+    try:
+        filepath = storage.path(filename)
+        digest = yield session.conn.call(checksum_range, filename, filepath, offset, count)
+        reply = (OP_OK, digest)
+    except OSError:
+        reply = (OP_ERROR, f"File {filename} not found.")
+    except ValueError as e:
+        reply = (OP_ERROR, str(e))
+    yield session.conn.send_frame(*reply, request_id=rid)
+
+
+def handle_dedup_open(session, frame):
+    # Deduplicated upload, step 1: the client sends the chunk list of its file
+    # and gets back the indexes of the chunks the store doesn't have yet
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    filename = command[0]
+    filesize = int(command[1])
+    chunk_total = int(command[2])
+
+    # Every chunk but the last is at least MIN_CHUNK long, so the size bounds
+    # the list we are willing to hold in memory. The size is the client's
+    # word though, the list is also capped on our side.
+    if filesize < 0 or not 0 < chunk_total <= filesize // MIN_CHUNK + 1:
+        yield conn.recv_body(lambda data: None)
+        yield conn.send_frame(OP_ERROR, f"Too many chunks for the size of {filename}.", request_id=rid)
+        return
+    if chunk_total * CHUNK_ENTRY.size > MAX_CHUNK_LIST:
+        yield conn.recv_body(lambda data: None)
+        yield conn.send_frame(OP_ERROR, f"{filename} has too many chunks to store deduplicated.", request_id=rid)
+        return
+    chunk_list = yield conn.recv_bytes(chunk_total * CHUNK_ENTRY.size)
+    if not DEDUP:
+        yield conn.send_frame(OP_ERROR, "Deduplicated uploads are not enabled.", request_id=rid)
+        return
+    try:
+        filepath = storage.target(filename)
+    except ValueError as e:
+        yield conn.send_frame(OP_ERROR, str(e), request_id=rid)
+        return
+    chunks = unpack_chunk_list(chunk_list)
+    if len(chunks) != chunk_total or sum(length for digest, length in chunks) != filesize:
+        yield conn.send_frame(OP_ERROR, f"Chunk list doesn't match {filename}.", request_id=rid)
+        return
+
+    if not (yield from confirm_overwrite(session, rid, filename, filepath)):
+        return
+
+    missing = chunk_store.missing(chunks)
+    session.dedup = {
+        "filename": filename,
+        "filepath": filepath,
+        "filesize": filesize,
+        "chunks": chunks,
+        "bytes_sent": 0,
+        "start_time": time.perf_counter(),
+    }
+    print(f"[DEDUP UPLOAD] {filename}: {len(missing)} of {len(chunks)} chunks needed.")
+    yield conn.send_frame(OP_OK, pack_fields(len(missing)), request_id=rid)
+    yield conn.send_bytes(pack_indexes(missing), request_id=rid)
+
+
+def handle_chunk_put(session, frame):
+    # Deduplicated upload, step 2: one missing chunk. There is no reply so the
+    # client can stream every chunk without waiting, problems are reported at
+    # commit time.
+    conn = session.conn
+    index = int(unpack_fields(frame.payload)[0])
+    pending = session.dedup
+    if pending is None or not 0 <= index < len(pending["chunks"]):
+        yield conn.recv_body(lambda data: None)
+        return
+
+    write, finish, discard = chunk_store.writer()
+    try:
+        bytes_received = yield conn.recv_body(write)
+    except Exception:
+        discard()
+        raise
+    pending["bytes_sent"] += bytes_received
+    if not finish(pending["chunks"][index][0]):
+        print(f"[DEDUP UPLOAD] Chunk {index} of {pending['filename']} failed verification.")
+
+
+def handle_dedup_commit(session, frame):
+    # Deduplicated upload, step 3: publish the manifest once every chunk is in
+    conn = session.conn
+    rid = frame.request_id
+    pending = session.dedup
+    session.dedup = None
+    if pending is None:
+        yield conn.send_frame(OP_ERROR, "No deduplicated upload in progress.", request_id=rid)
+        return
+
+    filename = pending["filename"]
+    missing = chunk_store.missing(pending["chunks"])
+    if missing:
+        yield conn.send_frame(OP_ERROR, f"{len(missing)} chunks of {filename} are missing or corrupt.", request_id=rid)
+        return
+
+    yield conn.call(publish_manifest, pending["filepath"], pending["filesize"],
+                    [list(chunk) for chunk in pending["chunks"]])
+    end_time = time.perf_counter()
+    stats_logger.record_upload(filename, pending["filesize"], pending["start_time"], end_time)
+    print(f"[UPLOAD COMPLETE] File {filename} stored deduplicated ({pending['bytes_sent']} bytes sent).")
+    yield conn.send_frame(OP_OK, f"File {filename} uploaded successfully ({pending['bytes_sent']} of "
+                                 f"{pending['filesize']} bytes sent).", request_id=rid)
+
+
+def handle_sync(session, frame):
+    # Delta upload: send the client the block signatures of our copy, then
+    # rebuild the new version from the block references and literal data it
+    # sends back. Replaces the file without asking, like rsync.
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    filename = command[0]
+    filesize = int(command[1])
+    try:
+        filepath = storage.target(filename)
+    except ValueError as e:
+        yield conn.send_frame(OP_ERROR, str(e), request_id=rid)
+        return
+
+    if DEDUP:
+        yield conn.send_frame(OP_ERROR, "Storage is deduplicated, UPLOAD already sends only changed chunks.",
+                              request_id=rid)
+        return
+    error = upload_size_error(filename, filesize)
+    if error:
+        yield conn.send_frame(OP_ERROR, error, request_id=rid)
+        return
+    with storage.reading(filepath):
+        basis = open(filepath, "rb") if os.path.isfile(filepath) else None
+
+    start_time = time.perf_counter()
+    staging_path = storage.staging_file("sync")
+    try:
+        block_size = block_size_for(os.fstat(basis.fileno()).st_size if basis else 0)
+        # Hashing a large basis takes a while, the asyncio engine does it
+        # off the event loop
+        signature_data = (yield conn.call(signatures, basis, block_size)) if basis else b""
+        yield conn.send_frame(OP_OK, pack_fields(block_size, len(signature_data) // SIGNATURE.size),
+                              request_id=rid)
+        yield conn.send_bytes(signature_data, request_id=rid)
+
+        with open(staging_path, "wb") as f:
+            storage.preallocate(f, filesize)
+            patcher = Patcher(basis, block_size, f.write)
+            bytes_received = yield conn.recv_body(patcher.write)
+        error = patcher.finish()
+        if error is None and patcher.size != filesize:
+            error = f"Size mismatch for {filename}."
+        if error is None:
+            try:
+                yield conn.call(publish_upload, staging_path, filepath)
+            except ValueError as e:
+                error = str(e)
+    finally:
+        if basis:
+            basis.close()
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+
+    end_time = time.perf_counter()
+    if error:
+        print(f"[SYNC FAILED] {filename}: {error}")
+        yield conn.send_frame(OP_ERROR, f"Sync of {filename} failed: {error}", request_id=rid)
+        return
+    stats_logger.record_upload(filename, filesize, start_time, end_time)
+    print(f"[SYNC COMPLETE] {filename}: {patcher.literal} literal bytes, {patcher.matched} bytes reused.")
+    yield conn.send_frame(OP_OK, f"File {filename} synced ({bytes_received} bytes sent, "
+                                 f"{patcher.matched} of {filesize} bytes reused).", request_id=rid)
+
+
+def handle_dir(session, frame):
+    # One page of a folder listing: DIR [folder] [cursor] [limit]. The reply
+    # holds the cursor for the next page ("" after the last one) followed by
+    # name, kind, size and mtime of each entry.
+    rid = frame.request_id
+    start_time = time.perf_counter()
+    command = unpack_fields(frame.payload)
+    folder = command[0] if command else ""
+    cursor = command[1] if len(command) > 1 else ""
+    try:
+        limit = min(max(int(command[2]), 1), MAX_DIR_PAGE) if len(command) > 2 and command[2] else DIR_PAGE_SIZE
+        # A folder that isn't cached is scanned, off the event loop
+        entries, next_cursor = yield session.conn.call(dir_index.page, folder, cursor, limit)
+        fields = [next_cursor]
+        for entry in entries:
+            fields.extend(entry)
+        reply = (OP_OK, pack_fields(*fields))
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] Failed to list directory contents: {e}")
+        reply = (OP_ERROR, f"Folder '{folder}' not found.")
+    finally:
+        end_time = time.perf_counter()  # End timing
+        stats_logger.record_response_time("DIR", start_time, end_time)
+    yield session.conn.send_frame(*reply, request_id=rid)
+
+
+def handle_download(session, frame):
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    filename = command[0]
+    try:
+        filepath = storage.path(filename)
+        # Opened under the lock so the size and the contents sent are of the
+        # same version, an upload replacing the file later doesn't affect us
+        with storage.reading(filepath):
+            # Deduplicated files are stored as a manifest of chunks
+            manifest = read_manifest(filepath) if DEDUP else None
+            f = None if manifest else open(filepath, "rb")
+            st = os.stat(filepath) if manifest else os.fstat(f.fileno())
+    except (OSError, ValueError):
+        yield conn.send_frame(OP_ERROR, f"File {filename} not found.", request_id=rid)
+        return
+    try:
+        transfer_path = yield from send_file_range(session, rid, command, filepath, manifest, f, st)
+    finally:
+        if f is not None:
+            f.close()
+    if transfer_path:
+        print(f"[DOWNLOAD COMPLETE] File {filename} sent to {session.addr} ({transfer_path}).")
+
+
+def send_file_range(session, rid, command, filepath, manifest, f, st):
+    # The rest of DOWNLOAD once the file is open, returns the transfer path
+    # used or None if nothing was sent
+    conn = session.conn
+    filename = command[0]
+    filesize = manifest[0] if manifest else st.st_size
+
+    # The reply carries the version's ETag and mtime. A client that sends the
+    # ETag of its own copy gets no body if that is still current.
+    tag = etag(filesize, st.st_mtime_ns)
+    if len(command) > 4 and command[4] == tag:
+        yield conn.send_frame(OP_OK, pack_fields(filename, filesize, 0, 0, "", tag, st.st_mtime_ns, "unchanged"),
+                              request_id=rid)
+        print(f"[DOWNLOAD SKIPPED] {session.addr} already has the current {filename}.")
+        return None
+
+    # Optional byte range: offset and count (empty count means to the end)
+    try:
+        offset = int(command[1]) if len(command) > 1 and command[1] else 0
+        count = int(command[2]) if len(command) > 2 and command[2] else filesize - offset
+    except ValueError:
+        offset = count = -1
+    if offset < 0 or offset > filesize or count < 0:
+        yield conn.send_frame(OP_ERROR, f"Invalid range for {filename}.", request_id=rid)
+        return None
+    count = min(count, filesize - offset)
+
+    # Compress if the client offered a codec we have
+    codec = negotiate(command[3]) if COMPRESSION and len(command) > 3 else ""
+    compressor = Compressor(codec) if codec else None
+
+    yield conn.send_frame(OP_OK, pack_fields(filename, filesize, offset, count, codec, tag, st.st_mtime_ns),
+                          request_id=rid)  # Send metadata
+
+    start_time = time.perf_counter()
+    # Zero-copy unless the payload has to be transformed in userspace, in
+    # which case popular files are sent from their shared mapping
+    zero_copy = ZERO_COPY and not session.encrypt_payloads
+    hot = None if manifest or (zero_copy and compressor is None) else hot_files.get(filepath, f, st)
+    if manifest:
+        transfer_path = yield from send_chunks(session, manifest[1], offset, count, rid, zero_copy, compressor)
+    elif hot is not None:
+        transfer_path = yield conn.send_buffer(hot, offset, count, request_id=rid, compressor=compressor)
+    else:
+        transfer_path = yield conn.send_file(f, offset, count, request_id=rid, zero_copy=zero_copy,
+                                             compressor=compressor)
+
+    end_time = time.perf_counter()
+    stats_logger.record_download(filename, count, start_time, end_time, transfer_path=transfer_path,
+                                 wire_bytes=compressor.wire if compressor else None, compression=codec)
+    return transfer_path
+
+
+def send_chunks(session, chunks, offset, count, rid, zero_copy, compressor=None, end=True):
+    # Body of a deduplicated file: one DATA frame per chunk piece
+    conn = session.conn
+    pieces = list(chunk_store.pieces(chunks, offset, count))
+    if not pieces:
+        yield conn.send_bytes(b"", request_id=rid, end=end)
+        return "buffered"
+    for number, (path, start, length) in enumerate(pieces):
+        with open(path, "rb") as f:
+            transfer_path = yield conn.send_file(f, start, length, request_id=rid, zero_copy=zero_copy,
+                                                 end=end and number == len(pieces) - 1, compressor=compressor)
+    return transfer_path
+
+
+def open_stored(path):
+    # (source, size) of a stored file for archive.pack(): the open file, or
+    # the chunk list of a deduplicated one
+    with storage.reading(path):
+        manifest = read_manifest(path) if DEDUP else None
+        if manifest:
+            return manifest[1], manifest[0]
+        f = open(path, "rb")
+    return f, os.fstat(f.fileno()).st_size
+
+
+def store_folder(path):
+    with dir_index.changing(os.path.relpath(path, storage.root)):
+        storage.make_folder(path)
+
+
+def handle_tree_upload(session, frame):
+    # A folder and everything in it as one archive stream (see archive.py),
+    # unpacked into the folder as it arrives. Existing files are replaced
+    # without asking, each one as it is complete.
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    name = command[0] if command else ""
+    try:
+        root = storage.target(name)
+    except ValueError as e:
+        yield conn.send_frame(OP_ERROR, str(e), request_id=rid)
+        return
+    if os.path.exists(root) and not os.path.isdir(root):
+        yield conn.send_frame(OP_ERROR, f"{name} exists and is not a folder.", request_id=rid)
+        return
+    codec = negotiate(command[1]) if COMPRESSION and len(command) > 1 else ""
+    store_folder(root)
+    yield conn.send_frame(OP_OK, pack_fields("Ready to receive folder", codec), request_id=rid)
+
+    start_time = time.perf_counter()
+    extractor = archive.Extractor(root, make_folder=store_folder, publish=publish_upload,
+                                  staging_file=lambda path: storage.staging_file("tree"))
+    try:
+        yield conn.recv_body(extractor.write, Decompressor(codec) if codec else None)
+        # Waits for the writer threads
+        yield conn.call(extractor.finish)
+    except BaseException:
+        extractor.finish()
+        raise
+    end_time = time.perf_counter()
+    stats_logger.record_response_time("TREE_UPLOAD", start_time, end_time, name, extractor.bytes)
+
+    if extractor.errors:
+        print(f"[TREE UPLOAD INCOMPLETE] {len(extractor.errors)} entries of {name} not stored: {extractor.errors[0]}")
+        yield conn.send_frame(OP_ERROR, f"{len(extractor.errors)} entries could not be stored, the first: "
+                                        f"{extractor.errors[0]}", request_id=rid)
+        return
+    print(f"[TREE UPLOAD COMPLETE] Folder {name}: {extractor.files} files, {extractor.folders} folders, "
+          f"{extractor.bytes} bytes.")
+    yield conn.send_frame(OP_OK, pack_fields(extractor.files, extractor.folders, extractor.bytes), request_id=rid)
+
+
+def handle_tree_download(session, frame):
+    # A folder and everything in it as one archive stream, built while the
+    # folder is walked
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    name = command[0] if command else ""
+    try:
+        root = storage.path(name)
+    except ValueError as e:
+        yield conn.send_frame(OP_ERROR, str(e), request_id=rid)
+        return
+    if not os.path.isdir(root):
+        yield conn.send_frame(OP_ERROR, f"Folder {name} not found.", request_id=rid)
+        return
+    codec = negotiate(command[1]) if COMPRESSION and len(command) > 1 else ""
+    compressor = Compressor(codec) if codec else None
+    zero_copy = ZERO_COPY and not session.encrypt_payloads
+    yield conn.send_frame(OP_OK, pack_fields(name, codec), request_id=rid)
+
+    start_time = time.perf_counter()
+    sent = 0
+    # Walking the tree and reading small files is disk work, each piece is
+    # made off the event loop
+    pieces = archive.pack(root, open_stored)
+    while (item := (yield conn.call(next, pieces, None))) is not None:
+        piece, last = item
+        if isinstance(piece, tuple):
+            source, size = piece
+            if isinstance(source, list):
+                yield from send_chunks(session, source, 0, size, rid, zero_copy, compressor, end=False)
+            else:
+                yield conn.send_file(source, 0, size, request_id=rid, zero_copy=zero_copy, end=False,
+                                     compressor=compressor)
+            sent += size
+        else:
+            yield conn.send_buffer(piece, request_id=rid, end=last, compressor=compressor)
+            sent += len(piece)
+    end_time = time.perf_counter()
+    stats_logger.record_response_time("TREE_DOWNLOAD", start_time, end_time, name, sent)
+    print(f"[TREE DOWNLOAD COMPLETE] Folder {name} sent to {session.addr} ({sent} bytes).")
+
+
+def create_folder(name):
+    # (opcode, message) for CREATE, shared by the single command and BATCH
+    try:
+        subfolder_path = storage.path(name)
+        with dir_index.changing(name):
+            storage.make_folder(subfolder_path)
+        return OP_OK, f"Subfolder '{name}' created successfully."
+    except Exception as e:
+        print(f"Received command: CREATE with argument {name}")
+        return OP_ERROR, f"Failed to create subfolder: {e}"
+
+
+def delete_path(name):
+    # (opcode, message) for DELETE
+    try:
+        path = storage.path(name)
+    except ValueError as e:
+        return OP_ERROR, str(e)
+
+    # Check if the file exists
+    if not os.path.isfile(path) and not os.path.isdir(path):
+        return OP_ERROR, f"File '{name}' not found."
+    elif os.path.isfile(path):
+        try:
+            # Attempt to delete the file, downloads already running finish
+            with dir_index.changing(name):
+                storage.remove(path)
+            return OP_OK, f"File '{name}' deleted successfully."
+        except Exception as e:
+            return OP_ERROR, f"Failed to delete file '{name}': {e}"
+    else:
+        try:
+            # Attempt to delete the subfolder
+            with dir_index.changing(name):
+                storage.remove(path)
+            return OP_OK, f"Subdirectory '{name}' deleted successfully."
+        except Exception as e:
+            return OP_ERROR, f"Failed to delete subdirectory '{name}': {e}"
+
+
+def delete_tree(name):
+    # (opcode, message) for TREE_DELETE: the folder and everything below it,
+    # innermost first
+    try:
+        root = storage.path(name)
+    except ValueError as e:
+        return OP_ERROR, str(e)
+    if not os.path.isdir(root):
+        return OP_ERROR, f"Folder '{name}' not found."
+    files = folders = 0
+    try:
+        with dir_index.changing(name):
+            for folder, subfolders, filenames in os.walk(root, topdown=False):
+                for filename in filenames:
+                    storage.remove(os.path.join(folder, filename))
+                    files += 1
+                for subfolder in subfolders:
+                    storage.remove(os.path.join(folder, subfolder))
+                    folders += 1
+            storage.remove(root)
+            folders += 1
+    except OSError as e:
+        return OP_ERROR, f"Failed to delete folder '{name}' after {files} files: {e}"
+    return OP_OK, f"Folder '{name}' deleted ({files} files, {folders} folders)."
+
+
+def stat_path(name):
+    # (opcode, fields) for STAT: name, "file" or "dir", size and mtime
+    try:
+        path = storage.path(name)
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return OP_ERROR, [f"File '{name}' not found."]
+    if os.path.isdir(path):
+        return OP_OK, [name, "dir", 0, st.st_mtime_ns]
+    return OP_OK, [name, "file", stored_size(path) if DEDUP else st.st_size, st.st_mtime_ns]
+
+
+def handle_create(session, frame):
+    rid = frame.request_id
+    start_time = time.perf_counter()
+    name = unpack_fields(frame.payload)[0]
+    try:
+        reply = yield session.conn.call(create_folder, name)
+    finally:
+        end_time = time.perf_counter()  # End timing
+        stats_logger.record_response_time("CREATE", start_time, end_time)
+    yield session.conn.send_frame(*reply, request_id=rid)
+
+
+def handle_delete(session, frame):
+    start_time = time.perf_counter()
+
+    name = unpack_fields(frame.payload)[0]
+    reply = yield session.conn.call(delete_path, name)
+
+    # Send the response to the client
+    yield session.conn.send_frame(*reply, request_id=frame.request_id)
+
+    end_time = time.perf_counter()  # End tracking the command execution time
+    stats_logger.record_response_time("DELETE", start_time, end_time)  # Log the response time
+
+
+def handle_tree_delete(session, frame):
+    start_time = time.perf_counter()
+    reply = yield session.conn.call(delete_tree, unpack_fields(frame.payload)[0] if frame.payload else "")
+    yield session.conn.send_frame(*reply, request_id=frame.request_id)
+    end_time = time.perf_counter()
+    stats_logger.record_response_time("TREE_DELETE", start_time, end_time)
+
+
+def handle_stat(session, frame):
+    start_time = time.perf_counter()
+    command = unpack_fields(frame.payload)
+    if command:
+        opcode, fields = yield session.conn.call(stat_path, command[0])
+    else:
+        opcode, fields = OP_ERROR, ["No file name given."]
+    yield session.conn.send_frame(opcode, pack_fields(*fields), request_id=frame.request_id)
+    end_time = time.perf_counter()
+    stats_logger.record_response_time("STAT", start_time, end_time)
+
+
+def stat_line(name):
+    # stat_path() for BATCH, fields joined into one tab-separated result
+    opcode, fields = stat_path(name)
+    return opcode, "\t".join(str(field) for field in fields)
+
+
+# Operations a BATCH may contain
+BATCH_OPERATIONS = {
+    "CREATE": create_folder,
+    "DELETE": delete_path,
+    "STAT": stat_line,
+}
+
+
+def run_batch(lines):
+    # Result line of every BATCH item, run in one go off the event loop
+    results = []
+    for line in lines:
+        operation, _, name = line.partition("\t")
+        run = BATCH_OPERATIONS.get(operation.upper())
+        if run is None or not name:
+            opcode, message = OP_ERROR, f"Invalid batch item: {line}"
+        else:
+            opcode, message = run(name)
+        results.append(f"{'OK' if opcode == OP_OK else 'ERROR'}\t{message}")
+    return results
+
+
+def handle_batch(session, frame):
+    # Many CREATE/DELETE/STAT operations in one request. The body has one
+    # "OPERATION<TAB>name" line per item, the reply body one
+    # "OK|ERROR<TAB>result" line per item in the same order. The reply gives
+    # the body's length so the client reads exactly that much.
+    conn = session.conn
+    rid = frame.request_id
+    command = unpack_fields(frame.payload)
+    body = yield conn.recv_bytes(MAX_BATCH_BODY)
+    if not command or not command[0].isdigit():
+        yield conn.send_frame(OP_ERROR, "BATCH needs the number of items.", request_id=rid)
+        return
+    item_total = int(command[0])
+    try:
+        lines = body.decode(FORMAT).split("\n")[:item_total]
+    except UnicodeDecodeError:
+        yield conn.send_frame(OP_ERROR, "BATCH items are not valid UTF-8.", request_id=rid)
+        return
+
+    start_time = time.perf_counter()
+    results = yield conn.call(run_batch, lines)
+    end_time = time.perf_counter()
+    stats_logger.record_response_time("BATCH", start_time, end_time)
+
+    succeeded = sum(result.startswith("OK") for result in results)
+    print(f"[BATCH] {len(results)} operations from {session.addr}, {succeeded} succeeded.")
+    reply = "\n".join(results).encode(FORMAT)
+    yield conn.send_frame(OP_OK, pack_fields(len(results), succeeded, len(reply)), request_id=rid)
+    yield conn.send_bytes(reply, request_id=rid)
+
+
+HANDLERS = {
+    OP_UPLOAD: handle_upload,
+    OP_UPLOAD_OPEN: handle_upload_open,
+    OP_UPLOAD_RANGE: handle_upload_range,
+    OP_CHECKSUM: handle_checksum,
+    OP_DEDUP_OPEN: handle_dedup_open,
+    OP_CHUNK_PUT: handle_chunk_put,
+    OP_DEDUP_COMMIT: handle_dedup_commit,
+    OP_SYNC: handle_sync,
+    OP_DOWNLOAD: handle_download,
+    OP_DIR: handle_dir,
+    OP_CREATE: handle_create,
+    OP_DELETE: handle_delete,
+    OP_STAT: handle_stat,
+    OP_BATCH: handle_batch,
+    OP_REVOKE: handle_revoke,
+    OP_TREE_UPLOAD: handle_tree_upload,
+    OP_TREE_DOWNLOAD: handle_tree_download,
+    OP_TREE_DELETE: handle_tree_delete,
+}
+
+
+def client_session(addr, stream=None):
+    # The whole conversation with one client, written once for both engines
+    session = Session(addr, stream)
+    with sessions_lock:
+        active_sessions.add(session)
+    try:
+        yield from serve_session(session)
+    finally:
+        with sessions_lock:
+            active_sessions.discard(session)
+            closed_totals["connections"] += 1
+            if stream is not None:
+                closed_totals["bytes_in"] += stream.bytes_in
+                closed_totals["bytes_out"] += stream.bytes_out
+
+
+def serve_session(session):
+    conn = session.conn
+    addr = session.addr
     print(f"\n[NEW CONNECTION] {addr} connected.")
-    conn.send("Welcome to the server".encode(FORMAT))
+    capabilities = [CAP_DEDUP] if DEDUP else []
+    yield conn.send_frame(OP_OK, pack_fields("Welcome to the server", *capabilities))
 
     while True:
         try:
             # Receive a command from the client
-            data = conn.recv(SIZE).decode(FORMAT)
-            if not data:
+            frame = yield conn.recv_frame()
+            if frame is None:
                 print(f"[DISCONNECTED] {addr} disconnected.")
                 break
+            session.commands += 1
+            session.command = COMMAND_NAMES.get(frame.opcode, hex(frame.opcode))
+            session.command_started = time.monotonic()
 
-            #print(f"[RECEIVED DATA] {data} from {addr}")
-            command = data.split("@")
-            cmd = command[0]
-            if not authenticated:
-                if cmd == "AUTH":
-                    username = command[1]
-                    encrypted_password = command[2]
-                    if authenticate(username, encrypted_password):
-                        authenticated = True
-                        conn.send("OK@Authentication successful.".encode(FORMAT))
-                    else:
-                        conn.send("ERROR@Invalid credentials.".encode(FORMAT))
-                else:
-                    conn.send("ERROR@Please authenticate first.".encode(FORMAT))
+            if not session.authenticated:
+                yield from handle_auth(session, frame)
+                session.command = None
                 continue
-            
-            if cmd == "LOGOUT":
-                # Log the user out
-                start_time = time.perf_counter()
-                conn.send("OK@Logged out".encode(FORMAT))
-                stats_logger.record_response_time(cmd, start_time, end_time)    
-                print(f"[DISCONNECTED] {addr} logged out.")
-                break
 
-            elif cmd == "UPLOAD":
-                filename = command[1]
-                filesize = int(command[2])
-                filepath = os.path.join(SERVER_PATH, filename)
-
-                # Check if the file exists
-                if os.path.exists(filepath):
-                    # Notify the client about the existing file
-                    conn.send(f"ERROR@File {filename} already exists.".encode(FORMAT))
-                    
-                    # Wait for client response
-                    overwrite = conn.recv(SIZE).decode(FORMAT).strip().lower()
-                    if overwrite != "yes":
-                        conn.send("ERROR@Upload cancelled by user.".encode(FORMAT))
-                        print(f"[UPLOAD CANCELLED] Client declined to overwrite {filename}.")
-                        continue  # Ensure proper exit to process further commands
-
-                # Notify the client that the server is ready to receive the file
-                conn.send("OK@Ready to receive file".encode(FORMAT))
-
-                start_time = time.perf_counter()
-                
-                # Open the file to write incoming data
-                with open(filepath, "wb") as f:
-                    bytes_received = 0
-                    while bytes_received < filesize:
-                        chunk = conn.recv(SIZE)
-                        f.write(chunk)
-                        bytes_received += len(chunk)
-
-                end_time = time.perf_counter()
-                stats_logger.record_upload(filename, filesize, start_time, end_time)
-                
-                print(f"[UPLOAD COMPLETE] File {filename} uploaded successfully.")
-                conn.send(f"OK@File {filename} uploaded successfully.".encode(FORMAT))
-
-            elif cmd == "DIR":
-                start_time = time.perf_counter()
-                
-                # Handle directory listing
-                try:
-                    files = os.listdir(SERVER_PATH)
-                    if files:
-                        file_list = "\n".join(files)
-                    else:
-                        file_list = "No files in the server directory."
-                    conn.send(f"OK@{file_list}".encode(FORMAT))
-
-                    
-                except Exception as e:
-                    print(f"[ERROR] Failed to list directory contents: {e}")
-                    conn.send(f"ERROR@Failed to list directory contents.".encode(FORMAT))
-                finally:
-                    end_time = time.perf_counter()  # End timing
-                    stats_logger.record_response_time(cmd, start_time, end_time)    
-
-            elif cmd == "DOWNLOAD":
-                filename = command[1]
-                filepath = os.path.join(SERVER_PATH, filename)
-
-                # Check if the file exists
-                if not os.path.isfile(filepath):
-                    conn.send(f"ERROR@File {filename} not found.".encode(FORMAT))
-                else:
-                    filesize = os.path.getsize(filepath)
-                    conn.send(f"OK@{filename}@{filesize}".encode(FORMAT))  # Send metadata
-
-                    start_time = time.perf_counter()
-                    # Open the file and send its content in chunks
-                    with open(filepath, "rb") as f:
-                        while (chunk := f.read(SIZE)):
-                            conn.send(chunk)
-
-                    # Send end-of-file marker
-                    conn.send(b"END_FILE")
-
-                    end_time = time.perf_counter()
-                    stats_logger.record_download(filename, filesize, start_time, end_time)
-                    
-                    print(f"[DOWNLOAD COMPLETE] File {filename} sent to {addr}.")
-            
-            elif cmd == "CREATE":
-                start_time = time.perf_counter()
-                subfolder_path = os.path.join(SERVER_PATH, command[1])
-                try:
-                    os.makedirs(subfolder_path, exist_ok=True)
-                    conn.send(f"OK@Subfolder '{command[1]}' created successfully.".encode(FORMAT))
-                except Exception as e:
-                    conn.send(f"ERROR@Failed to create subfolder: {e}".encode(FORMAT))
-                    print(f"Received command: {cmd} with argument {command[1]}")
-
-                finally:
-                    end_time = time.perf_counter()  # End timing
-                    stats_logger.record_response_time(cmd, start_time, end_time)
-
-            elif cmd == "DELETE":
-                start_time = time.perf_counter()
-                
-                name = command[1]
-                path = os.path.join(SERVER_PATH, name)
-
-                # Check if the file exists
-                if not os.path.isfile(path) and not os.path.isdir(path):
-                    send_data = f"ERROR@File '{name}' not found."
-                elif os.path.isfile(path):
-                    try:
-                        # Attempt to delete the file
-                        os.remove(path)                       
-                        send_data = f"OK@File '{name}' deleted successfully."
-
-                    except Exception as e:
-                        conn.send(f"ERROR@Failed to delete subfolder: {e}".encode(FORMAT))
-
-                elif os.path.isdir(path):
-                    try:
-                        # Attempt to delete the subfolder
-                        os.rmdir(path)                        
-                        send_data = f"OK@Subdirectory '{name}' deleted successfully."
-
-                    except Exception as e:
-                        send_data = f"ERROR@Failed to delete subdirectory '{name}': {e}"
-                # Send the response to the client
-                conn.send(send_data.encode(FORMAT))
-
-                end_time = time.perf_counter()  # End tracking the command execution time
-                stats_logger.record_response_time(cmd, start_time, end_time)  # Log the response time
+            if frame.opcode == OP_LOGOUT:
+                yield from handle_logout(session, frame)
+                break
 
-            else:
+            handler = HANDLERS.get(frame.opcode)
+            if handler is None:
                 # Unknown command
-                conn.send("ERROR@Invalid command.".encode(FORMAT))
-                print(f"[ERROR] Unknown command received: {cmd}")
+                yield conn.send_frame(OP_ERROR, "Invalid command.", request_id=frame.request_id)
+                print(f"[ERROR] Unknown command received: {session.command}")
+                session.command = None
+                continue
+            yield from handler(session, frame)
+            session.command = None
 
         except Exception as e:
-                # Handle general exceptions for the entire loop
-                print(f"[ERROR] Exception with client {addr}: {e}")
-                conn.send(f"ERROR@Unexpected error: {e}".encode(FORMAT))
-                break  # Exit the loop on critical error
+            # Handle general exceptions for the entire loop
+            print(f"[ERROR] Exception with client {addr}: {e}")
+            yield conn.send_frame(OP_ERROR, f"Unexpected error: {e}")
+            break  # Exit the loop on critical error
 
-    conn.close()
-    print(f"[CONNECTION CLOSED] {addr}")
-               
 
-def main():
-    global is_running
-    # Main server function to accept and manage connections.
-    print("[STARTING] Server is starting...")
+def metrics_snapshot():
+    # Everything the metrics endpoint reports, called from its own thread
+    now = time.monotonic()
+    with sessions_lock:
+        sessions = list(active_sessions)
+        totals = dict(closed_totals)
+    connections = [session.metrics(now) for session in sessions]
+    # A plain int, safe to read from this thread unlike the loop's task set
+    tasks = connection_tasks
+    return {
+        "uptime_s": round(time.time() - started_at, 3),
+        "active_connections": len(connections),
+        "total_connections": totals["connections"] + len(connections),
+        "bytes_in": totals["bytes_in"] + sum(c["bytes_in"] for c in connections),
+        "bytes_out": totals["bytes_out"] + sum(c["bytes_out"] for c in connections),
+        "threads": threading.active_count(),
+        "tasks": tasks,
+        "commands": stats_logger.latency_summary(),
+        "throughput": stats_logger.throughput(),
+        "bandwidth": bandwidth.summary(),
+        "hot_cache": hot_files.summary(),
+        "connections": connections,
+    }
+
+
+def merged_snapshot(supervisor):
+    # metrics_snapshot() of every worker added up, for the supervisor's
+    # endpoint. Totals include workers that have exited, current numbers
+    # (connections, threads, rates) only the running ones.
+    live = set(supervisor.alive())
+    reports = worker_reports.copy()
+    merged = {
+        "uptime_s": round(time.time() - started_at, 3),
+        "active_connections": 0,
+        "total_connections": 0,
+        "bytes_in": 0,
+        "bytes_out": 0,
+        "threads": 0,
+        "tasks": None,
+        "commands": {},
+        "throughput": {},
+        "bandwidth": bandwidth.summary(),
+        "hot_cache": {},
+        "workers": [],
+        "connections": [],
+    }
+    histograms = {}  # command -> LatencyHistogram
+    rates = {}  # command -> requests per second
+    for pid, (index, snapshot, worker_histograms) in sorted(reports.items()):
+        running = pid in live
+        for name in ("total_connections", "bytes_in", "bytes_out"):
+            merged[name] += snapshot[name]
+        for command, histogram in worker_histograms.items():
+            histograms.setdefault(command, LatencyHistogram()).merge(histogram)
+        merged["workers"].append({"index": index, "pid": pid, "running": running,
+                                  "active_connections": snapshot["active_connections"] if running else 0,
+                                  "total_connections": snapshot["total_connections"]})
+        if not running:
+            continue
+        merged["active_connections"] += snapshot["active_connections"]
+        merged["threads"] += snapshot["threads"]
+        if snapshot["tasks"] is not None:
+            merged["tasks"] = (merged["tasks"] or 0) + snapshot["tasks"]
+        for command, latency in snapshot["commands"].items():
+            rates[command] = rates.get(command, 0.0) + latency["rate_per_s"]
+        for name in ("throughput", "hot_cache"):
+            for key, value in snapshot[name].items():
+                merged[name][key] = merged[name].get(key, 0) + value
+        merged["connections"].extend(dict(connection, worker=index) for connection in snapshot["connections"])
+    merged["commands"] = {command: dict(histogram.summary(), rate_per_s=rates.get(command, 0.0))
+                          for command, histogram in sorted(histograms.items())}
+    return merged
+
+
+def report_metrics(index):
+    # Worker side of the merged metrics: hand the supervisor a fresh snapshot
+    # every REPORT_INTERVAL seconds, and a last one on the way out
+    try:
+        worker_reports[os.getpid()] = (index, metrics_snapshot(), stats_logger.histograms())
+    except (OSError, EOFError) as e:
+        print(f"[ERROR] Could not report metrics of worker {index}: {e}")
+
+
+def drive(conn, handler):
+    # Run a handler against a blocking FrameSocket. Errors raised by the socket
+    # are thrown back into the handler so its own except/finally blocks run.
+    resume, value = handler.send, None
+    while True:
+        try:
+            name, args, kwargs = resume(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, resume = getattr(conn, name)(*args, **kwargs), handler.send
+        except Exception as e:
+            value, resume = e, handler.throw
+
+
+async def drive_async(stream, handler):
+    # Same as drive() but each recorded call is awaited on an AsyncFrameStream
+    resume, value = handler.send, None
+    while True:
+        try:
+            name, args, kwargs = resume(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value, resume = await getattr(stream, name)(*args, **kwargs), handler.send
+        except Exception as e:
+            value, resume = e, handler.throw
+
+
+def handle_client(sock, addr):
+    try:
+        conn = FrameSocket(sock, BUFFER_SIZE)
+        drive(conn, client_session(addr, conn))
+    except Exception as e:
+        print(f"[ERROR] Connection error with {addr}: {e}")
+    finally:
+        sock.close()
+        print(f"[CONNECTION CLOSED] {addr}")
+
+
+def refuse_connection(sock, addr):
+    print(f"[REFUSED] {addr}: connection limit of {MAX_CONNECTIONS} reached.")
+    try:
+        FrameSocket(sock).send_frame(OP_ERROR, "Server is at capacity, try again later.")
+    except OSError:
+        pass
+    sock.close()
+
+
+def make_listener():
+    # Socket options set on the listener are inherited by accepted sockets,
+    # and the receive buffer has to be sized before the handshake to get a
+    # matching TCP window
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tune_socket(server, BUFFER_SIZE)
+    if WORKERS > 1:
+        # Every worker listens on the port, the kernel spreads connections over them
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.bind(ADDR)
-    server.listen()
+    server.listen(LISTEN_BACKLOG)
+    return server
+
+
+def serve_threaded():
+    # Thread-per-connection engine
+    server = make_listener()
     print(f"[LISTENING] Server is listening on {IP}:{PORT}")
+    slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+
+    def run_client(conn, addr):
+        try:
+            handle_client(conn, addr)
+        finally:
+            slots.release()
 
     try:
         while is_running:
             server.settimeout(0.1)  # Allow periodic checks
             try:
                 conn, addr = server.accept()
-                thread = threading.Thread(target=handle_client, args=(conn, addr))
+                conn.settimeout(None)
+                tune_socket(conn, BUFFER_SIZE)
+                if not slots.acquire(blocking=False):
+                    refuse_connection(conn, addr)
+                    continue
+                thread = threading.Thread(target=run_client, args=(conn, addr))
                 thread.start()
                 print(f"\n[ACTIVE CONNECTIONS] {threading.active_count() - 2}")
             except socket.timeout:
@@ -265,10 +1315,243 @@ def main():
         print(f"[ERROR] {e}")
     finally:
         server.close()
-        stats_logger.save_stats_to_csv("server_network_stats.csv")
+
+
+async def serve_asyncio():
+    # Single-threaded asyncio engine: one task per connection instead of one
+    # thread, so idle clients only cost a coroutine and a socket
+    global connection_tasks
+    loop = asyncio.get_running_loop()
+    connection_tasks = 0
+    stop = asyncio.Event()
+    tasks = set()
+
+    def request_stop():
+        print("\n[INFO] Interrupt received. Shutting down server...")
+        stop.set()
+
+    # The loop owns the stop signal here, so no global flag is needed
+    loop.add_signal_handler(STOP_SIGNAL, request_stop)
+
+    async def on_connect(reader, writer):
+        global connection_tasks
+        addr = writer.get_extra_info("peername")
+        if len(tasks) >= MAX_CONNECTIONS:
+            print(f"[REFUSED] {addr}: connection limit of {MAX_CONNECTIONS} reached.")
+            try:
+                await AsyncFrameStream(reader, writer).send_frame(
+                    OP_ERROR, "Server is at capacity, try again later.")
+            except OSError:
+                pass
+            writer.close()
+            return
+        task = asyncio.current_task()
+        tasks.add(task)
+        connection_tasks += 1
+        print(f"\n[ACTIVE CONNECTIONS] {len(tasks)}")
+        try:
+            stream = AsyncFrameStream(reader, writer, BUFFER_SIZE)
+            await drive_async(stream, client_session(addr, stream))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[ERROR] Connection error with {addr}: {e}")
+        finally:
+            tasks.discard(task)
+            connection_tasks -= 1
+            writer.close()
+            print(f"[CONNECTION CLOSED] {addr}")
+
+    # The StreamReader limit decides when reading from a socket is paused
+    server = await asyncio.start_server(on_connect, sock=make_listener(), limit=BUFFER_SIZE, backlog=LISTEN_BACKLOG)
+    print(f"[LISTENING] Server is listening on {IP}:{PORT} (asyncio)")
+    try:
+        await stop.wait()
+    finally:
+        loop.remove_signal_handler(STOP_SIGNAL)
+        server.close()
+        for task in list(tasks):
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.wait_closed()
+
+
+def serve(engine):
+    if engine == "asyncio":
+        asyncio.run(serve_asyncio())
+    else:
+        serve_threaded()
+
+
+def print_latency(summary):
+    for command, latency in summary.items():
+        print(f"[STATS] {command}: {latency['count']} requests, p50 {latency['p50_ms']:.2f} ms, "
+              f"p99 {latency['p99_ms']:.2f} ms, p999 {latency['p999_ms']:.2f} ms")
+
+
+def run_worker(index, args):
+    # One worker process of the multi-process server (see workers.py). It
+    # serves like a single server would, except that the supervisor decides
+    # when to stop: Ctrl+C reaches the whole process group, but only the
+    # supervisor acts on it and then sends every worker SIGTERM.
+    global STOP_SIGNAL
+    STOP_SIGNAL = signal.SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal_handler)
+    stem, ext = os.path.splitext(args.stats_file)
+    stats_file = f"{stem}-worker{index}{ext}"
+    stats_logger.start(stats_file)
+
+    def reporter():
+        while is_running:
+            report_metrics(index)
+            time.sleep(REPORT_INTERVAL)
+
+    threading.Thread(target=reporter, name="metrics-report", daemon=True).start()
+    try:
+        serve(args.engine)
+    finally:
+        transfers.close_all()
+        stats_logger.save_stats_to_csv(stats_file)
+        report_metrics(index)
+        print(f"[WORKER] Worker {index} stopped.")
+
+
+def supervise(args):
+    # Multi-process mode: WORKERS forked workers serve the clients, this
+    # process restarts the ones that crash and serves their merged metrics.
+    # Session tokens and bandwidth buckets move into a manager process so
+    # that every worker sees the same ones.
+    global session_tokens, bandwidth, worker_reports
+    if not workers.supported():
+        print("[ERROR] --workers needs SO_REUSEPORT and fork (Linux or BSD).")
+        return
+    workers.share("tokens", session_tokens)
+    workers.share("bandwidth", bandwidth)
+    manager = workers.start_manager()
+    session_tokens = manager.tokens()
+    bandwidth = manager.bandwidth()
+    worker_reports = manager.dict()
+    supervisor = workers.Supervisor(WORKERS, run_worker, (args,))
+    signal.signal(signal.SIGTERM, signal_handler)
+    print(f"[STARTING] Server is starting ({WORKERS} workers, {args.engine} engine)...")
+    metrics_server = None
+    try:
+        supervisor.start()
+        if args.metrics_socket or args.metrics_port:
+            metrics_server = metrics.start(lambda: merged_snapshot(supervisor), port=args.metrics_port,
+                                           path=args.metrics_socket)
+            where = args.metrics_socket or f"http://127.0.0.1:{metrics_server.server_address[1]}/metrics"
+            print(f"[METRICS] Live metrics of all workers on {where}")
+        supervisor.run(lambda: is_running)
+    finally:
+        if metrics_server is not None:
+            metrics.stop(metrics_server)
+        supervisor.stop()
+        print_latency(merged_snapshot(supervisor)["commands"])
+        manager.shutdown()
+        print("[SHUTDOWN] Server has shut down.")
+
+
+ENGINES = ("threaded", "asyncio")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="File server")
+    parser.add_argument("--engine", choices=ENGINES, default="threaded",
+                        help="Connection engine (default: threaded)")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Refuse connections beyond this many")
+    parser.add_argument("--no-sendfile", action="store_true",
+                        help="Always send downloads through a userspace buffer")
+    parser.add_argument("--buffer-size", type=parse_size, default=BUFFER_SIZE,
+                        help="Transfer buffer per connection, e.g. 256K or 4M")
+    parser.add_argument("--storage", choices=("plain", "dedup"), default="plain",
+                        help="dedup stores uploads as content-addressed chunks")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="Never compress transfers, even when the client offers to")
+    parser.add_argument("--no-encryption", action="store_true",
+                        help="Send file payloads in plaintext even if the client asks for encryption")
+    parser.add_argument("--encrypt-chunk-size", type=parse_size, default=ENCRYPT_CHUNK_SIZE,
+                        help="Bytes per encrypted DATA frame, e.g. 64K or 1M")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve live metrics as JSON on http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--metrics-socket",
+                        help="Serve live metrics on this Unix socket instead")
+    parser.add_argument("--max-upload-size", type=parse_size, default=MAX_UPLOAD_SIZE,
+                        help="Largest file a client may upload, e.g. 10G (0: only limited by free disk space)")
+    parser.add_argument("--hot-cache-size", type=parse_size, default=HOT_CACHE_SIZE,
+                        help="Bytes of popular files kept memory-mapped for downloads, e.g. 1G (0: off)")
+    parser.add_argument("--fsync", action="store_true",
+                        help="Flush every upload to disk before it replaces the old version")
+    parser.add_argument("--session-ttl", type=int, default=SESSION_TTL,
+                        help="Seconds a session token stays valid, 0 to not hand out tokens")
+    parser.add_argument("--rate-limit", type=parse_size, default=RATE_LIMIT,
+                        help="Bytes per second of file data for all users together, e.g. 100M (0: no limit)")
+    parser.add_argument("--user-rate-limit", type=parse_size, default=USER_RATE_LIMIT,
+                        help="Bytes per second of file data per user, e.g. 20M (0: no limit)")
+    parser.add_argument("--user-rate", action="append", default=[], metavar="USER=RATE",
+                        help="Own limit for one user, e.g. user1=50M, can be repeated")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Worker processes sharing the port (Linux/BSD), each with its own engine")
+    parser.add_argument("--stats-file", default=STATS_FILE,
+                        help="Where stats are appended while the server runs, .csv or .parquet")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    global MAX_CONNECTIONS, ZERO_COPY, BUFFER_SIZE, DEDUP, COMPRESSION, ENCRYPTION, ENCRYPT_CHUNK_SIZE, SESSION_TTL
+    global HOT_CACHE_SIZE, FSYNC, RATE_LIMIT, USER_RATE_LIMIT, WORKERS, MAX_UPLOAD_SIZE
+    # Main server function to accept and manage connections.
+    args = parse_args(argv)
+    MAX_CONNECTIONS = args.max_connections
+    MAX_UPLOAD_SIZE = args.max_upload_size
+    ZERO_COPY = not args.no_sendfile
+    BUFFER_SIZE = max(args.buffer_size, SIZE)
+    DEDUP = args.storage == "dedup"
+    COMPRESSION = not args.no_compression
+    ENCRYPTION = not args.no_encryption
+    ENCRYPT_CHUNK_SIZE = args.encrypt_chunk_size
+    SESSION_TTL = session_tokens.ttl = args.session_ttl
+    FSYNC = storage.fsync = args.fsync
+    HOT_CACHE_SIZE = args.hot_cache_size
+    hot_files.capacity = HOT_CACHE_SIZE
+    hot_files.max_file = HOT_CACHE_SIZE // 4
+    RATE_LIMIT = args.rate_limit
+    USER_RATE_LIMIT = args.user_rate_limit
+    for limit in args.user_rate:
+        username, _, rate = limit.partition("=")
+        USER_RATE_LIMITS[username] = parse_size(rate)
+    bandwidth.configure(RATE_LIMIT, USER_RATE_LIMIT, USER_RATE_LIMITS)
+    if RATE_LIMIT or USER_RATE_LIMIT or USER_RATE_LIMITS:
+        print(f"[BANDWIDTH] Total {RATE_LIMIT or 'unlimited'}, per user {USER_RATE_LIMIT or 'unlimited'} bytes/s"
+              + "".join(f", {user} {rate}" for user, rate in USER_RATE_LIMITS.items()))
+    if DEDUP:
+        removed = chunk_store.collect_garbage(SERVER_PATH)
+        print(f"[STORAGE] Deduplicating storage, {removed} unreferenced chunks removed.")
+    WORKERS = max(args.workers, 1)
+    if WORKERS > 1:
+        supervise(args)
+        return
+    stats_logger.start(args.stats_file)
+    print(f"[STARTING] Server is starting ({args.engine} engine)...")
+    metrics_server = None
+    if args.metrics_socket or args.metrics_port:
+        metrics_server = metrics.start(metrics_snapshot, port=args.metrics_port, path=args.metrics_socket)
+        where = args.metrics_socket or f"http://127.0.0.1:{metrics_server.server_address[1]}/metrics"
+        print(f"[METRICS] Live metrics on {where}")
+
+    try:
+        serve(args.engine)
+    finally:
+        if metrics_server is not None:
+            metrics.stop(metrics_server)
+        transfers.close_all()  # Unfinished uploads stay staged so clients can resume them
+        stats_logger.save_stats_to_csv(args.stats_file)
         print("[INFO] Server network statistics saved.")
+        print_latency(stats_logger.latency_summary())
         print("[SHUTDOWN] Server has shut down.")
-        
+
+
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,187 @@
+import os
+import shutil
+import secrets
+import threading
+from contextlib import contextmanager
+
+from dirindex import relative
+from transfers import preallocate
+
+# Stored files and how they change.
+#
+# A new version of a file is always written to a staging file first and
+# renamed over the old one in a single os.replace, so a reader sees either
+# the old contents or the new ones, never a mix, and a dropped connection
+# or a crash leaves the old version in place. With fsync on, the staging
+# file is flushed to disk before the rename and the folder after it, so a
+# finished upload also survives a power cut.
+#
+# Every path has a reader/writer lock. Readers hold it while they look a
+# file up and open it, writers while they rename or remove it. A download
+# that has its file open keeps reading the version it opened, however long
+# it takes. The locks are only ever held for those few system calls and
+# never while waiting on the network.
+
+PREALLOCATE_MIN = 1024 * 1024  # Smaller files aren't worth a fallocate call
+
+
+def sync_path(path):
+    # Flush a file or folder (the names in it) to disk
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ReadWriteLock:
+    # Any number of readers or one writer. A waiting writer holds back new
+    # readers so a steady stream of downloads can't postpone it forever.
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if not self.readers:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+
+class PathLocks:
+    # One ReadWriteLock per path, kept only while someone holds or waits for it
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}  # path -> [ReadWriteLock, holders]
+
+    @contextmanager
+    def _entry(self, path):
+        with self.lock:
+            entry = self.locks.get(path)
+            if entry is None:
+                entry = self.locks[path] = [ReadWriteLock(), 0]
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[path]
+
+    @contextmanager
+    def reading(self, path):
+        with self._entry(path) as lock:
+            lock.acquire_read()
+            try:
+                yield
+            finally:
+                lock.release_read()
+
+    @contextmanager
+    def writing(self, path):
+        with self._entry(path) as lock:
+            lock.acquire_write()
+            try:
+                yield
+            finally:
+                lock.release_write()
+
+
+class Storage:
+    def __init__(self, root, staging_dir, fsync=False):
+        self.root = root
+        self.staging_dir = staging_dir  # Must be on the same filesystem as root
+        self.fsync = fsync
+        self.locks = PathLocks()
+        self.watchers = []  # Called with the path of every file replaced or removed
+        os.makedirs(root, exist_ok=True)
+        os.makedirs(staging_dir, exist_ok=True)
+
+    def path(self, name):
+        # Where a client-supplied name is stored. Raises ValueError for names
+        # that would end up outside the root, or at the root itself.
+        name = relative(name)
+        if not name:
+            raise ValueError("No file name given")
+        return os.path.join(self.root, name)
+
+    def target(self, name):
+        # path() of a file about to be written, its folder has to exist
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            raise ValueError(f"Folder of {name} not found")
+        return path
+
+    def reading(self, path):
+        return self.locks.reading(path)
+
+    def writing(self, path):
+        return self.locks.writing(path)
+
+    def staging_file(self, suffix):
+        return os.path.join(self.staging_dir, f"{secrets.token_hex(8)}.{suffix}")
+
+    def free_space(self):
+        # Bytes left for new files, uploads are staged and published on this
+        # filesystem
+        return shutil.disk_usage(self.staging_dir).free
+
+    def preallocate(self, f, size):
+        # Reserve the blocks of a large file before writing it so the
+        # filesystem can lay it out in one piece
+        if size >= PREALLOCATE_MIN:
+            f.flush()
+            preallocate(f.fileno(), size)
+
+    def publish(self, staging_path, path):
+        # Move a finished staging file over path
+        if self.fsync:
+            sync_path(staging_path)
+        with self.writing(path):
+            os.replace(staging_path, path)
+        if self.fsync:
+            sync_path(os.path.dirname(path))
+        self._changed(path)
+
+    def remove(self, path):
+        with self.writing(path):
+            if os.path.isdir(path):
+                os.rmdir(path)
+            else:
+                os.remove(path)
+        if self.fsync:
+            sync_path(os.path.dirname(path))
+        self._changed(path)
+
+    def _changed(self, path):
+        for watcher in self.watchers:
+            watcher(path)
+
+    def make_folder(self, path):
+        os.makedirs(path, exist_ok=True)
+        if self.fsync:
+            sync_path(os.path.dirname(path))
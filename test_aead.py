@@ -0,0 +1,66 @@
+import os
+import base64
+import unittest
+
+from aead import FrameCipher, ALGORITHMS, NONCE_SIZE, derive_keys, negotiate
+from protocol import OP_DATA, FLAG_END
+
+
+class FrameCipherTest(unittest.TestCase):
+    def setUp(self):
+        self.key = base64.urlsafe_b64encode(os.urandom(32))
+        self.client_nonce, self.server_nonce = os.urandom(NONCE_SIZE), os.urandom(NONCE_SIZE)
+
+    def pair(self, algorithm="aes-gcm"):
+        return (FrameCipher.for_client(algorithm, self.key, self.client_nonce, self.server_nonce),
+                FrameCipher.for_server(algorithm, self.key, self.client_nonce, self.server_nonce))
+
+    def test_frames_round_trip_in_both_directions(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                client, server = self.pair(algorithm)
+                for n in range(3):
+                    sealed = client.seal(OP_DATA, 0, 5, b"chunk %d" % n)
+                    self.assertEqual(server.open(OP_DATA, 0, 5, sealed), b"chunk %d" % n)
+                sealed = server.seal(OP_DATA, FLAG_END, 5, b"reply")
+                self.assertEqual(client.open(OP_DATA, FLAG_END, 5, sealed), b"reply")
+
+    def test_every_frame_gets_a_fresh_nonce(self):
+        client, server = self.pair()
+        first = client.seal(OP_DATA, 0, 1, b"same payload")
+        second = client.seal(OP_DATA, 0, 1, b"same payload")
+        self.assertNotEqual(first, second)
+        self.assertEqual(client.sent, 2)
+
+    def test_tampered_payload_is_rejected(self):
+        client, server = self.pair()
+        sealed = bytearray(client.seal(OP_DATA, 0, 1, b"payload"))
+        sealed[0] ^= 1
+        with self.assertRaises(ValueError):
+            server.open(OP_DATA, 0, 1, bytes(sealed))
+
+    def test_moved_end_flag_is_rejected(self):
+        client, server = self.pair()
+        sealed = client.seal(OP_DATA, 0, 1, b"not the last chunk")
+        with self.assertRaises(ValueError):
+            server.open(OP_DATA, FLAG_END, 1, sealed)
+
+    def test_reordered_frames_are_rejected(self):
+        client, server = self.pair()
+        client.seal(OP_DATA, 0, 1, b"first")
+        second = client.seal(OP_DATA, 0, 1, b"second")
+        with self.assertRaises(ValueError):
+            server.open(OP_DATA, 0, 1, second)
+
+    def test_keys_differ_per_direction_and_connection(self):
+        to_server, to_client = derive_keys(self.key, self.client_nonce, self.server_nonce)
+        self.assertNotEqual(to_server, to_client)
+        self.assertNotEqual(derive_keys(self.key, os.urandom(NONCE_SIZE), self.server_nonce)[0], to_server)
+
+    def test_negotiate_picks_the_first_known_algorithm(self):
+        self.assertEqual(negotiate("rot13,chacha20-poly1305,aes-gcm"), "chacha20-poly1305")
+        self.assertEqual(negotiate("rot13"), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
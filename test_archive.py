@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+
+from archive import Extractor, pack, entry_header, KIND_DIR, KIND_FILE, KIND_END
+from protocol import ProtocolError
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, "source")
+        self.target = os.path.join(self.tmp.name, "target")
+        os.makedirs(self.target)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.source, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def stream(self, small_file=100):
+        # The whole archive of self.source, large files read from their source
+        out = bytearray()
+        for piece, last in pack(self.source, small_file=small_file, batch_size=200):
+            if isinstance(piece, tuple):
+                source, size = piece
+                out += source.read(size)
+            else:
+                out += piece
+        return bytes(out)
+
+    def extract(self, stream, piece=37, **options):
+        extractor = Extractor(self.target, **options)
+        for start in range(0, len(stream), piece):
+            extractor.write(stream[start:start + piece])
+        extractor.finish()
+        return extractor
+
+    def read(self, name):
+        with open(os.path.join(self.target, name), "rb") as f:
+            return f.read()
+
+    def test_tree_round_trip(self):
+        files = {"a.txt": b"small", "empty": b"", "sub/deeper/big.bin": os.urandom(5000),
+                 "sub/b.txt": b"b" * 100}
+        for name, data in files.items():
+            self.write(name, data)
+        os.makedirs(os.path.join(self.source, "empty folder"))
+        os.utime(os.path.join(self.source, "a.txt"), ns=(10 ** 18, 10 ** 18))
+        extractor = self.extract(self.stream(), keep_metadata=True, small_file=100)
+        self.assertEqual(extractor.errors, [])
+        self.assertEqual((extractor.files, extractor.folders), (4, 3))
+        for name, data in files.items():
+            self.assertEqual(self.read(name), data)
+        self.assertTrue(os.path.isdir(os.path.join(self.target, "empty folder")))
+        self.assertEqual(os.stat(os.path.join(self.target, "a.txt")).st_mtime_ns, 10 ** 18)
+
+    def test_paths_leaving_the_tree_are_refused(self):
+        stream = (entry_header(KIND_FILE, "../outside.txt", 4) + b"evil"
+                  + entry_header(KIND_DIR, "sub/../../up")
+                  + entry_header(KIND_FILE, "kept.txt", 4) + b"good"
+                  + entry_header(KIND_END, ""))
+        extractor = self.extract(stream)
+        self.assertEqual(len(extractor.errors), 2)
+        self.assertEqual(os.listdir(self.tmp.name), ["target"])
+        self.assertEqual(os.listdir(self.target), ["kept.txt"])
+        self.assertEqual(self.read("kept.txt"), b"good")
+
+    def test_absolute_path_lands_inside_the_tree(self):
+        extractor = self.extract(entry_header(KIND_FILE, "/absolute.txt", 4) + b"data" + entry_header(KIND_END, ""))
+        self.assertEqual(extractor.errors, [])
+        self.assertEqual(self.read("absolute.txt"), b"data")
+
+    def test_stream_that_ends_early_is_reported(self):
+        self.write("a.txt", b"contents")
+        extractor = self.extract(self.stream()[:-5])
+        self.assertEqual(extractor.errors, [": archive ended early"])
+
+    def test_unknown_entry_kind_is_a_protocol_error(self):
+        with self.assertRaises(ProtocolError):
+            self.extract(entry_header(9, "x"))
+
+
+if __name__ == "__main__":
+    unittest.main()
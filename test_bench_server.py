@@ -0,0 +1,34 @@
+import io
+import argparse
+import unittest
+from contextlib import redirect_stdout
+
+from bench_server import parse_mix, compare, DEFAULT_MIX
+
+
+def scenario(ops_per_s, p99_ms, concurrency=10):
+    return {"engine": "asyncio", "buffer_size": 262144, "server_workers": 1, "concurrency": concurrency,
+            "operations": {"download": {"count": 100, "ops_per_s": ops_per_s, "p99_ms": p99_ms}}}
+
+
+class BenchServerTest(unittest.TestCase):
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix(DEFAULT_MIX), {"upload": 2, "download": 5, "dir": 2, "delete": 1})
+        self.assertEqual(parse_mix("dir"), {"dir": 1})
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_mix("stat=1")
+
+    def compare(self, results, baseline, threshold=0.1):
+        with redirect_stdout(io.StringIO()):
+            return compare(results, {"scenarios": baseline}, threshold)
+
+    def test_compare_flags_slower_runs_only(self):
+        baseline = [scenario(1000, 10.0)]
+        self.assertEqual(self.compare([scenario(950, 10.5)], baseline), 0)
+        self.assertEqual(self.compare([scenario(800, 10.0)], baseline), 1)
+        self.assertEqual(self.compare([scenario(1000, 12.0)], baseline), 1)
+        self.assertEqual(self.compare([scenario(500, 50.0, concurrency=100)], baseline), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import random
+import hashlib
+import tempfile
+import unittest
+
+import cas
+from cas import ChunkStore, chunk_file, read_manifest, write_manifest, pack_chunk_list, unpack_chunk_list, \
+    MIN_CHUNK, MAX_CHUNK
+
+
+class ChunkingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = random.Random(1).randbytes(3 * 1024 * 1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def chunks(self, data):
+        path = os.path.join(self.tmp.name, "file")
+        with open(path, "wb") as f:
+            f.write(data)
+        return list(chunk_file(path))
+
+    def test_chunks_cover_the_file(self):
+        chunks = self.chunks(self.data)
+        self.assertEqual(sum(length for offset, length, digest in chunks), len(self.data))
+        for offset, length, digest in chunks:
+            self.assertEqual(digest, hashlib.sha256(self.data[offset:offset + length]).digest())
+        for offset, length, digest in chunks[:-1]:
+            self.assertTrue(MIN_CHUNK <= length <= MAX_CHUNK)
+
+    def test_edit_keeps_the_chunks_before_it(self):
+        edit = 2 * 1024 * 1024
+        before = self.chunks(self.data)
+        after = self.chunks(self.data[:edit] + b"inserted" + self.data[edit:])
+        untouched = [chunk for chunk in before if chunk[0] + chunk[1] <= edit]
+        self.assertEqual(after[:len(untouched)], untouched)
+
+    def test_empty_file_is_one_empty_chunk(self):
+        self.assertEqual(self.chunks(b""), [(0, 0, hashlib.sha256().digest())])
+
+    @unittest.skipUnless(cas.np is not None, "needs numpy")
+    def test_numpy_and_python_find_the_same_boundaries(self):
+        data = self.data[:512 * 1024]
+        self.assertEqual(cas._candidates_numpy(data, 100), cas._candidates_python(data, 100))
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = ChunkStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def put(self, data, digest=None):
+        write, finish, discard = self.store.writer()
+        write(data)
+        return finish(digest or hashlib.sha256(data).hexdigest())
+
+    def test_chunk_that_doesnt_match_its_digest_is_dropped(self):
+        digest = hashlib.sha256(b"expected").hexdigest()
+        self.assertFalse(self.put(b"something else", digest))
+        self.assertEqual(self.store.missing([(digest, 8)]), [0])
+        self.assertEqual(os.listdir(self.store.tmp), [])
+
+    def test_range_hash_spans_chunks(self):
+        pieces = [b"first chunk ", b"second ", b"third"]
+        for piece in pieces:
+            self.assertTrue(self.put(piece))
+        chunks = [(hashlib.sha256(piece).hexdigest(), len(piece)) for piece in pieces]
+        self.assertEqual(self.store.missing(chunks), [])
+        data = b"".join(pieces)
+        self.assertEqual(self.store.sha256_range(chunks, 6, 12), hashlib.sha256(data[6:18]).hexdigest())
+
+    def test_digest_that_could_be_a_path_is_refused(self):
+        with self.assertRaises(ValueError):
+            self.store.object_path("../" + "a" * 61)
+
+    def test_chunk_list_round_trip(self):
+        chunks = [(hashlib.sha256(b"a").hexdigest(), 1), (hashlib.sha256(b"bc").hexdigest(), 2)]
+        self.assertEqual(unpack_chunk_list(pack_chunk_list((bytes.fromhex(digest), length)
+                                                           for digest, length in chunks)), chunks)
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "manifest")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        chunks = [["a" * 64, 3], ["b" * 64, 4]]
+        write_manifest(self.path, 7, chunks)
+        self.assertEqual(read_manifest(self.path), (7, [("a" * 64, 3), ("b" * 64, 4)]))
+
+    def test_size_that_doesnt_match_the_chunks_is_corrupt(self):
+        write_manifest(self.path, 8, [["a" * 64, 3]])
+        with self.assertRaises(ValueError):
+            read_manifest(self.path)
+
+    def test_plain_file_is_not_a_manifest(self):
+        with open(self.path, "wb") as f:
+            f.write(b"just data")
+        self.assertIsNone(read_manifest(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
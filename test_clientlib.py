@@ -0,0 +1,98 @@
+import os
+import time
+import unittest
+
+import server
+from clientlib import ConnectionPool, ServerError, save_token, load_token
+from test_server import ServerTestCase
+
+
+class ConnectionTest(ServerTestCase):
+    def test_token_logs_in_without_the_password(self):
+        def client():
+            with self.connect() as first:
+                with self.connect(password=None, token=first.token) as second:
+                    second.create("a")
+                    return first.resumed, second.resumed
+        self.assertEqual(self.serve_threaded(client), (False, True))
+
+    def test_revoked_token_falls_back_to_the_password(self):
+        def client():
+            with self.connect() as first:
+                token = first.token
+                first.revoke()
+            with self.connect(token=token) as second:
+                self.assertFalse(second.resumed)
+                self.assertNotEqual(second.token, token)
+                second.create("a")
+            with self.assertRaises(ServerError):
+                self.connect(password=None, token=token)
+        self.serve_threaded(client)
+        self.assertEqual(os.listdir(self.root), ["a"])
+
+    def test_expired_token_falls_back_to_the_password(self):
+        server.session_tokens.ttl = 0.2
+
+        def client():
+            with self.connect() as first:
+                token = first.token
+            time.sleep(0.3)
+            with self.connect(token=token) as second:
+                return second.resumed, second.token != token
+        self.assertEqual(self.serve_asyncio(client), (False, True))
+
+
+class ConnectionPoolTest(ServerTestCase):
+    def pool(self, **options):
+        return ConnectionPool(self.addr, "user1", "password1", key=server.key, **options)
+
+    def test_connections_are_reused(self):
+        def client():
+            with self.pool() as pool:
+                with pool.connection() as conn:
+                    conn.create("a")
+                with pool.connection() as again:
+                    # A refused request leaves the connection usable
+                    with self.assertRaises(ServerError):
+                        again.stat("missing")
+                with pool.connection() as last:
+                    return conn is again is last, last.stat("a")[0]
+        self.assertEqual(self.serve_threaded(client), (True, "dir"))
+
+    def test_token_file_is_replaced_once_its_token_is_refused(self):
+        token_file = os.path.join(self.tmp.name, "session")
+        save_token(token_file, "revoked")
+
+        def client():
+            with self.pool(token_file=token_file) as pool:
+                with pool.connection() as conn:
+                    self.assertFalse(conn.resumed)
+            with self.pool(token_file=token_file) as pool:
+                with pool.connection() as conn:
+                    self.assertTrue(conn.resumed)
+                    return conn.token
+        token = self.serve_threaded(client)
+        self.assertEqual(load_token(token_file), token)
+
+    def test_connection_that_failed_mid_transfer_is_not_reused(self):
+        data = os.urandom(1024 * 1024)
+
+        def client():
+            with self.pool() as pool:
+                with pool.connection() as conn:
+                    conn.upload(self.local("file.bin", data), "file.bin")
+                # The server is already sending the body when the local file can't be opened
+                with self.assertRaises(FileNotFoundError):
+                    with pool.connection() as conn:
+                        conn.download("file.bin", os.path.join(self.tmp.name, "missing", "file.bin"))
+                self.assertEqual(pool.idle, [])
+                self.assertEqual(conn.conn.sock.fileno(), -1)
+                with pool.connection() as fresh:
+                    self.assertIsNot(fresh, conn)
+                    target = os.path.join(self.tmp.name, "file.bin.copy")
+                    return fresh.download("file.bin", target)
+        self.assertEqual(self.serve_asyncio(client), len(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
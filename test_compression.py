@@ -0,0 +1,62 @@
+import os
+import zlib
+import unittest
+
+from compression import Compressor, Decompressor, CODECS, negotiate, BLOCK_SIZE, MAX_BLOCK, GIVE_UP, RETRY
+from protocol import FrameDecoder, encoded_frames, split_blocks, decode_payload, FLAG_COMPRESSED, FLAG_END, \
+    MAX_CONTROL_PAYLOAD, ProtocolError
+
+
+class CompressionTest(unittest.TestCase):
+    def frames(self, data, codec):
+        # (flags, payload) of the DATA frames a body is sent as
+        compressor = Compressor(codec)
+        decoder = FrameDecoder(MAX_CONTROL_PAYLOAD)
+        for frame in encoded_frames(split_blocks(data, BLOCK_SIZE), len(data), 7, compressor=compressor):
+            decoder.feed(frame)
+        frames = []
+        while (frame := decoder.next_frame()) is not None:
+            frames.append((frame.flags, frame.payload))
+        return frames, compressor
+
+    def test_compressed_frames_round_trip_with_every_codec(self):
+        data = b"".join(b"line %d of a very repetitive log file\n" % n for n in range(30000))
+        for codec in CODECS:
+            with self.subTest(codec=codec):
+                frames, compressor = self.frames(data, codec)
+                self.assertTrue(all(flags & FLAG_COMPRESSED for flags, payload in frames))
+                self.assertEqual(frames[-1][0] & FLAG_END, FLAG_END)
+                decompressor = Decompressor(codec)
+                body = b"".join(decode_payload(None, decompressor, flags, 7, payload) for flags, payload in frames)
+                self.assertEqual(body, data)
+                self.assertEqual((decompressor.logical, decompressor.wire), (compressor.logical, compressor.wire))
+                self.assertLess(compressor.wire, len(data) // 10)
+
+    def test_incompressible_blocks_go_raw_and_compression_backs_off(self):
+        compressor = Compressor("zlib")
+        for n in range(GIVE_UP):
+            self.assertEqual(compressor.encode(os.urandom(1000))[1], False)
+        self.assertEqual(compressor.skip, RETRY)
+        block = b"a" * 1000
+        self.assertEqual(compressor.encode(block), (block, False))
+
+    def test_block_inflating_past_the_limit_is_refused(self):
+        with self.assertRaises(ValueError):
+            Decompressor("zlib").decode(zlib.compress(b"\0" * (MAX_BLOCK + 1)))
+
+    def test_corrupt_frame_is_a_protocol_error(self):
+        with self.assertRaises(ProtocolError):
+            decode_payload(None, Decompressor("zlib"), FLAG_COMPRESSED, 0, b"not zlib at all")
+
+    def test_compressed_frame_without_negotiation_is_refused(self):
+        with self.assertRaises(ProtocolError):
+            decode_payload(None, None, FLAG_COMPRESSED, 0, zlib.compress(b"data"))
+
+    def test_negotiate_picks_the_first_known_codec(self):
+        self.assertEqual(negotiate("snappy,zlib"), "zlib")
+        self.assertEqual(negotiate("snappy"), "")
+        self.assertEqual(negotiate(""), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import random
+import tempfile
+import unittest
+
+import delta
+from delta import Patcher, compute_delta, signatures, unpack_signatures, weak_checksum, COPY, DELTA_COPY
+
+BLOCK = 2048
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old = random.Random(1).randbytes(200 * 1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def sync(self, old, new, piece=1000):
+        # (rebuilt file, error, stats) of a delta of new against old fed to a
+        # Patcher in small pieces
+        new_path = self.write("new", new)
+        stats = {}
+        with open(self.write("old", old), "rb") as basis:
+            stream = b"".join(compute_delta(new_path, BLOCK, unpack_signatures(signatures(basis, BLOCK)), stats))
+            out = bytearray()
+            patcher = Patcher(basis, BLOCK, out.extend)
+            for start in range(0, len(stream), piece):
+                patcher.write(stream[start:start + piece])
+            return bytes(out), patcher.finish(), stats
+
+    def test_edited_file_is_rebuilt_from_the_old_blocks(self):
+        new = self.old[:50000] + b"inserted" + self.old[50000:150000] + self.old[160000:] + b"appended"
+        rebuilt, error, stats = self.sync(self.old, new)
+        self.assertIsNone(error)
+        self.assertEqual(rebuilt, new)
+        self.assertGreater(stats["matched"], len(self.old) - 20 * 1024)
+        self.assertLess(stats["literal"], 3 * BLOCK)
+
+    def test_unrelated_file_goes_as_literals(self):
+        new = random.Random(2).randbytes(10000)
+        rebuilt, error, stats = self.sync(self.old, new)
+        self.assertIsNone(error)
+        self.assertEqual(rebuilt, new)
+        self.assertEqual(stats["matched"], 0)
+
+    def test_without_an_old_copy(self):
+        new_path = self.write("new", self.old)
+        out = bytearray()
+        patcher = Patcher(None, BLOCK, out.extend)
+        for piece in compute_delta(new_path, BLOCK, []):
+            patcher.write(piece)
+        self.assertIsNone(patcher.finish())
+        self.assertEqual(bytes(out), self.old)
+
+    def test_copy_past_the_old_file_is_an_error(self):
+        with open(self.write("old", self.old), "rb") as basis:
+            patcher = Patcher(basis, BLOCK, lambda data: None)
+            patcher.write(COPY.pack(DELTA_COPY, len(self.old) // BLOCK, 1))
+            self.assertIn("outside the old file", patcher.finish())
+
+    def test_truncated_stream_is_an_error(self):
+        new_path = self.write("new", self.old)
+        stream = b"".join(compute_delta(new_path, BLOCK, []))
+        patcher = Patcher(None, BLOCK, lambda data: None)
+        patcher.write(stream[:-1])
+        self.assertEqual(patcher.finish(), "Delta stream ended early")
+
+    def test_rolling_checksum_matches_each_window(self):
+        data = self.old[:BLOCK + 300]
+        rolling = delta._rolling_python(data, BLOCK)
+        self.assertEqual(len(rolling), 301)
+        for k in (0, 1, 150, 300):
+            self.assertEqual(rolling[k], weak_checksum(data[k:k + BLOCK]))
+
+
+if __name__ == "__main__":
+    unittest.main()
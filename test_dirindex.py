@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+
+from dirindex import DirectoryIndex
+
+
+class DirectoryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def names(self, index, folder=""):
+        return [entry[0] for entry in index.page(folder)[0]]
+
+    def create(self, index, name):
+        with index.changing(name):
+            open(os.path.join(self.root, name), "w").close()
+
+    def test_change_outside_the_server_survives_an_update(self):
+        index = DirectoryIndex(self.root)
+        self.assertEqual(self.names(index), [])
+        open(os.path.join(self.root, "outside.txt"), "w").close()
+        self.create(index, "uploaded.txt")
+        self.assertEqual(self.names(index), ["outside.txt", "uploaded.txt"])
+
+    def test_indexes_of_two_workers_see_each_others_files(self):
+        first, second = DirectoryIndex(self.root), DirectoryIndex(self.root)
+        self.assertEqual(self.names(first), [])
+        self.assertEqual(self.names(second), [])
+        for number in range(8):
+            self.create(second if number % 2 else first, f"file{number}.txt")
+        expected = [f"file{number}.txt" for number in range(8)]
+        self.assertEqual(self.names(first), expected)
+        self.assertEqual(self.names(second), expected)
+
+    def test_removed_file_leaves_the_listing(self):
+        index = DirectoryIndex(self.root)
+        self.create(index, "a.txt")
+        self.create(index, "b.txt")
+        with index.changing("a.txt"):
+            os.remove(os.path.join(self.root, "a.txt"))
+        self.assertEqual(self.names(index), ["b.txt"])
+
+    def test_scan_runs_without_the_lock(self):
+        held = []
+        index = DirectoryIndex(self.root, lambda path, st: held.append(index.lock.locked()) or st.st_size)
+        open(os.path.join(self.root, "a.txt"), "w").close()
+        self.assertEqual(self.names(index), ["a.txt"])
+        self.assertEqual(held, [False])
+
+
+if __name__ == "__main__":
+    unittest.main()
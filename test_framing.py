@@ -0,0 +1,79 @@
+import os
+import socket
+import threading
+import unittest
+
+from protocol import (FrameDecoder, FrameSocket, ProtocolError, encode_frame, encode_header, pack_fields,
+                      unpack_fields, HEADER, MAX_CONTROL_PAYLOAD, OP_DIR, OP_OK)
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_frames_split_and_coalesced_by_tcp_come_out_whole(self):
+        frames = [encode_frame(OP_DIR, pack_fields("folder", "", 10), request_id=1),
+                  encode_frame(OP_OK, "done", request_id=2),
+                  encode_frame(OP_OK, request_id=3)]
+        decoder = FrameDecoder()
+        decoded = []
+        for byte in b"".join(frames):
+            decoder.feed(bytes([byte]))
+            while (frame := decoder.next_frame()) is not None:
+                decoded.append(frame)
+        self.assertEqual([(frame.opcode, frame.request_id) for frame in decoded],
+                         [(OP_DIR, 1), (OP_OK, 2), (OP_OK, 3)])
+        self.assertEqual(unpack_fields(decoded[0].payload), ["folder", "", "10"])
+        self.assertEqual(decoded[1].payload, b"done")
+        self.assertEqual(unpack_fields(decoded[2].payload), [])
+
+    def test_oversized_control_frame_is_refused(self):
+        decoder = FrameDecoder()
+        decoder.feed(encode_header(OP_DIR, MAX_CONTROL_PAYLOAD + 1))
+        with self.assertRaises(ProtocolError):
+            decoder.next_frame()
+
+    def test_unknown_version_is_refused(self):
+        decoder = FrameDecoder()
+        decoder.feed(HEADER.pack(99, OP_OK, 0, 0, 0))
+        with self.assertRaises(ProtocolError):
+            decoder.next_frame()
+
+
+class FrameSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.sender, self.receiver = FrameSocket(self.left, 4096), FrameSocket(self.right, 4096)
+        self.data = os.urandom(100000)
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_body_split_over_several_frames(self):
+        def send():
+            self.sender.send_bytes(self.data[:30000], end=False)
+            self.sender.send_buffer(self.data, 30000)
+        # Sent from another thread so neither side blocks on a full socket buffer
+        thread = threading.Thread(target=send)
+        thread.start()
+        body = bytearray()
+        self.assertEqual(self.receiver.recv_body(body.extend), len(self.data))
+        thread.join()
+        self.assertEqual(bytes(body), self.data)
+
+    def test_control_frames_keep_their_request_id(self):
+        self.sender.send_frame(OP_OK, pack_fields("a", 1), request_id=7)
+        frame = self.receiver.recv_frame()
+        self.assertEqual((frame.opcode, frame.request_id, unpack_fields(frame.payload)), (OP_OK, 7, ["a", "1"]))
+
+    def test_control_frame_where_a_body_was_expected(self):
+        self.sender.send_frame(OP_OK, "not data")
+        with self.assertRaises(ProtocolError):
+            self.receiver.recv_body(lambda data: None)
+
+    def test_recv_bytes_refuses_bodies_over_the_limit(self):
+        self.sender.send_bytes(b"x" * 100)
+        with self.assertRaises(ProtocolError):
+            self.receiver.recv_bytes(99)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+from hotcache import HotFileCache
+from storage import Storage
+
+
+class HotFileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = Storage(os.path.join(self.tmp.name, "storage"), os.path.join(self.tmp.name, "staging"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def store(self, name, data):
+        # Written the way the server writes files: staged, then renamed in
+        path = self.storage.target(name)
+        staging_path = self.storage.staging_file("test")
+        with open(staging_path, "wb") as f:
+            f.write(data)
+        self.storage.publish(staging_path, path)
+        return path
+
+    def get(self, cache, path):
+        with open(path, "rb") as f:
+            data = cache.get(path, f, os.fstat(f.fileno()))
+        return None if data is None else bytes(data)
+
+    def test_file_is_mapped_once_it_is_popular(self):
+        cache = HotFileCache(1000, min_hits=3)
+        path = self.store("a", b"a" * 100)
+        self.assertIsNone(self.get(cache, path))
+        self.assertIsNone(self.get(cache, path))
+        self.assertEqual(self.get(cache, path), b"a" * 100)
+        self.assertEqual(self.get(cache, path), b"a" * 100)
+        self.assertEqual(cache.summary()["hits"], 1)
+
+    def test_least_recently_used_file_is_evicted_first(self):
+        cache = HotFileCache(300, min_hits=1, max_file=100)
+        paths = {name: self.store(name, name.encode() * 100) for name in "abcd"}
+        for name in "abc":
+            self.get(cache, paths[name])
+        self.get(cache, paths["a"])
+        self.get(cache, paths["d"])
+        self.assertEqual(list(cache.files), [paths["c"], paths["a"], paths["d"]])
+        self.assertEqual(cache.used, 300)
+
+    def test_replaced_file_is_not_served_from_the_old_mapping(self):
+        cache = HotFileCache(1000, min_hits=1)
+        path = self.store("a", b"old" * 10)
+        self.assertEqual(self.get(cache, path), b"old" * 10)
+        self.store("a", b"new" * 10)
+        self.assertEqual(self.get(cache, path), b"new" * 10)
+
+    def test_storage_changes_drop_the_mapping(self):
+        cache = HotFileCache(1000, min_hits=1)
+        self.storage.watchers.append(cache.invalidate)
+        path = self.store("a", b"data")
+        self.get(cache, path)
+        self.assertIn(path, cache.files)
+        self.storage.remove(path)
+        self.assertEqual((cache.files, cache.used), ({}, 0))
+
+    def test_files_over_the_budget_are_never_cached(self):
+        cache = HotFileCache(400, min_hits=1)
+        path = self.store("big", b"x" * 101)
+        for attempt in range(3):
+            self.assertIsNone(self.get(cache, path))
+        self.assertEqual(cache.used, 0)
+        self.assertIsNone(self.get(HotFileCache(0, min_hits=1), self.store("small", b"x")))
+
+
+if __name__ == "__main__":
+    unittest.main()
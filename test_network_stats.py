@@ -0,0 +1,100 @@
+import os
+import csv
+import tempfile
+import unittest
+
+from network_stats import NetworkStats, LatencyHistogram, COLUMNS
+
+BASELINE_CSV = """operation,command,response_time_ms,filename,filesize_bytes,rate_mb_s,time_s
+response,DIR,0.208,,,,
+upload,,,test.txt,16384.0,19.328,0.0008
+"""
+
+
+class NetworkStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "stats.csv")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def rows(self):
+        with open(self.path, newline="") as f:
+            return list(csv.DictReader(f))
+
+    def test_flushed_rows_match_what_was_recorded(self):
+        stats = NetworkStats(capacity=16)
+        stats.path = self.path
+        stats.record_upload("up.bin", 2048, 10.0, 10.5, wire_bytes=1024, compression="zlib")
+        stats.record_download("down.bin", 4096, 20.0, 21.0, transfer_path="sendfile")
+        stats.record_response_time("DIR", 30.0, 30.25)
+        stats.flush()
+        rows = self.rows()
+        self.assertEqual([row["operation"] for row in rows], ["upload", "download", "response"])
+        self.assertEqual((rows[0]["filename"], float(rows[0]["filesize_bytes"]), float(rows[0]["wire_bytes"]),
+                          rows[0]["compression"]), ("up.bin", 2048, 1024, "zlib"))
+        self.assertAlmostEqual(float(rows[0]["time_s"]), 0.5)
+        self.assertEqual((rows[1]["filename"], rows[1]["transfer_path"]), ("down.bin", "sendfile"))
+        self.assertEqual((rows[2]["command"], float(rows[2]["response_time_ms"]), rows[2]["filename"]),
+                         ("DIR", 250.0, ""))
+        # A second flush only appends what came since
+        stats.record_response_time("STAT", 40.0, 40.001)
+        stats.flush()
+        self.assertEqual([row["command"] for row in self.rows()], ["", "", "DIR", "STAT"])
+        self.assertEqual(stats.dropped, 0)
+
+    def test_full_ring_overwrites_the_oldest_rows(self):
+        stats = NetworkStats(capacity=4)
+        stats.path = self.path
+        for number in range(6):
+            stats.record_response_time(f"CMD{number}", 0.0, 0.001)
+        stats.flush()
+        self.assertEqual([row["command"] for row in self.rows()], ["CMD2", "CMD3", "CMD4", "CMD5"])
+        self.assertEqual(stats.dropped, 2)
+        # Histograms count every request, dropped rows included
+        self.assertEqual(sum(histogram.count for histogram in stats.latency.values()), 6)
+
+    def test_baseline_csv_is_migrated_and_appended_to(self):
+        with open(self.path, "w", newline="") as f:
+            f.write(BASELINE_CSV)
+        stats = NetworkStats()
+        stats.start(self.path)
+        stats.record_response_time("STAT", 0.0, 0.002)
+        stats.save_stats_to_csv(self.path)
+        with open(self.path, newline="") as f:
+            self.assertEqual(f.readline().strip(), ",".join(COLUMNS))
+        rows = self.rows()
+        self.assertEqual([(row["operation"], row["command"]) for row in rows],
+                         [("response", "DIR"), ("upload", ""), ("response", "STAT")])
+        self.assertEqual((rows[1]["filename"], rows[1]["rate_mb_s"]), ("test.txt", "19.328"))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "stats_latency.csv")))
+
+
+class LatencyHistogramTest(unittest.TestCase):
+    def test_percentiles_are_close(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 1001):
+            histogram.record(ms / 1000)
+        summary = histogram.summary()
+        self.assertEqual(summary["count"], 1000)
+        self.assertAlmostEqual(summary["p50_ms"], 500, delta=500 * 0.04)
+        self.assertAlmostEqual(summary["p99_ms"], 990, delta=990 * 0.04)
+        self.assertEqual(summary["max_ms"], 1000)
+
+    def test_merged_histograms_add_up(self):
+        first, second = LatencyHistogram(), LatencyHistogram()
+        for n in range(100):
+            first.record(0.001)
+            second.record(0.1)
+        first.merge(second)
+        self.assertEqual(first.count, 200)
+        self.assertAlmostEqual(first.percentile(0.25), 1, delta=0.05)
+        self.assertAlmostEqual(first.percentile(0.75), 100, delta=4)
+
+    def test_empty_histogram(self):
+        self.assertEqual(LatencyHistogram().percentile(0.99), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
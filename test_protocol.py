@@ -0,0 +1,48 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from protocol import FrameSocket, file_range
+
+
+class FileTransferTest(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+        self.sender, self.receiver = FrameSocket(self.left, 4096), FrameSocket(self.right, 4096)
+        self.tmp = tempfile.TemporaryFile()
+        self.data = os.urandom(100000)
+        self.tmp.write(self.data)
+        self.tmp.flush()
+
+    def tearDown(self):
+        self.tmp.close()
+        self.left.close()
+        self.right.close()
+
+    def transfer(self, send):
+        # Body received while send() runs in another thread, so neither side
+        # blocks on a full socket buffer
+        thread = threading.Thread(target=send)
+        thread.start()
+        body = bytearray()
+        total = self.receiver.recv_body(body.extend)
+        thread.join()
+        self.assertEqual(total, len(body))
+        return bytes(body)
+
+    def test_file_ranges_round_trip_with_and_without_sendfile(self):
+        for zero_copy in (True, False):
+            body = self.transfer(lambda: self.sender.send_file(self.tmp, 1000, 50000, zero_copy=zero_copy))
+            self.assertEqual(body, self.data[1000:51000])
+
+    def test_file_range_is_clamped_to_the_file(self):
+        self.assertEqual(file_range(self.tmp, 90000, None), 10000)
+        self.assertEqual(file_range(self.tmp, 90000, 50000), 10000)
+        with self.assertRaises(ValueError):
+            file_range(self.tmp, len(self.data) + 1, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+from ratelimit import TokenBucket, BandwidthLimiter, Lease, throttle
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_bucket_refills_at_its_rate(self):
+        bucket = TokenBucket(1000)
+        now = bucket.updated
+        self.assertEqual(bucket.take(1000, now), 0.0)
+        self.assertAlmostEqual(bucket.take(500, now), 0.5)
+        # Half a second later the debt is paid off, a second later it is full again
+        self.assertEqual(bucket.take(0, now + 0.5), 0.0)
+        self.assertAlmostEqual(bucket.take(1000, now + 1.5), 0.0)
+        self.assertAlmostEqual(bucket.take(250, now + 1.5), 0.25)
+
+    def test_refill_stops_at_the_burst(self):
+        bucket = TokenBucket(1000, burst=2000)
+        now = bucket.updated
+        self.assertEqual(bucket.take(2000, now + 60), 0.0)
+        self.assertAlmostEqual(bucket.take(1000, now + 60), 1.0)
+
+
+class BandwidthLimiterTest(unittest.TestCase):
+    def test_unlimited_users_get_no_throttle(self):
+        limiter = BandwidthLimiter(user_rates={"user1": 1000})
+        self.assertIsNone(throttle(limiter, "user2"))
+        self.assertIsNotNone(throttle(limiter, "user1"))
+
+    def test_active_users_share_the_global_rate(self):
+        limiter = BandwidthLimiter(rate=1000)
+        self.assertEqual(limiter.delay("user1", 0), 0.0)
+        limiter.delay("user2", 0)
+        limiter.delay("user1", 0)  # Its share is worked out again with user2 active
+        self.assertEqual(limiter.users["user1"].rate, 500)
+        self.assertEqual(limiter.users["user2"].rate, 500)
+
+    def test_unused_share_of_a_slower_user_goes_to_the_others(self):
+        limiter = BandwidthLimiter(rate=1000, user_rates={"slow": 100})
+        for user in ("slow", "fast", "slow"):
+            limiter.delay(user, 0)
+        self.assertEqual(limiter.users["slow"].rate, 100)
+        self.assertEqual(limiter.users["fast"].rate, 900)
+
+
+class Remote:
+    # Stands in for the manager's proxy of a limiter, which isn't a BandwidthLimiter
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def limited(self, username):
+        return self.limiter.limited(username)
+
+    def lease(self, username, amount, duration):
+        return self.limiter.lease(username, amount, duration)
+
+
+class LeaseTest(unittest.TestCase):
+    def test_shared_limiter_is_asked_once_per_lease(self):
+        limiter = BandwidthLimiter(user_rate=1_000_000)
+        pace = throttle(Remote(limiter), "user1")
+        self.assertIsInstance(pace, Lease)
+        # 0.1 s of 1 MB/s covers ten 10 kB buffers
+        waits = [pace(10_000) for n in range(25)]
+        self.assertEqual(pace.leases, 3)
+        self.assertEqual(waits.count(0.0), 25)
+        self.assertEqual(limiter.users["user1"].rate, 1_000_000)
+
+    def test_lease_covers_a_buffer_larger_than_its_time(self):
+        limiter = BandwidthLimiter(user_rate=1000)
+        pace = throttle(Remote(limiter), "user1")
+        self.assertAlmostEqual(pace(1000), 0.0, places=2)
+        self.assertAlmostEqual(pace(500), 0.5, places=2)
+        self.assertEqual(pace.leases, 2)
+
+    def test_local_limiter_is_not_leased(self):
+        self.assertNotIsInstance(throttle(BandwidthLimiter(rate=1000), "user1"), Lease)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,275 @@
+import os
+import signal
+import asyncio
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import server
+from client import pipeline, command_request
+from clientlib import Connection
+from protocol import (AsyncFrameStream, Frame, encode_frame, pack_fields, unpack_fields, OP_DATA, OP_BATCH, OP_OK,
+                      OP_ERROR, FLAG_END)
+from storage import Storage
+from transfers import TransferRegistry
+from hotcache import HotFileCache
+from cas import ChunkStore
+from tokens import TokenStore
+from dirindex import DirectoryIndex
+
+
+class ServerTestCase(unittest.TestCase):
+    # Runs the server of this process on an ephemeral port of 127.0.0.1,
+    # with its storage in a temporary folder
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        root = os.path.join(self.tmp.name, "storage")
+        staging = os.path.join(self.tmp.name, "staging")
+        storage = Storage(root, staging)
+        hot_files = HotFileCache(server.HOT_CACHE_SIZE)
+        storage.watchers.append(hot_files.invalidate)
+        with mock.patch.object(server, "ADDR", ("127.0.0.1", 0)):
+            listener = server.make_listener()
+        self.addCleanup(listener.close)
+        self.addr = listener.getsockname()
+        self.patch(storage=storage,
+                   transfers=TransferRegistry(staging, publish=storage.publish),
+                   hot_files=hot_files,
+                   chunk_store=ChunkStore(os.path.join(self.tmp.name, "cas")),
+                   session_tokens=TokenStore(server.SESSION_TTL),
+                   dir_index=DirectoryIndex(root, lambda path, st: st.st_size),
+                   make_listener=lambda: listener,
+                   STOP_SIGNAL=signal.SIGUSR1,
+                   is_running=True)
+        self.root = root
+
+    def patch(self, **values):
+        for name, value in values.items():
+            patcher = mock.patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def connect(self, **options):
+        options.setdefault("password", "password1")
+        return Connection(self.addr, "user1", key=server.key, **options)
+
+    def local(self, name, data=b""):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def serve_threaded(self, client):
+        # client() while the threaded engine runs in the background
+        thread = threading.Thread(target=server.serve_threaded)
+        thread.start()
+        try:
+            return client()
+        finally:
+            server.is_running = False
+            thread.join()
+
+    def serve_asyncio(self, client):
+        # client() in an executor thread while the asyncio engine runs on
+        # this thread, which owns the loop's stop signal
+        async def run():
+            serving = asyncio.create_task(server.serve_asyncio())
+            await asyncio.sleep(0)  # Until the stop signal handler is in place
+            try:
+                return await asyncio.get_running_loop().run_in_executor(None, client)
+            finally:
+                os.kill(os.getpid(), server.STOP_SIGNAL)
+                await serving
+        return asyncio.run(run())
+
+
+class EngineTest(ServerTestCase):
+    def round_trip(self):
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        with self.connect() as conn:
+            conn.create("folder")
+            # Several ranges, each body split over many frames and reads
+            message = conn.upload(self.local("upload.bin", data), "folder/file.bin", chunk_size=1024 * 1024)
+            self.assertIn("uploaded", message)
+            conn.upload(self.local("empty.txt"), "folder/empty.txt")
+            self.assertEqual(conn.stat("folder/file.bin")[:2], ("file", len(data)))
+            listing = {name: size for name, kind, size, mtime_ns in conn.list("folder")}
+            self.assertEqual(listing, {"file.bin": len(data), "empty.txt": 0})
+            target = os.path.join(self.tmp.name, "download.bin")
+            self.assertEqual(conn.download("folder/file.bin", target), len(data))
+            with open(target, "rb") as f:
+                self.assertEqual(f.read(), data)
+            self.assertIsNone(conn.download("folder/file.bin", target))
+            # A range lands at its offset in the local copy
+            ranged = self.local("ranged.bin", b"x" * 100)
+            self.assertEqual(conn.download("folder/file.bin", ranged, offset=1000, length=5000), 5000)
+            with open(ranged, "rb") as f:
+                self.assertEqual(f.read(), b"x" * 100 + bytes(900) + data[1000:6000])
+        with open(os.path.join(self.root, "folder", "file.bin"), "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_threaded_round_trip(self):
+        self.serve_threaded(self.round_trip)
+
+    def test_asyncio_round_trip(self):
+        self.serve_asyncio(self.round_trip)
+
+    def test_asyncio_connections_are_served_concurrently(self):
+        def client():
+            first, second = self.connect(), self.connect()
+            with first, second:
+                first.create("a")
+                second.create("b")
+                return sorted(name for name, kind, size, mtime_ns in first.list())
+        self.assertEqual(self.serve_asyncio(client), ["a", "b"])
+
+    def test_asyncio_stop_closes_open_connections(self):
+        def client():
+            conn = self.connect()
+            return conn  # Left open, the engine has to cancel its task
+        conn = self.serve_asyncio(client)
+        self.assertIsNone(conn.conn.recv_frame())
+        conn.close(logout=False)
+
+
+class BatchTest(ServerTestCase):
+    def batch(self, conn, items):
+        # (succeeded, [(status, result)]) of a BATCH of "OPERATION<TAB>name" items
+        rid = conn._next_id()
+        conn.conn.send_frame(OP_BATCH, pack_fields(len(items)), request_id=rid)
+        conn.conn.send_bytes("\n".join(items).encode(), request_id=rid)
+        reply = conn.conn.recv_frame()
+        self.assertEqual((reply.opcode, reply.request_id), (OP_OK, rid))
+        total, succeeded, length = map(int, unpack_fields(reply.payload))
+        results = conn.conn.recv_bytes(length).decode().split("\n")
+        self.assertEqual(total, len(results))
+        return succeeded, [tuple(result.split("\t", 1)) for result in results]
+
+    def test_mixed_batch(self):
+        def client():
+            with self.connect() as conn:
+                return self.batch(conn, ["CREATE\tfolder", "CREATE\tfolder/sub", "STAT\tfolder",
+                                         "DELETE\tfolder/sub", "STAT\tfolder/sub"])
+        succeeded, results = self.serve_threaded(client)
+        self.assertEqual(succeeded, 4)
+        self.assertEqual([status for status, result in results], ["OK", "OK", "OK", "OK", "ERROR"])
+        self.assertTrue(results[2][1].startswith("folder\tdir\t0\t"))
+        self.assertEqual(os.listdir(self.root), ["folder"])
+        self.assertEqual(os.listdir(os.path.join(self.root, "folder")), [])
+
+    def test_failed_item_does_not_stop_the_rest(self):
+        def client():
+            with self.connect() as conn:
+                return self.batch(conn, ["DELETE\tmissing.txt", "CREATE\ta", "STAT\tmissing.txt", "CREATE\tb"])
+        succeeded, results = self.serve_asyncio(client)
+        self.assertEqual(succeeded, 2)
+        self.assertEqual([status for status, result in results], ["ERROR", "OK", "ERROR", "OK"])
+        self.assertIn("not found", results[0][1])
+        self.assertEqual(sorted(os.listdir(self.root)), ["a", "b"])
+
+    def test_disallowed_operations_and_paths_outside_the_root(self):
+        def client():
+            with self.connect() as conn:
+                return self.batch(conn, ["UPLOAD\tfile.txt", "TREE_DELETE\t.", "CREATE\t",
+                                         "CREATE\t../outside", "DELETE\t../storage", "STAT\ta/../../staging",
+                                         "create\tkept"])
+        succeeded, results = self.serve_threaded(client)
+        self.assertEqual(succeeded, 1)
+        self.assertEqual([status for status, result in results], ["ERROR"] * 6 + ["OK"])
+        self.assertTrue(all(result.startswith("Invalid batch item") for status, result in results[:3]))
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ["cas", "staging", "storage"])
+        self.assertEqual(os.listdir(self.root), ["kept"])
+
+    def test_batch_without_an_item_count_is_refused(self):
+        def client():
+            with self.connect() as conn:
+                conn.conn.send_frame(OP_BATCH, pack_fields("many"), request_id=1)
+                conn.conn.send_bytes(b"CREATE\ta", request_id=1)
+                reply = conn.conn.recv_frame()
+                # The body was read, the connection is still in step
+                conn.create("b")
+                return reply
+        reply = self.serve_threaded(client)
+        self.assertEqual(reply.opcode, OP_ERROR)
+        self.assertEqual(os.listdir(self.root), ["b"])
+
+
+class PipelineTest(ServerTestCase):
+    def test_replies_are_matched_to_their_requests(self):
+        lines = ["CREATE a", "STAT a", "DELETE missing", "DIR", "DELETE a", "STAT a"]
+        requests = [command_request(line) for line in lines]
+
+        def client():
+            with self.connect() as conn:
+                return pipeline(conn.conn, requests, 100, window=2)
+        replies = self.serve_asyncio(client)
+        self.assertEqual([reply.request_id for reply in replies], list(range(100, 106)))
+        self.assertEqual([reply.opcode for reply in replies], [OP_OK, OP_OK, OP_ERROR, OP_OK, OP_OK, OP_ERROR])
+        self.assertEqual(unpack_fields(replies[1].payload)[:2], ["a", "dir"])
+
+    def test_replies_out_of_order(self):
+        class Replies:
+            # Answers every request once all of them are in, last first
+            def __init__(self):
+                self.sent = []
+                self.replies = []
+
+            def send_frame(self, opcode, payload=b"", flags=0, request_id=0):
+                self.sent.append(request_id)
+                if len(self.sent) == 3:
+                    self.replies = [Frame(OP_OK, 0, rid, str(rid).encode()) for rid in self.sent]
+
+            def recv_frame(self):
+                return self.replies.pop()
+
+        replies = pipeline(Replies(), [command_request("STAT x")] * 3, 7)
+        self.assertEqual([reply.payload for reply in replies], [b"7", b"8", b"9"])
+
+    def test_reply_to_an_unknown_request(self):
+        class Stray:
+            def send_frame(self, opcode, payload=b"", flags=0, request_id=0):
+                pass
+
+            def recv_frame(self):
+                return Frame(OP_OK, 0, 99, b"")
+
+        with self.assertRaises(ConnectionError):
+            pipeline(Stray(), [command_request("STAT x")], 1)
+
+
+class AsyncFrameStreamTest(unittest.TestCase):
+    def test_body_split_across_reads(self):
+        payload = os.urandom(100000)
+        data = encode_frame(OP_DATA, payload[:60000]) + encode_frame(OP_DATA, payload[60000:], FLAG_END)
+
+        async def run():
+            reader = asyncio.StreamReader()
+            stream = AsyncFrameStream(reader, None, 4096)
+            body = bytearray()
+            receiving = asyncio.create_task(stream.recv_body(body.extend))
+            # Pieces that cut through headers and payloads alike
+            for start in range(0, len(data), 7001):
+                reader.feed_data(data[start:start + 7001])
+                await asyncio.sleep(0)
+            reader.feed_eof()
+            return await receiving, bytes(body)
+
+        total, body = asyncio.run(run())
+        self.assertEqual((total, body), (len(payload), payload))
+
+    def test_stream_closed_mid_body(self):
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(encode_frame(OP_DATA, b"x" * 1000)[:500])
+            reader.feed_eof()
+            await AsyncFrameStream(reader, None).recv_body(lambda data: None)
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from storage import Storage, PathLocks
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "storage")
+        self.storage = Storage(self.root, os.path.join(self.tmp.name, "staging"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def staged(self, storage, data):
+        path = storage.staging_file("test")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_names_outside_the_root_are_refused(self):
+        for name in ("../x", "/etc/passwd", "a/../../x", "", "/"):
+            with self.subTest(name=name), self.assertRaises(ValueError):
+                self.storage.target(name)
+
+    def test_absolute_names_stay_inside_the_root(self):
+        self.assertEqual(self.storage.path("/etc/passwd"), os.path.join(self.root, "etc", "passwd"))
+
+    def test_publish_replaces_the_file_in_one_step(self):
+        path = self.storage.target("file.txt")
+        changed = []
+        self.storage.watchers.append(changed.append)
+        self.storage.publish(self.staged(self.storage, b"old"), path)
+        with open(path, "rb") as reader:
+            staging_path = self.staged(self.storage, b"new")
+            self.storage.publish(staging_path, path)
+            # A reader that had the file open keeps the version it opened
+            self.assertEqual(reader.read(), b"old")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"new")
+        self.assertFalse(os.path.exists(staging_path))
+        self.assertEqual(os.listdir(self.storage.staging_dir), [])
+        self.assertEqual(changed, [path, path])
+
+    def test_fsync_flushes_file_and_folder(self):
+        storage = Storage(self.root, os.path.join(self.tmp.name, "staging"), fsync=True)
+        path = storage.target("file.txt")
+        staging_path = self.staged(storage, b"data")
+        with mock.patch("os.fsync", wraps=os.fsync) as fsync:
+            storage.publish(staging_path, path)
+            self.assertEqual(fsync.call_count, 2)
+            storage.make_folder(storage.path("folder"))
+            storage.remove(path)
+            self.assertEqual(fsync.call_count, 4)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.isdir(os.path.join(self.root, "folder")))
+
+
+class PathLocksTest(unittest.TestCase):
+    def read_in_thread(self, locks, path):
+        # Event set once another thread got the read lock of path
+        acquired = threading.Event()
+
+        def read():
+            with locks.reading(path):
+                acquired.set()
+
+        threading.Thread(target=read, daemon=True).start()
+        return acquired
+
+    def test_writer_excludes_readers_of_the_same_path_only(self):
+        locks = PathLocks()
+        with locks.writing("a"):
+            same = self.read_in_thread(locks, "a")
+            other = self.read_in_thread(locks, "b")
+            self.assertTrue(other.wait(2))
+            self.assertFalse(same.wait(0.2))
+        self.assertTrue(same.wait(2))
+
+    def test_readers_share_a_path(self):
+        locks = PathLocks()
+        with locks.reading("a"):
+            self.assertTrue(self.read_in_thread(locks, "a").wait(2))
+
+    def test_locks_are_dropped_once_released(self):
+        locks = PathLocks()
+        with locks.writing("a"):
+            pass
+        with locks.reading("b"):
+            self.assertEqual(list(locks.locks), ["b"])
+        self.assertEqual(locks.locks, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
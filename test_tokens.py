@@ -0,0 +1,38 @@
+import unittest
+
+from tokens import TokenStore
+
+
+class TokenStoreTest(unittest.TestCase):
+    def test_issued_token_logs_in_its_user(self):
+        store = TokenStore()
+        token = store.issue("user1")
+        self.assertEqual(store.check(token), "user1")
+        self.assertIsNone(store.check(token + "x"))
+        self.assertNotIn(token.encode(), b"".join(store.tokens))
+
+    def test_expired_token_is_refused(self):
+        store = TokenStore(ttl=-1)
+        self.assertIsNone(store.check(store.issue("user1")))
+        self.assertEqual(len(store.tokens), 0)
+
+    def test_revoke_one_token_or_all_of_a_user(self):
+        store = TokenStore()
+        first, second, other = store.issue("user1"), store.issue("user1"), store.issue("user2")
+        self.assertTrue(store.revoke(first))
+        self.assertFalse(store.revoke(first))
+        self.assertIsNone(store.check(first))
+        self.assertEqual(store.check(second), "user1")
+        self.assertEqual(store.revoke_user("user1"), 1)
+        self.assertIsNone(store.check(second))
+        self.assertEqual(store.check(other), "user2")
+
+    def test_oldest_tokens_make_room(self):
+        store = TokenStore(max_tokens=2)
+        tokens = [store.issue(f"user{n}") for n in range(3)]
+        self.assertIsNone(store.check(tokens[0]))
+        self.assertEqual([store.check(token) for token in tokens[1:]], ["user1", "user2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
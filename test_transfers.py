@@ -0,0 +1,74 @@
+import os
+import hashlib
+import tempfile
+import unittest
+
+from transfers import TransferRegistry, split_ranges, range_writer, parse_chunk_log, sha256_range
+
+
+class TransferTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.staging = os.path.join(self.tmp.name, "staging")
+        self.target = os.path.join(self.tmp.name, "file.bin")
+        self.data = os.urandom(10000)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def store_chunk(self, transfer, index):
+        write, digest = transfer.chunk_writer(index)
+        offset, count = transfer.chunk_range(index)
+        write(self.data[offset:offset + count])
+        return transfer.add_chunk(index, digest.hexdigest())
+
+    def test_upload_resumes_after_a_restart(self):
+        registry = TransferRegistry(self.staging)
+        transfer = registry.create("user1", "file.bin", self.target, len(self.data), 4096)
+        self.assertFalse(self.store_chunk(transfer, 0))
+        self.assertFalse(self.store_chunk(transfer, 2))
+        registry.close_all()
+
+        registry = TransferRegistry(self.staging)
+        transfer = registry.resumable("user1", self.target, len(self.data), 4096)
+        self.assertEqual(transfer.missing(), [1])
+        self.assertEqual(transfer.received(), 4096 + len(self.data) - 8192)
+        self.assertTrue(self.store_chunk(transfer, 1))
+        with open(self.target, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(sorted(os.listdir(self.staging)), [])
+
+    def test_other_owner_cannot_pick_up_an_upload(self):
+        registry = TransferRegistry(self.staging)
+        transfer = registry.create("user1", "file.bin", self.target, len(self.data), 4096)
+        self.assertIs(registry.get(transfer.transfer_id, "user1"), transfer)
+        self.assertIsNone(registry.get(transfer.transfer_id, "user2"))
+        registry.close_all()
+
+    def test_torn_chunk_log_line_is_ignored(self):
+        digest = "a" * 64
+        self.assertEqual(parse_chunk_log(f"0 {digest}\n1 {digest}\n2 {digest[:10]}".encode()),
+                         {0: digest, 1: digest})
+
+    def test_ranges_cover_the_file(self):
+        self.assertEqual(split_ranges(10, 4), [(0, 4), (4, 4), (8, 2)])
+        self.assertEqual(split_ranges(0, 4), [(0, 0)])
+
+    def test_range_writer_stays_inside_its_range(self):
+        with open(self.target, "wb+") as f:
+            f.truncate(8)
+            write = range_writer(f.fileno(), 2, 6)
+            write(b"ab")
+            write(b"cd")
+            with self.assertRaises(ValueError):
+                write(b"e")
+            self.assertEqual(os.pread(f.fileno(), 8, 0), b"\0\0abcd\0\0")
+
+    def test_sha256_of_a_range(self):
+        with open(self.target, "wb") as f:
+            f.write(self.data)
+        self.assertEqual(sha256_range(self.target, 100, 5000), hashlib.sha256(self.data[100:5100]).hexdigest())
+
+
+if __name__ == "__main__":
+    unittest.main()
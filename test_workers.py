@@ -0,0 +1,52 @@
+import os
+import time
+import signal
+import threading
+import unittest
+from unittest import mock
+
+import workers
+
+
+def idle(index):
+    time.sleep(60)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@unittest.skipUnless(workers.supported(), "needs SO_REUSEPORT and fork")
+class SupervisorTest(unittest.TestCase):
+    def test_killed_worker_is_restarted_and_stop_reaps_all(self):
+        with mock.patch("workers.RESTART_DELAY", 0.05):
+            supervisor = workers.Supervisor(2, idle)
+        supervisor.start()
+        running = threading.Event()
+        running.set()
+        watcher = threading.Thread(target=supervisor.run, args=(running.is_set, 0.02))
+        watcher.start()
+        try:
+            first = supervisor.workers[0]
+            os.kill(first.pid, signal.SIGKILL)
+            self.assertTrue(wait_for(lambda: supervisor.workers[0] is not first
+                                     and supervisor.workers[0].is_alive()))
+            self.assertEqual(first.exitcode, -signal.SIGKILL)
+            self.assertEqual(len(supervisor.alive()), 2)
+        finally:
+            running.clear()
+            watcher.join()
+            supervisor.stop()
+        processes = supervisor.workers + [first]
+        self.assertEqual(supervisor.alive(), [])
+        self.assertTrue(all(process.exitcode is not None for process in processes))
+        self.assertEqual(supervisor.workers[1].exitcode, -signal.SIGTERM)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import time
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+
+# Session tokens, so a client that reconnects can skip the password check.
+#
+# After a successful AUTH the server hands out a random token. A new
+# connection can present it with RESUME instead of the credentials, which
+# costs a dictionary lookup rather than a Fernet decrypt and a password hash.
+# Tokens live only in this process's memory, expire ttl seconds after they
+# were issued and can be revoked one at a time or for a whole user. Only a
+# hash of each token is kept, so the store itself holds nothing a client
+# could log in with.
+
+DEFAULT_TTL = 3600  # Seconds a token stays valid
+MAX_TOKENS = 100000  # Oldest tokens are dropped beyond this many
+
+
+def token_key(token):
+    return hashlib.sha256(token.encode()).digest()
+
+
+class TokenStore:
+    def __init__(self, ttl=DEFAULT_TTL, max_tokens=MAX_TOKENS):
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self.tokens = OrderedDict()  # token hash -> (username, expiry), oldest first
+        self.lock = threading.Lock()
+
+    def issue(self, username):
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with self.lock:
+            # Tokens are issued in order with the same ttl, so the expired
+            # ones are all at the front
+            while self.tokens and next(iter(self.tokens.values()))[1] < now:
+                self.tokens.popitem(last=False)
+            self.tokens[token_key(token)] = (username, now + self.ttl)
+            while len(self.tokens) > self.max_tokens:
+                self.tokens.popitem(last=False)
+        return token
+
+    def check(self, token):
+        # The user a token belongs to, None if it is unknown, expired or revoked
+        key = token_key(token)
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self.tokens[key]
+                return None
+            return entry[0]
+
+    def revoke(self, token):
+        with self.lock:
+            return self.tokens.pop(token_key(token), None) is not None
+
+    def revoke_user(self, username):
+        # Every token of username, returns how many there were
+        with self.lock:
+            keys = [key for key, (owner, _) in self.tokens.items() if owner == username]
+            for key in keys:
+                del self.tokens[key]
+        return len(keys)
@@ -0,0 +1,404 @@
+import os
+import json
+import time
+import hashlib
+import secrets
+import threading
+
+try:
+    import fcntl  # Locks the chunk log between worker processes
+except ImportError:
+    fcntl = None
+
+# Byte-range transfers: one file assembled from (or split into) pieces that
+# travel over several connections at once, or over one connection across
+# several attempts. Each piece is written with os.pwrite at its own offset
+# into one preallocated file, so the streams never need to coordinate beyond
+# tracking which ranges have arrived.
+#
+# In the multi-process server (see workers.py) the chunks of one upload can
+# arrive at different worker processes. Each of them opens the upload from
+# its sidecar files, and the chunk log, locked with flock while it is read
+# and appended to, is what they agree on: whichever process logs the last
+# chunk moves the file into place.
+
+
+def preallocate(fd, size):
+    # Reserve the blocks up front where the OS supports it, otherwise just
+    # extend the file so every range has somewhere to land
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+def range_writer(fd, offset, limit):
+    # Returns a write(data) callback that pwrites consecutive data starting at
+    # `offset` and refuses to go past `limit`
+    position = offset
+
+    def write(data):
+        nonlocal position
+        view = memoryview(data)
+        if position + len(view) > limit:
+            raise ValueError("Range extends past the end of the file")
+        while view:
+            n = os.pwrite(fd, view, position)
+            position += n
+            view = view[n:]
+
+    return write
+
+
+def split_ranges(filesize, chunk_size):
+    # [(offset, count), ...] covering the whole file
+    if filesize == 0:
+        return [(0, 0)]
+    return [(offset, min(chunk_size, filesize - offset))
+            for offset in range(0, filesize, chunk_size)]
+
+
+def chunk_count(filesize, chunk_size):
+    return (filesize + chunk_size - 1) // chunk_size
+
+
+def sha256_range(path, offset, count, buffer_size=1024 * 1024):
+    # Hex SHA-256 of path[offset:offset + count]
+    with open(path, "rb") as f:
+        return sha256_file(f, offset, count, buffer_size)
+
+
+def sha256_file(f, offset, count, buffer_size=1024 * 1024):
+    # sha256_range() of a file that is already open
+    digest = hashlib.sha256()
+    f.seek(offset)
+    remaining = count
+    while remaining > 0:
+        data = f.read(min(buffer_size, remaining))
+        if not data:
+            break
+        digest.update(data)
+        remaining -= len(data)
+    return digest.hexdigest()
+
+
+def parse_chunk_log(data):
+    # {index: sha256} of the complete lines in data, a line torn by a crash
+    # is simply not counted
+    chunks = {}
+    for line in data.decode(errors="replace").splitlines():
+        parts = line.split()
+        if len(parts) == 2 and len(parts[1]) == 64 and parts[0].isdigit():
+            chunks[int(parts[0])] = parts[1]
+    return chunks
+
+
+def sync(fd):
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+class Transfer:
+    # A chunked upload in progress. Data goes into a preallocated staging
+    # file, next to it a sidecar manifest (<id>.json) describes the upload and
+    # a chunk log (<id>.chunks) lists every chunk whose SHA-256 has been
+    # verified. Both survive a dropped connection or a server restart, so a
+    # client can resume by sending only the chunks that are missing. The
+    # staging file is moved over the target path once every chunk is in, by
+    # publish(staging_path, filepath).
+
+    def __init__(self, transfer_id, staging_dir, manifest, chunks=None, publish=os.replace):
+        self.transfer_id = transfer_id
+        self.owner = manifest["owner"]
+        self.filename = manifest["filename"]
+        self.filepath = manifest["filepath"]
+        self.filesize = manifest["filesize"]
+        self.chunk_size = manifest["chunk_size"]
+        self.staging_path = os.path.join(staging_dir, f"{transfer_id}.part")
+        self.manifest_path = os.path.join(staging_dir, f"{transfer_id}.json")
+        self.chunk_log_path = os.path.join(staging_dir, f"{transfer_id}.chunks")
+        self.chunks = chunks if chunks is not None else {}  # index -> verified sha256
+        self.log_offset = 0  # Bytes of the chunk log already read into chunks
+        self.committed = False
+        self.publish = publish
+        self.lock = threading.Lock()
+        if chunks is None:
+            # New upload: write the manifest, start an empty chunk log
+            self.fd = os.open(self.staging_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            preallocate(self.fd, self.filesize)
+            with open(self.manifest_path, "w") as f:
+                json.dump(manifest, f)
+            open(self.chunk_log_path, "w").close()
+        else:
+            self.fd = os.open(self.staging_path, os.O_RDWR)
+
+    @classmethod
+    def load(cls, staging_dir, transfer_id, publish=os.replace, rewrite=True):
+        # Rebuild an upload from its manifest and chunk log. rewrite cleans
+        # up the log, which is only safe while no other process is using it.
+        with open(os.path.join(staging_dir, f"{transfer_id}.json")) as f:
+            manifest = json.load(f)
+        transfer = cls(transfer_id, staging_dir, manifest, {}, publish)
+        try:
+            with open(transfer.chunk_log_path, "rb") as f:
+                transfer._read_log(f.fileno())
+            if rewrite:
+                # So new entries never get appended to a torn line
+                with open(transfer.chunk_log_path, "w") as f:
+                    f.writelines(f"{index} {digest}\n" for index, digest in transfer.chunks.items())
+                    transfer.log_offset = f.tell()
+        except BaseException:
+            os.close(transfer.fd)
+            raise
+        return transfer
+
+    def _read_log(self, fd):
+        # Add the chunks logged since we last looked, by this process or another
+        data = os.pread(fd, max(os.fstat(fd).st_size - self.log_offset, 0), self.log_offset)
+        end = data.rfind(b"\n") + 1
+        self.chunks.update(parse_chunk_log(data[:end]))
+        self.log_offset += end
+
+    def refresh(self):
+        # Pick up chunks other worker processes have stored
+        with self.lock:
+            if self.committed:
+                return
+            try:
+                with open(self.chunk_log_path, "rb") as f:
+                    self._read_log(f.fileno())
+            except FileNotFoundError:
+                pass
+
+    def total_chunks(self):
+        return chunk_count(self.filesize, self.chunk_size)
+
+    def chunk_range(self, index):
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.filesize - offset)
+
+    def missing(self):
+        return [index for index in range(self.total_chunks()) if index not in self.chunks]
+
+    def received(self):
+        return sum(self.chunk_range(index)[1] for index in self.chunks)
+
+    def chunk_writer(self, index):
+        # write() callback for one chunk plus the hash object fed along the way
+        if index < 0 or index >= self.total_chunks():
+            raise ValueError(f"Chunk {index} outside file of {self.filesize} bytes")
+        offset, count = self.chunk_range(index)
+        digest = hashlib.sha256()
+        pwrite = range_writer(self.fd, offset, offset + count)
+
+        def write(data):
+            digest.update(data)
+            pwrite(data)
+
+        return write, digest
+
+    def add_chunk(self, index, digest):
+        # Record a verified chunk, commit once every chunk is in.
+        # Returns True if this call committed the file.
+        with self.lock:
+            if self.committed:
+                return False
+            try:
+                log = os.open(self.chunk_log_path, os.O_RDWR | os.O_APPEND)
+            except FileNotFoundError:
+                # Committed or discarded by another worker process
+                self._release()
+                return False
+            try:
+                if fcntl is not None:
+                    fcntl.flock(log, fcntl.LOCK_EX)
+                    if os.fstat(log).st_nlink == 0:
+                        self._release()  # Committed while we waited for the lock
+                        return False
+                self._read_log(log)
+                if index not in self.chunks:
+                    # Data must be on disk before the log claims it is
+                    sync(self.fd)
+                    line = f"{index} {digest}\n".encode()
+                    os.write(log, line)
+                    self.log_offset += len(line)
+                    self.chunks[index] = digest
+                if len(self.chunks) < self.total_chunks():
+                    return False
+                return self._commit()
+            finally:
+                os.close(log)  # Also drops the flock
+
+    def commit_if_complete(self):
+        with self.lock:
+            if self.committed or len(self.chunks) < self.total_chunks():
+                return False
+            return self._commit()
+
+    def _commit(self):
+        sync(self.fd)
+        os.close(self.fd)
+        self.publish(self.staging_path, self.filepath)
+        self._remove_sidecars()
+        self.committed = True
+        return True
+
+    def _remove_sidecars(self):
+        for path in (self.manifest_path, self.chunk_log_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _release(self):
+        if not self.committed:
+            self.committed = True
+            os.close(self.fd)
+
+    def close(self):
+        # Stop using the staging file but keep it for a later resume
+        with self.lock:
+            self._release()
+
+    def abort(self):
+        with self.lock:
+            if self.committed:
+                return
+            self.committed = True
+            os.close(self.fd)
+            try:
+                os.remove(self.staging_path)
+            except OSError:
+                pass
+            self._remove_sidecars()
+
+
+class TransferRegistry:
+    # Chunked uploads by id, shared by every connection of the server.
+    # Unfinished uploads found in the staging directory at startup are picked
+    # up again, those older than max_age are discarded.
+
+    def __init__(self, staging_dir, max_age=7 * 24 * 3600, publish=os.replace):
+        self.staging_dir = staging_dir
+        self.publish = publish
+        self.transfers = {}
+        self.lock = threading.Lock()
+        os.makedirs(staging_dir, exist_ok=True)
+        self._load(max_age)
+
+    def _load(self, max_age):
+        now = time.time()
+        for entry in os.listdir(self.staging_dir):
+            if not entry.endswith(".json"):
+                continue
+            transfer_id = entry[:-len(".json")]
+            try:
+                age = now - os.path.getmtime(os.path.join(self.staging_dir, f"{transfer_id}.chunks"))
+                transfer = Transfer.load(self.staging_dir, transfer_id, self.publish)
+            except (OSError, ValueError, KeyError):
+                continue
+            if age > max_age:
+                transfer.abort()
+                continue
+            if transfer.commit_if_complete():
+                continue
+            self.transfers[transfer_id] = transfer
+
+    def _refresh(self):
+        # Catch up with uploads other worker processes started or finished
+        ids = {entry[:-len(".json")] for entry in os.listdir(self.staging_dir) if entry.endswith(".json")}
+        with self.lock:
+            gone = [transfer for transfer_id, transfer in self.transfers.items() if transfer_id not in ids]
+            for transfer in gone:
+                del self.transfers[transfer.transfer_id]
+            new = ids.difference(self.transfers)
+        for transfer in gone:
+            transfer.close()
+        for transfer_id in new:
+            self._adopt(transfer_id)
+
+    def _adopt(self, transfer_id):
+        # Open an upload another process started from its sidecar files
+        if len(transfer_id) != 16 or not all(c in "0123456789abcdef" for c in transfer_id):
+            return None
+        try:
+            transfer = Transfer.load(self.staging_dir, transfer_id, self.publish, rewrite=False)
+        except (OSError, ValueError, KeyError):
+            return None  # Not (or no longer) a complete upload
+        with self.lock:
+            existing = self.transfers.setdefault(transfer_id, transfer)
+        if existing is not transfer:
+            transfer.close()
+        return existing
+
+    def resumable(self, owner, filepath, filesize, chunk_size):
+        # The unfinished upload a client can pick up again, if any
+        self._refresh()
+        with self.lock:
+            for transfer in self.transfers.values():
+                if (transfer.owner, transfer.filepath, transfer.filesize, transfer.chunk_size) == \
+                        (owner, filepath, filesize, chunk_size):
+                    break
+            else:
+                return None
+        transfer.refresh()
+        return transfer
+
+    def create(self, owner, filename, filepath, filesize, chunk_size):
+        # An unfinished upload of a different version of the file can't be
+        # resumed any more, drop it
+        self._refresh()
+        with self.lock:
+            stale = [transfer for transfer in self.transfers.values()
+                     if transfer.owner == owner and transfer.filepath == filepath]
+        for transfer in stale:
+            self.discard(transfer)
+        manifest = {
+            "owner": owner,
+            "filename": filename,
+            "filepath": filepath,
+            "filesize": filesize,
+            "chunk_size": chunk_size,
+        }
+        transfer = Transfer(secrets.token_hex(8), self.staging_dir, manifest, publish=self.publish)
+        if not transfer.commit_if_complete():  # Empty files are complete right away
+            with self.lock:
+                adopted = self.transfers.get(transfer.transfer_id)
+                self.transfers[transfer.transfer_id] = transfer
+            if adopted is not None:
+                adopted.close()  # Picked up by a _refresh() while it was being created
+        return transfer
+
+    def get(self, transfer_id, owner):
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            transfer = self._adopt(transfer_id)
+        elif not os.path.exists(transfer.manifest_path):
+            # Finished or dropped by another worker process
+            self.finish(transfer)
+            transfer.close()
+            return None
+        if transfer is None or transfer.owner != owner:
+            return None
+        return transfer
+
+    def finish(self, transfer):
+        with self.lock:
+            self.transfers.pop(transfer.transfer_id, None)
+
+    def discard(self, transfer):
+        self.finish(transfer)
+        transfer.abort()
+
+    def close_all(self):
+        with self.lock:
+            transfers = list(self.transfers.values())
+            self.transfers.clear()
+        for transfer in transfers:
+            transfer.close()
@@ -0,0 +1,119 @@
+import os
+import time
+import socket
+import signal
+import multiprocessing
+from multiprocessing.managers import SyncManager
+
+# Multi-process server: a supervisor and N forked workers.
+#
+# Every worker binds its own listening socket to the same port with
+# SO_REUSEPORT, and the kernel spreads new connections over them, so each
+# worker runs the normal threaded or asyncio engine with its own interpreter
+# and its own GIL. State that has to be the same in every worker (session
+# tokens, bandwidth buckets) lives in a manager process, the workers reach it
+# through proxies. USERS, the key and the configuration are read-only after
+# startup and inherited with the fork, files are kept on disk, where the
+# storage layer already makes changes atomic. Two caches stay per process:
+# the DIR index (dir_index) and the mapped popular files (hot_files). Both
+# check the mtime on disk before trusting an entry, so a change made by
+# another worker is picked up on the next request, and the file locks of
+# the storage layer only order the transfers of one worker.
+#
+# The supervisor only watches its workers: one that exits is started again,
+# with a growing delay if it keeps dying right after starting, and on
+# shutdown each worker gets SIGTERM and a few seconds to finish its
+# transfers before it is killed.
+
+RESTART_DELAY = 1.0  # Seconds before a crashed worker is started again
+MAX_RESTART_DELAY = 30.0  # Longest wait for a worker that keeps crashing
+STABLE_AFTER = 5.0  # A worker that ran this long resets the delay
+STOP_TIMEOUT = 10.0  # Seconds workers get to finish after SIGTERM
+
+
+def supported():
+    # SO_REUSEPORT and fork, i.e. Linux and the BSDs
+    return hasattr(socket, "SO_REUSEPORT") and "fork" in multiprocessing.get_all_start_methods()
+
+
+class StateManager(SyncManager):
+    pass
+
+
+def share(name, obj):
+    # Serve obj from the manager process as manager.<name>(), must be called
+    # before the manager is started since the manager forks a copy of it
+    StateManager.register(name, callable=lambda: obj)
+
+
+def start_manager():
+    # Forked, so it holds the objects given to share(). It ignores Ctrl+C,
+    # the supervisor shuts it down once the workers are gone.
+    manager = StateManager(ctx=multiprocessing.get_context("fork"))
+    manager.start(signal.signal, (signal.SIGINT, signal.SIG_IGN))
+    return manager
+
+
+class Supervisor:
+    def __init__(self, count, target, args=()):
+        self.count = count
+        self.target = target  # Called as target(index, *args) in every worker
+        self.args = args
+        self.context = multiprocessing.get_context("fork")
+        self.workers = [None] * count  # index -> Process
+        self.started = [0.0] * count  # index -> when it was last started
+        self.delays = [RESTART_DELAY] * count
+        self.restart_at = [None] * count  # index -> when a dead worker is due to start again
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        process = self.context.Process(target=self.target, args=(index,) + tuple(self.args),
+                                       name=f"worker-{index}")
+        process.start()
+        self.workers[index] = process
+        self.started[index] = time.monotonic()
+        self.restart_at[index] = None
+        print(f"[WORKER] Worker {index} started (pid {process.pid}).")
+
+    def alive(self):
+        # pids of the running workers
+        return [process.pid for process in self.workers if process is not None and process.is_alive()]
+
+    def run(self, running, interval=0.2):
+        # Restart workers that exit until running() turns false
+        while running():
+            now = time.monotonic()
+            for index, process in enumerate(self.workers):
+                if self.restart_at[index] is not None:
+                    if now >= self.restart_at[index]:
+                        self._spawn(index)
+                    continue
+                if process.is_alive():
+                    continue
+                process.join()
+                if now - self.started[index] >= STABLE_AFTER:
+                    self.delays[index] = RESTART_DELAY
+                delay = self.delays[index]
+                self.delays[index] = min(delay * 2, MAX_RESTART_DELAY)
+                self.restart_at[index] = now + delay
+                print(f"[WORKER] Worker {index} (pid {process.pid}) exited with code {process.exitcode}, "
+                      f"restarting in {delay:.0f}s.")
+            time.sleep(interval)
+
+    def stop(self):
+        running = [process for process in self.workers if process is not None and process.is_alive()]
+        for process in running:
+            try:
+                os.kill(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in running:
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                print(f"[WORKER] Worker pid {process.pid} did not stop in time, killing it.")
+                process.kill()
+                process.join()